@@ -8,6 +8,8 @@ if not os.path.exists(CONFIG_DIR):
     os.makedirs(CONFIG_DIR, exist_ok=True)
 
 CONFIG_FILE = os.path.join(CONFIG_DIR, "config.json")
+# EmbyPulse 自有的旁路数据库 (汇总表/索引等)，插件库只读不碰
+SIDECAR_DB_PATH = os.path.join(CONFIG_DIR, "pulse_data.db")
 FONT_DIR = os.path.join(CONFIG_DIR, "fonts")
 if not os.path.exists(FONT_DIR):
     os.makedirs(FONT_DIR, exist_ok=True)
@@ -41,6 +43,8 @@ DEFAULT_CONFIG = {
     "emby_host": os.getenv("EMBY_HOST", "http://127.0.0.1:8096").rstrip('/'),
     "emby_api_key": os.getenv("EMBY_API_KEY", "").strip(),
     "emby_public_host": "",
+    "emby_pool_size": 16, # Emby 连接池大小
+    "image_cache_max_mb": 512, # 图片磁盘缓存上限
     "tmdb_api_key": os.getenv("TMDB_API_KEY", "").strip(),
     "proxy_url": "",
     "hidden_users": [],
@@ -49,8 +53,14 @@ DEFAULT_CONFIG = {
     "enable_bot": False,  
     "enable_notify": False,
     "enable_library_notify": False,
+    "tg_webhook_mode": False, # Telegram 推送模式 (setWebhook)，替代 getUpdates 长轮询
+    "tg_webhook_url": "", # 对外可访问的 EmbyPulse 地址，Telegram 回调 {地址}/api/v1/telegram/webhook
+    "tg_webhook_secret": "", # 回调校验令牌 (X-Telegram-Bot-Api-Secret-Token)，留空自动生成
+    "tg_api_base": "", # Bot API 地址，留空为官方 https://api.telegram.org (可指向自建 Bot API 或测试替身)
     "webhook_token": "embypulse",
     "calendar_cache_ttl": 86400, # 🔥 新增默认值
+    "geoip_db_path": "", # 离线 IP 库 (MaxMind .mmdb)，留空则只用缓存 + 在线查询
+    "geoip_online": True, # 本地查不到时是否后台调用 ip-api
     "scheduled_tasks": []
 }
 
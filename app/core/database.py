@@ -1,6 +1,232 @@
+import asyncio
+import functools
 import sqlite3
 import os
-from app.core.config import cfg, DB_PATH
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from app.core.config import cfg, DB_PATH, SIDECAR_DB_PATH
+
+# ================= 连接池配置 =================
+# 读连接数上限 (仪表盘一次加载就会并发好几个查询)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# 等待空闲连接的最长时间 (秒)
+DB_POOL_TIMEOUT = 20.0
+# 读连接调优：cache_size 为负数表示 KiB，mmap 让大库的热页直接走页缓存
+DB_CACHE_SIZE_KIB = 32768
+DB_MMAP_SIZE = 256 * 1024 * 1024
+# async 路由访问数据库用的有界线程池 (与读连接数一致，多出来的请求排队而不是挤占 Starlette 默认线程池)
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_SIZE)))
+
+def clean_item_name(name):
+    """条目名归一化：剧集 "剧名 - S01E01 - 标题" 只保留剧名，用于按剧聚合"""
+    return name.split(' - ')[0] if name else name
+
+class SQLitePool:
+    """
+    SQLite 连接管理器
+    - 读：有上限的只读连接池 (mode=ro + query_only)，连接复用，免去每次冷连接的开销
+    - 写：单一专用写连接 (users_meta / invitations)，串行化所有写操作
+    """
+    def __init__(self, path, size=DB_POOL_SIZE, wal=False):
+        self.path = path
+        self.size = max(1, size)
+        self.wal = wal
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "discarded": 0,
+            "writes": 0,
+            "write_wait_ms_total": 0.0,
+        }
+
+    # ---------- 连接创建 ----------
+    def _file_id(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_dev, st.st_ino)
+        except OSError:
+            return None
+
+    def _tune(self, conn):
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KIB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        # 注册 SQL 函数，让按剧名的分组/排序/截断都在数据库内完成
+        conn.create_function("clean_name", 1, clean_item_name, deterministic=True)
+
+    def _open_reader(self):
+        uri = f"file:{urllib.request.pathname2url(self.path)}?mode=ro"
+        try:
+            conn = sqlite3.connect(uri, uri=True, timeout=DB_POOL_TIMEOUT, check_same_thread=False)
+            conn.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+        except sqlite3.Error:
+            # WAL 库在缺少 -shm 文件时无法以 mode=ro 打开，退回普通连接 + query_only
+            conn = sqlite3.connect(self.path, timeout=DB_POOL_TIMEOUT, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        self._tune(conn)
+        # 记录文件身份：插件重建数据库后旧连接会指向已删除的 inode
+        return conn, self._file_id()
+
+    def _open_writer(self):
+        conn = sqlite3.connect(self.path, timeout=DB_POOL_TIMEOUT, check_same_thread=False)
+        if self.wal:
+            # 自有库使用 WAL：后台写入不阻塞前台读取
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        self._tune(conn)
+        return conn
+
+    # ---------- 读连接 ----------
+    @contextmanager
+    def reader(self):
+        start = time.perf_counter()
+        waited = False
+        entry = None
+        try:
+            entry = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create: self._created += 1
+            if can_create:
+                try:
+                    entry = self._open_reader()
+                except Exception:
+                    with self._lock: self._created -= 1
+                    raise
+            else:
+                waited = True
+                try:
+                    entry = self._idle.get(timeout=DB_POOL_TIMEOUT)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("DB pool exhausted")
+
+        wait_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._stats["checkouts"] += 1
+            if waited: self._stats["waits"] += 1
+            self._stats["wait_ms_total"] += wait_ms
+            self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+
+        conn, file_id = entry
+        if file_id != self._file_id():
+            # 数据库文件已被替换，丢弃旧连接
+            self._discard(conn)
+            with self._lock: self._created += 1
+            try:
+                conn, file_id = self._open_reader()
+            except Exception:
+                with self._lock: self._created -= 1
+                raise
+
+        healthy = True
+        try:
+            yield conn
+        except sqlite3.DatabaseError:
+            healthy = False
+            raise
+        finally:
+            if healthy:
+                self._idle.put((conn, file_id))
+            else:
+                self._discard(conn)
+
+    def _discard(self, conn):
+        try: conn.close()
+        except Exception: pass
+        with self._lock:
+            self._created -= 1
+            self._stats["discarded"] += 1
+
+    # ---------- 写连接 ----------
+    @contextmanager
+    def writer(self):
+        start = time.perf_counter()
+        with self._writer_lock:
+            with self._lock:
+                self._stats["writes"] += 1
+                self._stats["write_wait_ms_total"] += (time.perf_counter() - start) * 1000
+            if self._writer is None:
+                self._writer = self._open_writer()
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                try: self._writer.rollback()
+                except Exception: pass
+                raise
+
+    def get_stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["size"] = self.size
+            s["open"] = self._created
+            s["idle"] = self._idle.qsize()
+            s["in_use"] = self._created - s["idle"]
+        s["wait_ms_avg"] = round(s["wait_ms_total"] / s["checkouts"], 3) if s["checkouts"] else 0
+        s["wait_ms_total"] = round(s["wait_ms_total"], 3)
+        s["wait_ms_max"] = round(s["wait_ms_max"], 3)
+        s["write_wait_ms_total"] = round(s["write_wait_ms_total"], 3)
+        return s
+
+db_pool = SQLitePool(DB_PATH)
+sidecar_pool = SQLitePool(SIDECAR_DB_PATH, wal=True)
+
+# ================= 数据库线程池 =================
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+_executor_lock = threading.Lock()
+_executor_stats = {"submitted": 0, "in_flight": 0, "max_in_flight": 0, "queue_ms_total": 0.0, "queue_ms_max": 0.0}
+
+def _run_tracked(fn, submitted_at):
+    waited = (time.perf_counter() - submitted_at) * 1000
+    with _executor_lock:
+        _executor_stats["queue_ms_total"] += waited
+        _executor_stats["queue_ms_max"] = max(_executor_stats["queue_ms_max"], waited)
+    try: return fn()
+    finally:
+        with _executor_lock: _executor_stats["in_flight"] -= 1
+
+async def run_db(fn, *args, **kwargs):
+    """在 db_executor 里执行同步的数据库函数，供 async 路由 await"""
+    with _executor_lock:
+        _executor_stats["submitted"] += 1
+        _executor_stats["in_flight"] += 1
+        _executor_stats["max_in_flight"] = max(_executor_stats["max_in_flight"], _executor_stats["in_flight"])
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, _run_tracked, functools.partial(fn, *args, **kwargs), time.perf_counter())
+
+def db_handler(fn):
+    """
+    装饰器：把只查库的同步路由函数包装成 async def，整体放进 db_executor 执行
+    用在 @router.get(...) 下面，FastAPI 通过 __wrapped__ 读取原函数的参数签名
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run_db(fn, *args, **kwargs)
+    return wrapper
+
+def get_executor_stats():
+    with _executor_lock: s = dict(_executor_stats)
+    s["workers"] = DB_EXECUTOR_WORKERS
+    s["queue_ms_avg"] = round(s["queue_ms_total"] / s["submitted"], 3) if s["submitted"] else 0
+    s["queue_ms_total"] = round(s["queue_ms_total"], 3)
+    s["queue_ms_max"] = round(s["queue_ms_max"], 3)
+    return s
+
+def get_pool_stats():
+    return {"plugin": db_pool.get_stats(), "sidecar": sidecar_pool.get_stats(), "executor": get_executor_stats()}
 
 def init_db():
     # 确保数据库目录存在
@@ -11,66 +237,83 @@ def init_db():
         except: pass
 
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        # 1. 只初始化机器人专属配置表 (不碰插件的表)
-        c.execute('''CREATE TABLE IF NOT EXISTS users_meta (
-                        user_id TEXT PRIMARY KEY,
-                        expire_date TEXT,
-                        note TEXT,
-                        created_at TEXT
-                    )''')
-        
-        # 2. 🔥 新增：邀请码表
-        c.execute('''CREATE TABLE IF NOT EXISTS invitations (
-                        code TEXT PRIMARY KEY,
-                        days INTEGER,        -- 有效期天数 (-1为永久)
-                        used_count INTEGER DEFAULT 0,
-                        max_uses INTEGER DEFAULT 1,
-                        created_at TEXT
-                    )''')
-        
-        conn.commit()
-        conn.close()
+        with db_pool.writer() as conn:
+            c = conn.cursor()
+
+            # 1. 只初始化机器人专属配置表 (不碰插件的表)
+            c.execute('''CREATE TABLE IF NOT EXISTS users_meta (
+                            user_id TEXT PRIMARY KEY,
+                            expire_date TEXT,
+                            note TEXT,
+                            created_at TEXT
+                        )''')
+
+            # 2. 🔥 新增：邀请码表
+            c.execute('''CREATE TABLE IF NOT EXISTS invitations (
+                            code TEXT PRIMARY KEY,
+                            days INTEGER,        -- 有效期天数 (-1为永久)
+                            used_count INTEGER DEFAULT 0,
+                            max_uses INTEGER DEFAULT 1,
+                            created_at TEXT
+                        )''')
         print("✅ Database initialized (Plugin Read-Only Mode).")
-    except Exception as e: 
+    except Exception as e:
         print(f"❌ DB Init Error: {e}")
 
+    # 旁路库：首次打开写连接即创建文件并切换到 WAL
+    try:
+        with sidecar_pool.writer(): pass
+    except Exception as e:
+        print(f"❌ Sidecar DB Init Error: {e}")
+
 def query_db(query, args=(), one=False):
     if not os.path.exists(DB_PATH): return None
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=20.0)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute(query, args)
         if query.strip().upper().startswith("SELECT"):
-            rv = cur.fetchall()
-            conn.close()
+            with db_pool.reader() as conn:
+                rv = conn.execute(query, args).fetchall()
             return (rv[0] if rv else None) if one else rv
         else:
-            conn.commit()
-            conn.close()
+            # 写操作统一走专用写连接
+            with db_pool.writer() as conn:
+                conn.execute(query, args)
             return True
-    except Exception as e: 
+    except Exception as e:
         print(f"SQL Error: {e}")
         return None
 
-def get_base_filter(user_id_filter):
+def query_sidecar(query, args=(), one=False):
+    """与 query_db 相同的用法，但查询 EmbyPulse 自有的旁路库"""
+    try:
+        if query.strip().upper().startswith("SELECT"):
+            with sidecar_pool.reader() as conn:
+                rv = conn.execute(query, args).fetchall()
+            return (rv[0] if rv else None) if one else rv
+        else:
+            with sidecar_pool.writer() as conn:
+                conn.execute(query, args)
+            return True
+    except Exception as e:
+        print(f"Sidecar SQL Error: {e}")
+        return None
+
+def get_base_filter(user_id_filter, alias=None):
     where = "WHERE 1=1"
     params = []
-    
+    # 多表查询时给 UserId 加表别名 (如 alias="s" → s.UserId)
+    col = f"{alias}.UserId" if alias else "UserId"
+
     # 注意：插件数据库列名通常是 UserId (PascalCase)
     # 如果您的插件版本不同，可能需要改为 user_id，但标准版是 UserId
     if user_id_filter and user_id_filter != 'all':
-        where += " AND UserId = ?"
+        where += f" AND {col} = ?"
         params.append(user_id_filter)
-    
+
     # 隐藏用户过滤
     hidden = cfg.get("hidden_users")
     if (not user_id_filter or user_id_filter == 'all') and hidden and len(hidden) > 0:
         placeholders = ','.join(['?'] * len(hidden))
-        where += f" AND UserId NOT IN ({placeholders})"
+        where += f" AND {col} NOT IN ({placeholders})"
         params.extend(hidden)
-        
-    return where, params
\ No newline at end of file
+
+    return where, params
@@ -0,0 +1,186 @@
+import asyncio
+import random
+import re
+import threading
+import time
+import logging
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from app.core.config import cfg
+
+logger = logging.getLogger("uvicorn")
+
+# ================= Emby 客户端配置 =================
+# GET 请求的重试次数 (仅幂等请求会重试)
+EMBY_RETRIES = 2
+# 重试退避基数 (秒)，实际等待 = 基数 * 2^n + 随机抖动
+EMBY_BACKOFF = 0.3
+# 这些状态码视为临时故障，可以重试
+RETRY_STATUS = {502, 503, 504}
+# 延迟直方图的桶上界 (毫秒)
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# 把路径中的 ID 段归一化，避免直方图按条目无限膨胀
+_ID_SEGMENT = re.compile(r"/(?:[0-9a-fA-F]{16,}|[0-9a-fA-F-]{36}|\d+)(?=/|$)")
+
+class EmbyClient:
+    """
+    全局共享的 Emby HTTP 客户端
+    - 一个带连接池的 Session，HTTP keep-alive 复用 TCP/TLS 连接
+    - API Key 放在 X-Emby-Token 头里，不再拼进 URL
+    - 幂等 GET 带退避 + 抖动重试
+    - 按接口记录延迟直方图
+    - 另有 httpx.AsyncClient 供 async 路由使用 (aget/apost/adelete)，慢请求不占线程
+    """
+    def __init__(self):
+        self._session = None
+        self._pool_size = None
+        self._async_client = None
+        self._async_loop = None
+        self._async_pool_size = None
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_session(self):
+        pool_size = int(cfg.get("emby_pool_size") or 16)
+        with self._lock:
+            if self._session is None or self._pool_size != pool_size:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=False)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"Accept": "application/json"})
+                if self._session is not None: self._session.close()
+                self._session = session
+                self._pool_size = pool_size
+            return self._session
+
+    def _get_async_client(self):
+        # AsyncClient 绑定创建它的事件循环，循环变了 (测试/重载) 就重建
+        pool_size = int(cfg.get("emby_pool_size") or 16)
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop or self._async_pool_size != pool_size:
+            if self._async_client is not None and self._async_loop is loop:
+                loop.create_task(self._async_client.aclose())
+            # 与同步 Session (pool_block=False) 一致：常驻连接数受限，突发时允许临时多开
+            self._async_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+                headers={"Accept": "application/json"})
+            self._async_loop = loop
+            self._async_pool_size = pool_size
+        return self._async_client
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def is_configured(self):
+        return bool(cfg.get("emby_host") and cfg.get("emby_api_key"))
+
+    def request(self, method, path, params=None, json=None, headers=None, timeout=10, stream=False, retries=None):
+        """
+        发起 Emby 请求，path 形如 /emby/Users
+        返回 requests.Response；网络异常在重试耗尽后向上抛出
+        """
+        host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
+        req_headers = {"X-Emby-Token": key or ""}
+        if headers: req_headers.update(headers)
+        method = method.upper()
+        if retries is None: retries = EMBY_RETRIES if method == "GET" else 0
+        endpoint = f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+        session = self._get_session()
+
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                resp = session.request(method, f"{host}{path}", params=params, json=json,
+                                       headers=req_headers, timeout=timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(endpoint, start, error=True)
+                if attempt >= retries: raise
+                logger.warning(f"Emby {endpoint} 失败，重试中 ({attempt + 1}/{retries}): {e}")
+                self._sleep_backoff(attempt)
+                continue
+            self._record(endpoint, start, error=resp.status_code >= 500)
+            if resp.status_code in RETRY_STATUS and attempt < retries:
+                resp.close()
+                self._sleep_backoff(attempt)
+                continue
+            return resp
+
+    async def arequest(self, method, path, params=None, json=None, headers=None, timeout=10, stream=False, retries=None):
+        """
+        request() 的异步版本，返回 httpx.Response (status_code / json() / content / headers 用法一致)
+        stream=True 时不读响应体，调用方用 aiter_bytes() 读取并负责 aclose()
+        """
+        host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
+        req_headers = {"X-Emby-Token": key or ""}
+        if headers: req_headers.update(headers)
+        method = method.upper()
+        if retries is None: retries = EMBY_RETRIES if method == "GET" else 0
+        endpoint = f"{method} {_ID_SEGMENT.sub('/{id}', path)}"
+        client = self._get_async_client()
+
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            try:
+                req = client.build_request(method, f"{host}{path}", params=params, json=json,
+                                           headers=req_headers, timeout=timeout)
+                resp = await client.send(req, stream=stream)
+            except httpx.TransportError as e:
+                self._record(endpoint, start, error=True)
+                if attempt >= retries: raise
+                logger.warning(f"Emby {endpoint} 失败，重试中 ({attempt + 1}/{retries}): {e}")
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            self._record(endpoint, start, error=resp.status_code >= 500)
+            if resp.status_code in RETRY_STATUS and attempt < retries:
+                await resp.aclose()
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            return resp
+
+    def get(self, path, **kwargs): return self.request("GET", path, **kwargs)
+    def post(self, path, **kwargs): return self.request("POST", path, **kwargs)
+    def delete(self, path, **kwargs): return self.request("DELETE", path, **kwargs)
+    async def aget(self, path, **kwargs): return await self.arequest("GET", path, **kwargs)
+    async def apost(self, path, **kwargs): return await self.arequest("POST", path, **kwargs)
+    async def adelete(self, path, **kwargs): return await self.arequest("DELETE", path, **kwargs)
+
+    def _backoff(self, attempt):
+        return EMBY_BACKOFF * (2 ** attempt) + random.uniform(0, EMBY_BACKOFF)
+
+    def _sleep_backoff(self, attempt):
+        time.sleep(self._backoff(attempt))
+
+    def _record(self, endpoint, start, error=False):
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            m = self._metrics.get(endpoint)
+            if m is None:
+                m = {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+                self._metrics[endpoint] = m
+            m["count"] += 1
+            if error: m["errors"] += 1
+            m["total_ms"] += elapsed
+            m["max_ms"] = max(m["max_ms"], elapsed)
+            idx = next((i for i, b in enumerate(LATENCY_BUCKETS_MS) if elapsed <= b), len(LATENCY_BUCKETS_MS))
+            m["buckets"][idx] += 1
+
+    def get_stats(self):
+        labels = [f"<={b}ms" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        with self._lock:
+            data = {}
+            for endpoint, m in self._metrics.items():
+                data[endpoint] = {
+                    "count": m["count"],
+                    "errors": m["errors"],
+                    "avg_ms": round(m["total_ms"] / m["count"], 1) if m["count"] else 0,
+                    "max_ms": round(m["max_ms"], 1),
+                    "histogram": dict(zip(labels, m["buckets"])),
+                }
+        return {"pool_size": self._pool_size, "endpoints": data}
+
+emby = EmbyClient()
@@ -0,0 +1,40 @@
+import time
+import threading
+
+class TokenBucket:
+    """简单令牌桶限速器，线程安全，拿不到令牌时阻塞等待"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited_ms = 0.0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+                self.waited_ms += wait * 1000
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """非阻塞：拿到令牌返回 0，否则返回还需等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """归还一个令牌 (拿到后因其它限制没能使用时)"""
+        with self.lock: self.tokens = min(self.capacity, self.tokens + 1)
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import threading
+from fastapi.responses import StreamingResponse
+
+# 每个订阅者最多积压的事件数，超过后丢弃积压并重发一次全量快照
+SSE_QUEUE_SIZE = 100
+# 心跳间隔 (秒)，防止反向代理因空闲断开连接
+SSE_HEARTBEAT = 15
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class ChangeFeed:
+    """
+    后台线程 → 浏览器的变更广播 (Server-Sent Events)
+    生产者在任意线程调用 publish()，每个 SSE 连接持有一个有界 asyncio 队列；
+    新连接和积压溢出的连接都会先收到 snapshot_fn() 生成的全量快照
+    """
+    def __init__(self, snapshot_fn=None, snapshot_event="snapshot"):
+        self.snapshot_fn = snapshot_fn
+        self.snapshot_event = snapshot_event
+        self._subs = set()
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscriber_count(self):
+        with self._lock: return len(self._subs)
+
+    def publish(self, event, data):
+        payload = format_sse(event, data)
+        with self._lock:
+            subs = list(self._subs)
+            self.published += 1
+        for loop, queue in subs:
+            try: loop.call_soon_threadsafe(self._offer, queue, payload)
+            except RuntimeError: pass  # 事件循环已关闭
+
+    def _snapshot_payload(self):
+        return format_sse(self.snapshot_event, self.snapshot_fn()) if self.snapshot_fn else None
+
+    def _offer(self, queue, payload):
+        if queue.full():
+            # 客户端消费太慢：清空积压，用一份快照让它重新对齐
+            while not queue.empty(): queue.get_nowait()
+            snapshot = self._snapshot_payload()
+            if snapshot: queue.put_nowait(snapshot)
+            return
+        queue.put_nowait(payload)
+
+    async def stream(self, request):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        sub = (loop, queue)
+        with self._lock: self._subs.add(sub)
+        try:
+            snapshot = self._snapshot_payload()
+            if snapshot: yield snapshot
+            while True:
+                if await request.is_disconnected(): break
+                try:
+                    payload = await asyncio.wait_for(queue.get(), SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                yield payload
+        finally:
+            with self._lock: self._subs.discard(sub)
+
+    def response(self, request):
+        return StreamingResponse(self.stream(request), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,117 @@
+import json
+import time
+import threading
+import logging
+import requests
+from app.core.config import cfg
+from app.core.database import query_sidecar, sidecar_pool
+from app.core.ratelimit import TokenBucket
+
+logger = logging.getLogger("uvicorn")
+
+TMDB_API_BASE = "https://api.themoviedb.org/3"
+# 缓存有效期 (秒)：连载中的季/剧集详情短一些，已完结的季长一些
+TMDB_TTL_SHORT = 6 * 3600
+TMDB_TTL_LONG = 7 * 86400
+# 404 等确定性失败也缓存一会，避免反复请求
+TMDB_TTL_NEGATIVE = 3600
+# 令牌桶：平均每秒请求数与突发容量 (TMDB 限制约 50 次/秒/IP，留足余量)
+TMDB_RATE = 20
+TMDB_BURST = 40
+
+class TmdbClient:
+    """
+    TMDB 客户端 (带持久化缓存)
+    - 响应按 路径 + 参数 (含语言，不含 api_key) 缓存在旁路库 tmdb_cache 表，重启不丢
+    - 过期后带 If-None-Match 条件请求，304 只刷新时间戳
+    - 请求失败时回退到过期缓存
+    - 令牌桶限速
+    """
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self.limiter = TokenBucket(TMDB_RATE, TMDB_BURST)
+        self._stats = {"hits": 0, "revalidated": 0, "fetched": 0, "stale_served": 0, "errors": 0}
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+            return self._session
+
+    def _ensure_schema(self):
+        if self._schema_ready: return
+        with sidecar_pool.writer() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS tmdb_cache (
+                                CacheKey TEXT PRIMARY KEY, ETag TEXT, Status INTEGER,
+                                Body TEXT, FetchedAt REAL, Ttl REAL
+                            )""")
+        self._schema_ready = True
+
+    def _proxies(self):
+        proxy = cfg.get("proxy_url")
+        return {"http": proxy, "https": proxy} if proxy else None
+
+    def _count(self, key):
+        with self._lock: self._stats[key] += 1
+
+    def get(self, path, params=None, ttl=TMDB_TTL_SHORT, timeout=5):
+        """
+        GET TMDB 接口，path 形如 /tv/1399
+        返回解析后的 JSON；失败且没有可用缓存时返回 None
+        """
+        api_key = cfg.get("tmdb_api_key")
+        if not api_key: return None
+        self._ensure_schema()
+        params = dict(params or {})
+        cache_key = path + "?" + "&".join(f"{k}={params[k]}" for k in sorted(params))
+        row = query_sidecar("SELECT * FROM tmdb_cache WHERE CacheKey = ?", (cache_key,), one=True)
+        now = time.time()
+
+        if row and now - row['FetchedAt'] < row['Ttl']:
+            self._count("hits")
+            return json.loads(row['Body']) if row['Status'] == 200 else None
+
+        headers = {"Accept": "application/json"}
+        if row and row['ETag'] and row['Status'] == 200: headers["If-None-Match"] = row['ETag']
+        self.limiter.acquire()
+        try:
+            res = self._get_session().get(f"{TMDB_API_BASE}{path}", params={**params, "api_key": api_key},
+                                          headers=headers, timeout=timeout, proxies=self._proxies())
+        except requests.RequestException as e:
+            logger.warning(f"TMDB Request Error {path}: {e}")
+            return self._stale(row)
+
+        if res.status_code == 304 and row:
+            # 内容没变，只续期
+            query_sidecar("UPDATE tmdb_cache SET FetchedAt = ?, Ttl = ? WHERE CacheKey = ?", (now, ttl, cache_key))
+            self._count("revalidated")
+            return json.loads(row['Body'])
+        if res.status_code == 200:
+            query_sidecar("INSERT OR REPLACE INTO tmdb_cache (CacheKey, ETag, Status, Body, FetchedAt, Ttl) VALUES (?, ?, ?, ?, ?, ?)",
+                          (cache_key, res.headers.get("ETag"), 200, res.text, now, ttl))
+            self._count("fetched")
+            return res.json()
+        if res.status_code == 404:
+            query_sidecar("INSERT OR REPLACE INTO tmdb_cache (CacheKey, ETag, Status, Body, FetchedAt, Ttl) VALUES (?, ?, ?, ?, ?, ?)",
+                          (cache_key, None, 404, "null", now, TMDB_TTL_NEGATIVE))
+            self._count("fetched")
+            return None
+        # 429 / 5xx 等临时错误
+        logger.warning(f"TMDB {path} 返回 {res.status_code}")
+        return self._stale(row)
+
+    def _stale(self, row):
+        self._count("errors")
+        if row and row['Status'] == 200:
+            self._count("stale_served")
+            return json.loads(row['Body'])
+        return None
+
+    def get_stats(self):
+        with self._lock: s = dict(self._stats)
+        s["limiter_wait_ms"] = round(self.limiter.waited_ms, 1)
+        return s
+
+tmdb = TmdbClient()
@@ -8,7 +8,16 @@ from app.routers import insight
 
 from app.core.config import PORT, SECRET_KEY, CONFIG_DIR, FONT_DIR
 from app.core.database import init_db
+from app.core.emby import emby
 from app.services.bot_service import bot
+from app.services.rollup_service import rollup_service
+from app.services.search_index import history_index
+from app.services.quality_service import quality_service
+from app.services.calendar_service import calendar_service
+from app.services.session_service import session_monitor
+from app.services.task_monitor import task_monitor
+from app.services.webhook_queue import webhook_queue
+from app.services.geoip import geoip
 # 🔥 引入新路由 webhook
 from app.routers import views, auth, users, stats, bot as bot_router, system, proxy, report, webhook,insight,tasks,history,calendar
 
@@ -22,10 +31,27 @@ init_db()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("🚀 Starting EmbyPulse...")
+    webhook_queue.start()
     bot.start()
+    rollup_service.start()
+    history_index.start()
+    quality_service.start()
+    calendar_service.start()
+    session_monitor.start()
+    task_monitor.start()
+    geoip.start()
     yield
     print("🛑 Stopping EmbyPulse...")
     bot.stop()
+    rollup_service.stop()
+    history_index.stop()
+    quality_service.stop()
+    calendar_service.stop()
+    session_monitor.stop()
+    task_monitor.stop()
+    geoip.stop()
+    webhook_queue.stop()
+    await emby.aclose()
 
 app = FastAPI(lifespan=lifespan)
 
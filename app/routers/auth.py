@@ -3,6 +3,8 @@ from fastapi.responses import JSONResponse, RedirectResponse
 from app.core.config import cfg
 from app.core.database import query_db
 from app.schemas.models import LoginModel, UserRegisterModel
+from app.services.user_directory import user_directory
+from app.core.emby import emby
 import requests
 import datetime
 
@@ -21,26 +23,26 @@ async def api_register(data: UserRegisterModel):
             return JSONResponse(content={"status": "error", "message": "邀请码已被使用"})
 
         # 2. 准备 Emby 连接
-        host = cfg.get("emby_host"); key = cfg.get("emby_api_key")
-        if not host or not key:
+        if not emby.is_configured():
             return JSONResponse(content={"status": "error", "message": "系统未配置 Emby 连接"})
 
         # 3. 创建用户
-        res = requests.post(f"{host}/emby/Users/New?api_key={key}", json={"Name": data.username})
+        res = emby.post("/emby/Users/New", json={"Name": data.username})
         if res.status_code != 200:
             return JSONResponse(content={"status": "error", "message": f"用户名可能已存在"})
         
         new_id = res.json()['Id']
+        user_directory.invalidate()
 
         # 4. 设置密码
-        pwd_res = requests.post(f"{host}/emby/Users/{new_id}/Password?api_key={key}", json={"Id": new_id, "NewPw": data.password})
+        pwd_res = emby.post(f"/emby/Users/{new_id}/Password", json={"Id": new_id, "NewPw": data.password})
         if pwd_res.status_code not in [200, 204]:
             # 回滚：删除用户
-            requests.delete(f"{host}/emby/Users/{new_id}?api_key={key}")
+            emby.delete(f"/emby/Users/{new_id}")
             return JSONResponse(content={"status": "error", "message": "密码设置失败"})
 
         # 5. 初始化策略 (启用账户)
-        requests.post(f"{host}/emby/Users/{new_id}/Policy?api_key={key}", json={"IsDisabled": False, "LoginAttemptsBeforeLockout": -1})
+        emby.post(f"/emby/Users/{new_id}/Policy", json={"IsDisabled": False, "LoginAttemptsBeforeLockout": -1})
 
         # 6. 计算过期时间
         expire_date = None
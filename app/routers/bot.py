@@ -2,7 +2,9 @@ from fastapi import APIRouter, Request
 from app.schemas.models import BotSettingsModel
 from app.core.config import cfg
 from app.services.bot_service import bot
+from app.services.telegram_outbox import tg_api_url
 import requests
+import secrets
 import threading
 
 router = APIRouter()
@@ -19,6 +21,10 @@ def api_save_bot_settings(data: BotSettingsModel, request: Request):
     cfg.set("enable_bot", data.enable_bot)
     cfg.set("enable_notify", data.enable_notify)
     cfg.set("enable_library_notify", data.enable_library_notify) # 🔥 新增
+    cfg.set("tg_webhook_mode", data.tg_webhook_mode)
+    cfg.set("tg_webhook_url", (data.tg_webhook_url or "").rstrip('/'))
+    # 首次开启推送模式时生成回调校验令牌 (Telegram 只允许 A-Z a-z 0-9 _ -)
+    if data.tg_webhook_mode and not cfg.get("tg_webhook_secret"): cfg.set("tg_webhook_secret", secrets.token_urlsafe(32))
     
     bot.stop()
     if data.enable_bot: threading.Timer(1.0, bot.start).start()
@@ -31,6 +37,6 @@ def api_test_bot(request: Request):
     if not token: return {"status": "error", "message": "请先保存配置"}
     try:
         proxies = {"http": proxy, "https": proxy} if proxy else None
-        res = requests.post(f"https://api.telegram.org/bot{token}/sendMessage", json={"chat_id": chat_id, "text": "🎉 测试消息"}, proxies=proxies, timeout=10)
+        res = requests.post(tg_api_url(token, "sendMessage"), json={"chat_id": chat_id, "text": "🎉 测试消息"}, proxies=proxies, timeout=10)
         return {"status": "success"} if res.status_code == 200 else {"status": "error", "message": f"API Error: {res.text}"}
     except Exception as e: return {"status": "error", "message": str(e)}
\ No newline at end of file
@@ -17,10 +17,10 @@ async def calendar_page(request: Request):
     return templates.TemplateResponse("calendar.html", {"request": request, "active_page": "calendar"})
 
 @router.get("/api/calendar/weekly")
-async def get_weekly_calendar(refresh: bool = False, offset: int = 0): 
+def get_weekly_calendar(refresh: bool = False, offset: int = 0): 
     """
     API: 获取本周数据 (JSON)
-    refresh: 是否强制刷新缓存
+    refresh: 是否强制刷新缓存 (后台重建，先返回现有数据)
     offset: 周偏移 (0=本周, 1=下周, -1=上周)
     """
     return calendar_service.get_weekly_calendar(force_refresh=refresh, week_offset=offset)
@@ -1,36 +1,81 @@
 from fastapi import APIRouter
 from typing import Optional
-from app.core.database import query_db
+from app.core.database import query_db, query_sidecar, db_handler
+from app.services.rollup_service import rollup_service
+from app.services.search_index import history_index
 from app.core.config import cfg
-import requests
+from app.services.user_directory import user_directory, with_user_directory
 import math
+import time
+import base64
+import threading
+import html
 
 router = APIRouter()
 
-# --- 内部工具：获取用户映射 ---
-def get_user_map_local():
-    user_map = {}
-    key = cfg.get("emby_api_key")
-    host = cfg.get("emby_host")
-    if key and host:
-        try:
-            res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=2)
-            if res.status_code == 200:
-                for u in res.json(): 
-                    user_map[u['Id']] = u['Name']
-        except: 
-            pass
-    return user_map
+# 总条数缓存 (按过滤条件)，翻页时不再每页都 COUNT(*) 全表
+HISTORY_COUNT_TTL = 60
+# 全文检索高亮的占位标记
+HL_OPEN, HL_CLOSE = "\x01", "\x02"
+_count_cache = {}
+_count_lock = threading.Lock()
+
+def encode_cursor(date_created, rowid):
+    return base64.urlsafe_b64encode(f"{date_created}|{rowid}".encode()).decode()
+
+def decode_cursor(cursor):
+    date_created, rowid = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+    return date_created, int(rowid)
+
+def get_history_total(source, where_sql, params):
+    """
+    按过滤条件缓存总条数
+    source: plugin=插件原表 COUNT(*) / rollup=月汇总表求和 (无关键词时) / fts=全文索引计数
+    """
+    cache_key = (source, where_sql, tuple(params))
+    now = time.time()
+    with _count_lock:
+        hit = _count_cache.get(cache_key)
+        if hit and now - hit[1] < HISTORY_COUNT_TTL: return hit[0]
+
+    if source == "rollup":
+        # 无关键词时条件只涉及 UserId，直接用月汇总表求和 (最多落后一个同步周期)
+        res = query_sidecar(f"SELECT SUM(Plays) as c FROM rollup_user_monthly{where_sql}", params)
+    elif source == "fts":
+        res = query_sidecar(f"SELECT COUNT(*) as c FROM history_fts{where_sql}", params)
+    else:
+        res = query_db(f"SELECT COUNT(*) as c FROM PlaybackActivity{where_sql}", params)
+    total = (res[0]['c'] or 0) if res else 0
+
+    with _count_lock:
+        if len(_count_cache) > 256: _count_cache.clear()
+        _count_cache[cache_key] = (total, now)
+    return total
+
+def render_highlight(marked):
+    # highlight() 用控制字符标记命中位置，先整体转义再换成 <mark>，避免标题里的 HTML 被执行
+    return html.escape(marked).replace(HL_OPEN, "<mark>").replace(HL_CLOSE, "</mark>")
 
 @router.get("/api/history/list")
+@with_user_directory
+@db_handler
 def api_get_history(
     page: int = 1, 
     limit: int = 20, 
     user_id: Optional[str] = None, 
-    keyword: Optional[str] = None
+    keyword: Optional[str] = None,
+    cursor: Optional[str] = None,
+    sort: str = 'time'
 ):
+    """
+    播放历史
+    - 传 cursor 时使用游标翻页 (按 DateCreated, rowid 定位)，深页与首页代价相同
+    - 不传 cursor 时保持原有 page/offset 模式
+    - 有关键词时走 FTS5 全文索引，返回 HighlightName；sort=relevance 按相关度排序 (仅 page 模式)
+    两种翻页模式都会返回 next_cursor
+    """
     try:
-        # 1. 构建查询条件
+        # 1. 构建查询条件 (用户条件在插件表与索引表上通用)
         where_clauses = []
         params = []
         
@@ -44,35 +89,83 @@ def api_get_history(
         if user_id and user_id != 'all':
             where_clauses.append("UserId = ?")
             params.append(user_id)
-            
-        if keyword:
+        
+        use_index = history_index.can_search(keyword)
+        if use_index:
+            where_clauses.insert(0, "history_fts MATCH ?")
+            params.insert(0, history_index.match_expr(keyword))
+            source = "fts"
+        elif keyword:
             where_clauses.append("ItemName LIKE ?")
             params.append(f"%{keyword}%")
+            source = "plugin"
+        else:
+            source = "rollup" if rollup_service.ready else "plugin"
 
         where_sql = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
 
-        # 2. 获取总条数
-        count_sql = f"SELECT COUNT(*) as c FROM PlaybackActivity{where_sql}"
-        count_res = query_db(count_sql, params)
-        total = count_res[0]['c'] if count_res else 0
+        # 2. 获取总条数 (按过滤条件缓存)
+        total = get_history_total(source, where_sql, params)
         total_pages = math.ceil(total / limit)
 
-        # 3. 获取分页数据
-        offset = (page - 1) * limit
+        # 3. 获取分页数据 (多取一条用于判断是否还有下一页)
+        by_relevance = use_index and sort == 'relevance'
+        page_clauses = list(where_clauses)
+        page_params = list(params)
+        offset = 0
+        if cursor and not by_relevance:
+            last_date, last_rowid = decode_cursor(cursor)
+            page_clauses.append("(DateCreated < ? OR (DateCreated = ? AND rowid < ?))")
+            page_params.extend([last_date, last_date, last_rowid])
+        else:
+            offset = (page - 1) * limit
+        page_sql = " WHERE " + " AND ".join(page_clauses) if page_clauses else ""
+        page_params.extend([limit + 1, offset])
         
-        # 🔥 核心修复：移除了 IpAddress 字段，防止报错
-        data_sql = f"""
-            SELECT DateCreated, UserId, ItemId, ItemName, ItemType, PlayDuration, DeviceName, ClientName
-            FROM PlaybackActivity
-            {where_sql}
-            ORDER BY DateCreated DESC 
-            LIMIT ? OFFSET ?
-        """
-        params.extend([limit, offset])
-        rows = query_db(data_sql, params)
+        if use_index:
+            order_sql = "rank" if by_relevance else "DateCreated DESC, rowid DESC"
+            hits = query_sidecar(f"""
+                SELECT rowid as RowId, DateCreated, highlight(history_fts, 0, '{HL_OPEN}', '{HL_CLOSE}') as Marked
+                FROM history_fts
+                {page_sql}
+                ORDER BY {order_sql}
+                LIMIT ? OFFSET ?
+            """, page_params) or []
+            has_more = len(hits) > limit
+            hits = hits[:limit]
+            # 按 rowid 回插件表取完整记录 (走 rowid 主键，不扫表)
+            full = {}
+            if hits:
+                placeholders = ','.join(['?'] * len(hits))
+                full_rows = query_db(f"""
+                    SELECT rowid as RowId, DateCreated, UserId, ItemId, ItemName, ItemType, PlayDuration, DeviceName, ClientName
+                    FROM PlaybackActivity WHERE rowid IN ({placeholders})
+                """, [h['RowId'] for h in hits]) or []
+                full = {r['RowId']: dict(r) for r in full_rows}
+            rows = []
+            for h in hits:
+                row = full.get(h['RowId'])
+                if not row: continue
+                row['HighlightName'] = render_highlight(h['Marked'])
+                rows.append(row)
+        else:
+            # 🔥 核心修复：移除了 IpAddress 字段，防止报错
+            data_sql = f"""
+                SELECT rowid as RowId, DateCreated, UserId, ItemId, ItemName, ItemType, PlayDuration, DeviceName, ClientName
+                FROM PlaybackActivity
+                {page_sql}
+                ORDER BY DateCreated DESC, rowid DESC
+                LIMIT ? OFFSET ?
+            """
+            rows = query_db(data_sql, page_params) or []
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        next_cursor = None
+        if has_more and rows and not by_relevance:
+            next_cursor = encode_cursor(rows[-1]['DateCreated'], rows[-1]['RowId'])
 
         # 4. 数据格式化
-        user_map = get_user_map_local()
+        user_map = user_directory.get_user_map()
         result = []
         for row in rows:
             item = dict(row)
@@ -102,7 +195,8 @@ def api_get_history(
                 "page": page,
                 "limit": limit,
                 "total": total,
-                "total_pages": total_pages
+                "total_pages": total_pages,
+                "next_cursor": next_cursor
             }
         }
     except Exception as e:
@@ -1,63 +1,53 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from typing import Optional
 from app.core.config import cfg
-from app.core.database import query_db, get_base_filter
-import requests
+from app.core.database import query_db, query_sidecar, get_base_filter, run_db, db_handler
+from app.services.rollup_service import rollup_service
+from app.services.user_directory import user_directory, with_user_directory
+from app.services.session_service import session_monitor
+from app.services.playback_events import playback_store
+from app.core.emby import emby
 
 router = APIRouter()
 
-# --- 内部工具函数：获取第一个有效用户的ID (优先管理员) ---
-def get_admin_user_id():
-    key = cfg.get("emby_api_key")
-    host = cfg.get("emby_host")
-    if key and host:
-        try:
-            # 获取用户列表
-            res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=5)
-            if res.status_code == 200:
-                users = res.json()
-                # 优先找管理员
-                for u in users:
-                    if u.get("Policy", {}).get("IsAdministrator"):
-                        return u['Id']
-                # 没有管理员则返回第一个用户
-                if users:
-                    return users[0]['Id']
-        except: 
-            pass
-    return None
+def _dashboard_totals(user_id):
+    """仪表盘的播放总数/活跃人数/总时长 (纯数据库，在 db_executor 里执行)"""
+    where, params = get_base_filter(user_id)
+    if rollup_service.ready:
+        # 🔥 走旁路汇总表，不再全表扫描插件库
+        totals = query_sidecar(f"SELECT SUM(Plays) as p, SUM(PlayDuration) as d FROM rollup_user_monthly {where}", params)[0]
+        plays = totals['p'] or 0
+        dur = totals['d'] or 0
+        users = query_sidecar(f"SELECT COUNT(DISTINCT UserId) as c FROM rollup_user_daily {where} AND Day >= date('now', '-30 days')", params)[0]['c']
+    else:
+        plays = query_db(f"SELECT COUNT(*) as c FROM PlaybackActivity {where}", params)[0]['c']
+        users = query_db(f"SELECT COUNT(DISTINCT UserId) as c FROM PlaybackActivity {where} AND DateCreated > date('now', '-30 days')", params)[0]['c']
+        dur = query_db(f"SELECT SUM(PlayDuration) as c FROM PlaybackActivity {where}", params)[0]['c'] or 0
 
-# --- 内部工具：获取用户映射 ---
-def get_user_map_local():
-    user_map = {}
-    key = cfg.get("emby_api_key")
-    host = cfg.get("emby_host")
-    if key and host:
-        try:
-            res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=2)
-            if res.status_code == 200:
-                for u in res.json(): 
-                    user_map[u['Id']] = u['Name']
-        except: 
-            pass
-    return user_map
+    # 🔥 并入插件还没落库的播放 (Webhook 事件表)，今天的数字是实时的
+    live = playback_store.get_live_plays(user_id)
+    if live:
+        plays += len(live)
+        dur += sum(p['PlayDuration'] for p in live)
+        live_users = list({p['UserId'] for p in live})
+        placeholders = ','.join(['?'] * len(live_users))
+        if rollup_service.ready:
+            seen = query_sidecar(f"SELECT DISTINCT UserId FROM rollup_user_daily WHERE Day >= date('now', '-30 days') AND UserId IN ({placeholders})", live_users)
+        else:
+            seen = query_db(f"SELECT DISTINCT UserId FROM PlaybackActivity WHERE DateCreated > date('now', '-30 days') AND UserId IN ({placeholders})", live_users)
+        users += len(set(live_users) - {r['UserId'] for r in (seen or [])})
+    
+    return {"total_plays": plays, "active_users": users, "total_duration": dur}
 
 @router.get("/api/stats/dashboard")
-def api_dashboard(user_id: Optional[str] = None):
+async def api_dashboard(user_id: Optional[str] = None):
     try:
-        where, params = get_base_filter(user_id)
-        plays = query_db(f"SELECT COUNT(*) as c FROM PlaybackActivity {where}", params)[0]['c']
-        users = query_db(f"SELECT COUNT(DISTINCT UserId) as c FROM PlaybackActivity {where} AND DateCreated > date('now', '-30 days')", params)[0]['c']
-        dur = query_db(f"SELECT SUM(PlayDuration) as c FROM PlaybackActivity {where}", params)[0]['c'] or 0
-        
-        base = {"total_plays": plays, "active_users": users, "total_duration": dur}
+        base = await run_db(_dashboard_totals, user_id)
         lib = {"movie": 0, "series": 0, "episode": 0}
         
-        key = cfg.get("emby_api_key")
-        host = cfg.get("emby_host")
-        if key and host:
+        if emby.is_configured():
             try:
-                res = requests.get(f"{host}/emby/Items/Counts?api_key={key}", timeout=5)
+                res = await emby.aget("/emby/Items/Counts", timeout=5)
                 if res.status_code == 200:
                     d = res.json()
                     lib = {
@@ -75,17 +65,15 @@ def api_dashboard(user_id: Optional[str] = None):
 
 # 🔥 新增接口：获取媒体库列表 (Views)
 @router.get("/api/stats/libraries")
-def api_get_libraries():
-    key = cfg.get("emby_api_key")
-    host = cfg.get("emby_host")
-    if not key or not host: return {"status": "error", "data": []}
+async def api_get_libraries():
+    if not emby.is_configured(): return {"status": "error", "data": []}
     
     try:
-        user_id = get_admin_user_id()
+        await user_directory.ensure_async()
+        user_id = user_directory.get_admin_id()
         if not user_id: return {"status": "error", "data": []}
         
-        url = f"{host}/emby/Users/{user_id}/Views?api_key={key}"
-        res = requests.get(url, timeout=10)
+        res = await emby.aget(f"/emby/Users/{user_id}/Views", timeout=10)
         
         if res.status_code == 200:
             items = res.json().get("Items", [])
@@ -104,16 +92,21 @@ def api_get_libraries():
     return {"status": "error", "data": []}
 
 @router.get("/api/stats/recent")
+@with_user_directory
+@db_handler
 def api_recent_activity(user_id: Optional[str] = None):
     try:
         where, params = get_base_filter(user_id)
         # 获取最近 50 条，前端只显示前 10 条
-        results = query_db(f"SELECT DateCreated, UserId, ItemId, ItemName, ItemType FROM PlaybackActivity {where} ORDER BY DateCreated DESC LIMIT 50", params)
+        results = query_db(f"SELECT DateCreated, UserId, ItemId, ItemName, ItemType FROM PlaybackActivity {where} ORDER BY DateCreated DESC LIMIT 50", params) or []
+        # 🔥 插件还没落库的播放排在最前 (InProgress 表示正在播放)
+        live = [{k: p[k] for k in ("DateCreated", "UserId", "ItemId", "ItemName", "ItemType", "InProgress")} for p in playback_store.get_live_plays(user_id)]
+        results = (live + [dict(r) for r in results])[:50]
         
         if not results: 
             return {"status": "success", "data": []}
             
-        user_map = get_user_map_local()
+        user_map = user_directory.get_user_map()
         data = []
         for row in results:
             item = dict(row)
@@ -128,29 +121,27 @@ def api_recent_activity(user_id: Optional[str] = None):
 
 # 🔥 核心接口：获取最近入库 (使用 Users/Latest)
 @router.get("/api/stats/latest")
-def api_latest_media(limit: int = 10):
-    key = cfg.get("emby_api_key")
-    host = cfg.get("emby_host")
-    if not key or not host: return {"status": "error", "data": []}
+async def api_latest_media(limit: int = 10):
+    if not emby.is_configured(): return {"status": "error", "data": []}
     
     try:
         # 1. 获取执行查询的用户身份
-        user_id = get_admin_user_id()
+        await user_directory.ensure_async()
+        user_id = user_directory.get_admin_id()
         if not user_id:
             return {"status": "error", "data": []}
 
         # 2. 构造 Emby 官方推荐的 Latest 接口
-        url = f"{host}/emby/Users/{user_id}/Items/Latest"
+        path = f"/emby/Users/{user_id}/Items/Latest"
         
         # 3. 参数配置
         params = {
             "Limit": 30,             # 多取一点用于过滤
             "MediaTypes": "Video",   # 只看视频
-            "Fields": "ProductionYear,CommunityRating,Path",
-            "api_key": key
+            "Fields": "ProductionYear,CommunityRating,Path"
         }
         
-        res = requests.get(url, params=params, timeout=15)
+        res = await emby.aget(path, params=params, timeout=15)
         
         if res.status_code == 200:
             raw_items = res.json()
@@ -183,16 +174,17 @@ def api_latest_media(limit: int = 10):
 # 🔥 核心修复：路径改为 /api/stats/live 以匹配前端请求
 @router.get("/api/stats/live")
 def api_live_sessions():
-    key = cfg.get("emby_api_key")
-    host = cfg.get("emby_host")
-    if not key: return {"status": "error"}
-    try:
-        res = requests.get(f"{host}/emby/Sessions?api_key={key}", timeout=5)
-        if res.status_code == 200: 
-            return {"status": "success", "data": [s for s in res.json() if s.get("NowPlayingItem")]}
-    except Exception as e:
-        print(f"❌ Live Sessions Error: {e}") # 增加报错打印，方便调试
-    return {"status": "success", "data": []}
+    if not cfg.get("emby_api_key"): return {"status": "error"}
+    # 读共享轮询器的快照，不再每次请求都访问 Emby
+    return {"status": "success", "data": session_monitor.get_sessions()}
+
+@router.get("/api/stats/live/stream")
+async def api_live_stream(request: Request):
+    """
+    正在播放的 SSE 推送
+    连接后先收到 snapshot (全量)，之后是 started / stopped / progress 增量事件
+    """
+    return session_monitor.feed.response(request)
 
 # 保留旧接口做兼容
 @router.get("/api/live")
@@ -200,42 +192,45 @@ def api_live_sessions_legacy():
     return api_live_sessions()
 
 @router.get("/api/stats/top_movies")
+@db_handler
 def api_top_movies(user_id: Optional[str] = None, category: str = 'all', sort_by: str = 'count'):
     try:
         where, params = get_base_filter(user_id)
         if category == 'Movie': where += " AND ItemType = 'Movie'"
         elif category == 'Episode': where += " AND ItemType = 'Episode'"
+        order = "TotalTime" if sort_by == 'time' else "PlayCount"
         
-        sql = f"SELECT ItemName, ItemId, ItemType, PlayDuration FROM PlaybackActivity {where} LIMIT 5000"
-        rows = query_db(sql, params)
+        # 🔥 剧名归一化、分组、排序、Top 50 截断全部在 SQL 内完成 (clean_name 为注册的 SQLite 函数)
+        # MAX() 使裸列 ItemId 取自最近一次播放的那一行
+        if rollup_service.ready:
+            sql = f"SELECT clean_name(ItemName) as ItemName, ItemId, SUM(Plays) as PlayCount, SUM(PlayDuration) as TotalTime, MAX(Month) as Latest FROM rollup_item_monthly {where} GROUP BY 1 ORDER BY {order} DESC LIMIT 50"
+            rows = query_sidecar(sql, params)
+        else:
+            sql = f"SELECT clean_name(ItemName) as ItemName, ItemId, COUNT(*) as PlayCount, SUM(PlayDuration) as TotalTime, MAX(DateCreated) as Latest FROM PlaybackActivity {where} GROUP BY 1 ORDER BY {order} DESC LIMIT 50"
+            rows = query_db(sql, params)
         
-        aggregated = {}
-        for row in rows:
-            clean = row['ItemName'].split(' - ')[0]
-            if clean not in aggregated: 
-                aggregated[clean] = {'ItemName': clean, 'ItemId': row['ItemId'], 'PlayCount': 0, 'TotalTime': 0}
-            aggregated[clean]['PlayCount'] += 1
-            aggregated[clean]['TotalTime'] += (row['PlayDuration'] or 0)
-            aggregated[clean]['ItemId'] = row['ItemId']
-            
-        res = list(aggregated.values())
-        res.sort(key=lambda x: x['TotalTime'] if sort_by == 'time' else x['PlayCount'], reverse=True)
-        return {"status": "success", "data": res[:50]}
+        res = [{'ItemName': r['ItemName'], 'ItemId': r['ItemId'], 'PlayCount': r['PlayCount'], 'TotalTime': r['TotalTime'] or 0} for r in rows]
+        return {"status": "success", "data": res}
     except: return {"status": "error", "data": []}
 
 @router.get("/api/stats/user_details")
+@with_user_directory
+@db_handler
 def api_user_details(user_id: Optional[str] = None):
     try:
         where, params = get_base_filter(user_id)
-        h_res = query_db(f"SELECT strftime('%H', DateCreated) as Hour, COUNT(*) as Plays FROM PlaybackActivity {where} GROUP BY Hour", params)
+        if rollup_service.ready:
+            h_res = query_sidecar(f"SELECT substr(Hour, 12, 2) as Hour, SUM(Plays) as Plays FROM rollup_user_hourly {where} GROUP BY 1", params)
+            d_res = query_sidecar(f"SELECT Device, SUM(Plays) as Plays FROM rollup_device_monthly {where} GROUP BY Device ORDER BY Plays DESC LIMIT 10", params)
+        else:
+            h_res = query_db(f"SELECT strftime('%H', DateCreated) as Hour, COUNT(*) as Plays FROM PlaybackActivity {where} GROUP BY Hour", params)
+            d_res = query_db(f"SELECT COALESCE(DeviceName, ClientName, 'Unknown') as Device, COUNT(*) as Plays FROM PlaybackActivity {where} GROUP BY Device ORDER BY Plays DESC LIMIT 10", params)
         h_data = {str(i).zfill(2): 0 for i in range(24)}
         if h_res:
             for r in h_res: h_data[r['Hour']] = r['Plays']
-            
-        d_res = query_db(f"SELECT COALESCE(DeviceName, ClientName, 'Unknown') as Device, COUNT(*) as Plays FROM PlaybackActivity {where} GROUP BY Device ORDER BY Plays DESC LIMIT 10", params)
         
         l_res = query_db(f"SELECT DateCreated, ItemName, PlayDuration, COALESCE(DeviceName, ClientName) as Device, UserId FROM PlaybackActivity {where} ORDER BY DateCreated DESC LIMIT 100", params)
-        u_map = get_user_map_local()
+        u_map = user_directory.get_user_map()
         logs = []
         if l_res:
             for r in l_res: 
@@ -249,17 +244,21 @@ def api_user_details(user_id: Optional[str] = None):
 
 @router.get("/api/stats/chart")
 @router.get("/api/stats/trend")
+@db_handler
 def api_chart_stats(user_id: Optional[str] = None, dimension: str = 'day'):
     try:
         where, params = get_base_filter(user_id)
-        if dimension == 'week':
-            sql = f"SELECT strftime('%Y-%W', DateCreated) as Label, SUM(PlayDuration) as Duration FROM PlaybackActivity {where} AND DateCreated > date('now', '-120 days') GROUP BY Label ORDER BY Label"
-        elif dimension == 'month':
-            sql = f"SELECT strftime('%Y-%m', DateCreated) as Label, SUM(PlayDuration) as Duration FROM PlaybackActivity {where} AND DateCreated > date('now', '-365 days') GROUP BY Label ORDER BY Label"
-        else:
-            sql = f"SELECT date(DateCreated) as Label, SUM(PlayDuration) as Duration FROM PlaybackActivity {where} AND DateCreated > date('now', '-30 days') GROUP BY Label ORDER BY Label"
+        if dimension == 'week': label, days = "strftime('%Y-%W', {col})", 120
+        elif dimension == 'month': label, days = "strftime('%Y-%m', {col})", 365
+        else: label, days = "date({col})", 30
 
-        results = query_db(sql, params)
+        if rollup_service.ready:
+            # 日汇总表按天一行，Day >= 起始日 与原先 DateCreated > 起始日 0 点等价
+            sql = f"SELECT {label.format(col='Day')} as Label, SUM(PlayDuration) as Duration FROM rollup_user_daily {where} AND Day >= date('now', '-{days} days') GROUP BY Label ORDER BY Label"
+            results = query_sidecar(sql, params)
+        else:
+            sql = f"SELECT {label.format(col='DateCreated')} as Label, SUM(PlayDuration) as Duration FROM PlaybackActivity {where} AND DateCreated > date('now', '-{days} days') GROUP BY Label ORDER BY Label"
+            results = query_db(sql, params)
         data = {}
         if results:
             for r in results: data[r['Label']] = int(r['Duration'])
@@ -267,34 +266,47 @@ def api_chart_stats(user_id: Optional[str] = None, dimension: str = 'day'):
     except Exception as e: 
         return {"status": "error", "data": {}}
 
+# 海报周期过滤: 周期 -> (插件原表过滤, 日汇总表过滤)
+POSTER_PERIOD_FILTERS = {
+    'week': (" AND DateCreated > date('now', '-7 days')", " AND Day >= date('now', '-7 days')"),
+    'month': (" AND DateCreated > date('now', '-30 days')", " AND Day >= date('now', '-30 days')"),
+}
+
 @router.get("/api/stats/poster_data")
+@db_handler
 def api_poster_data(user_id: Optional[str] = None, period: str = 'all'):
     try:
         where_base, params = get_base_filter(user_id)
-        date_filter = ""
-        if period == 'week': date_filter = " AND DateCreated > date('now', '-7 days')"
-        elif period == 'month': date_filter = " AND DateCreated > date('now', '-30 days')"
-        server_res = query_db(f"SELECT COUNT(*) as Plays FROM PlaybackActivity {get_base_filter('all')[0]} {date_filter}", get_base_filter('all')[1])
-        server_plays = server_res[0]['Plays'] if server_res else 0
-        raw_sql = f"SELECT ItemName, ItemId, ItemType, PlayDuration FROM PlaybackActivity {where_base + date_filter}"
-        rows = query_db(raw_sql, params)
-        total_plays = 0; total_duration = 0; aggregated = {} 
-        if rows:
-            for row in rows:
-                total_plays += 1; dur = row['PlayDuration'] or 0; total_duration += dur; clean = row['ItemName'].split(' - ')[0]
-                if clean not in aggregated: aggregated[clean] = {'ItemName': clean, 'ItemId': row['ItemId'], 'Count': 0, 'Duration': 0}
-                aggregated[clean]['Count'] += 1; aggregated[clean]['Duration'] += dur; aggregated[clean]['ItemId'] = row['ItemId'] 
-        top_list = list(aggregated.values()); top_list.sort(key=lambda x: x['Count'], reverse=True)
-        return {"status": "success", "data": {"plays": total_plays, "hours": round(total_duration / 3600), "server_plays": server_plays, "top_list": top_list[:10], "tags": ["观影达人"]}}
+        server_where, server_params = get_base_filter('all')
+        raw_filter, rollup_filter = POSTER_PERIOD_FILTERS.get(period, ("", ""))
+        
+        if rollup_service.ready:
+            if rollup_filter: user_table, item_table, bucket = "rollup_user_daily", "rollup_item_daily", "Day"
+            else: user_table, item_table, bucket = "rollup_user_monthly", "rollup_item_monthly", "Month"
+            server_res = query_sidecar(f"SELECT SUM(Plays) as Plays FROM {user_table} {server_where}{rollup_filter}", server_params)
+            totals = query_sidecar(f"SELECT SUM(Plays) as Plays, SUM(PlayDuration) as Duration FROM {user_table} {where_base}{rollup_filter}", params)
+            top_rows = query_sidecar(f"SELECT clean_name(ItemName) as ItemName, ItemId, SUM(Plays) as Count, SUM(PlayDuration) as Duration, MAX({bucket}) as Latest FROM {item_table} {where_base}{rollup_filter} GROUP BY 1 ORDER BY Count DESC LIMIT 10", params)
+        else:
+            server_res = query_db(f"SELECT COUNT(*) as Plays FROM PlaybackActivity {server_where}{raw_filter}", server_params)
+            totals = query_db(f"SELECT COUNT(*) as Plays, SUM(PlayDuration) as Duration FROM PlaybackActivity {where_base}{raw_filter}", params)
+            top_rows = query_db(f"SELECT clean_name(ItemName) as ItemName, ItemId, COUNT(*) as Count, SUM(PlayDuration) as Duration, MAX(DateCreated) as Latest FROM PlaybackActivity {where_base}{raw_filter} GROUP BY 1 ORDER BY Count DESC LIMIT 10", params)
+        
+        server_plays = (server_res[0]['Plays'] or 0) if server_res else 0
+        total_plays = (totals[0]['Plays'] or 0) if totals else 0
+        total_duration = (totals[0]['Duration'] or 0) if totals else 0
+        top_list = [{'ItemName': r['ItemName'], 'ItemId': r['ItemId'], 'Count': r['Count'], 'Duration': r['Duration'] or 0} for r in top_rows] if top_rows else []
+        return {"status": "success", "data": {"plays": total_plays, "hours": round(total_duration / 3600), "server_plays": server_plays, "top_list": top_list, "tags": ["观影达人"]}}
     except: return {"status": "error", "data": {"plays": 0, "hours": 0}}
 
 @router.get("/api/stats/top_users_list")
+@with_user_directory
+@db_handler
 def api_top_users_list():
     try:
         res = query_db("SELECT UserId, COUNT(*) as Plays, SUM(PlayDuration) as TotalTime FROM PlaybackActivity GROUP BY UserId ORDER BY TotalTime DESC LIMIT 10")
         if not res: return {"status": "success", "data": []}
-        user_map = get_user_map_local()
-        hidden = cfg.get("hidden_users") or []
+        user_map = user_directory.get_user_map()
+        hidden = user_directory.get_hidden()
         data = []
         for row in res:
             if row['UserId'] in hidden: continue
@@ -307,6 +319,7 @@ def api_top_users_list():
         return {"status": "success", "data": []}
 
 @router.get("/api/stats/badges")
+@db_handler
 def api_badges(user_id: Optional[str] = None):
     try:
         where, params = get_base_filter(user_id); badges = []
@@ -320,12 +333,19 @@ def api_badges(user_id: Optional[str] = None):
     except: return {"status": "success", "data": []}
 
 @router.get("/api/stats/monthly_stats")
+@db_handler
 def api_monthly_stats(user_id: Optional[str] = None):
     try:
         where_base, params = get_base_filter(user_id)
-        where = where_base + " AND DateCreated > date('now', '-12 months')"
-        sql = f"SELECT strftime('%Y-%m', DateCreated) as Month, SUM(PlayDuration) as Duration FROM PlaybackActivity {where} GROUP BY Month ORDER BY Month"
-        results = query_db(sql, params); data = {}
+        if rollup_service.ready:
+            where = where_base + " AND Day >= date('now', '-12 months')"
+            sql = f"SELECT substr(Day, 1, 7) as Month, SUM(PlayDuration) as Duration FROM rollup_user_daily {where} GROUP BY Month ORDER BY Month"
+            results = query_sidecar(sql, params)
+        else:
+            where = where_base + " AND DateCreated > date('now', '-12 months')"
+            sql = f"SELECT strftime('%Y-%m', DateCreated) as Month, SUM(PlayDuration) as Duration FROM PlaybackActivity {where} GROUP BY Month ORDER BY Month"
+            results = query_db(sql, params)
+        data = {}
         if results: 
             for r in results: data[r['Month']] = int(r['Duration'])
         return {"status": "success", "data": data}
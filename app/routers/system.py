@@ -1,7 +1,23 @@
 from fastapi import APIRouter, Request
 from app.schemas.models import SettingsModel
 from app.core.config import cfg, FALLBACK_IMAGE_URL, TMDB_FALLBACK_POOL
-import requests
+from app.core.database import get_pool_stats
+from app.core.emby import emby
+from app.core.tmdb import tmdb, TMDB_TTL_SHORT
+from app.services.rollup_service import rollup_service
+from app.services.search_index import history_index
+from app.services.image_cache import image_cache
+from app.services.image_resolver import image_resolver
+from app.services.quality_service import quality_service
+from app.services.session_service import session_monitor
+from app.services.task_monitor import task_monitor
+from app.services.webhook_queue import webhook_queue
+from app.services.playback_events import playback_store
+from app.services.telegram_outbox import tg_outbox
+from app.services.telegram_media import tg_file_ids
+from app.services.telegram_dispatch import tg_dispatcher
+from app.services.geoip import geoip
+from app.services.user_directory import user_directory
 import random
 
 router = APIRouter()
@@ -22,16 +38,37 @@ def api_save_settings(data: SettingsModel, request: Request):
     cfg.set("hidden_users", data.hidden_users)
     return {"status": "success"}
 
+# 🔥 运行指标 (连接池等)，用于容量评估
+@router.get("/api/system/metrics")
+def api_get_metrics(request: Request):
+    if not request.session.get("user"): return {"status": "error"}
+    return {"status": "success", "data": {
+        "db_pool": get_pool_stats(),
+        "rollup": rollup_service.get_status(),
+        "search_index": history_index.get_status(),
+        "user_directory": user_directory.get_stats(),
+        "emby": emby.get_stats(),
+        "image_cache": image_cache.get_stats(),
+        "image_resolver": image_resolver.get_stats(),
+        "quality_index": quality_service.get_status(),
+        "tmdb": tmdb.get_stats(),
+        "live_sessions": session_monitor.get_stats(),
+        "tasks": task_monitor.get_stats(),
+        "webhook_queue": webhook_queue.get_stats(),
+        "playback_events": playback_store.get_stats(),
+        "telegram_outbox": tg_outbox.get_stats(),
+        "telegram_file_ids": tg_file_ids.get_stats(),
+        "geoip": geoip.get_stats(),
+        "telegram_commands": tg_dispatcher.get_stats(),
+    }}
+
 @router.get("/api/wallpaper")
 def api_get_wallpaper():
-    tmdb_key = cfg.get("tmdb_api_key"); proxy = cfg.get("proxy_url")
-    proxies = {"http": proxy, "https": proxy} if proxy else None
-    if tmdb_key:
+    if cfg.get("tmdb_api_key"):
         try:
-            url = f"https://api.themoviedb.org/3/trending/all/week?api_key={tmdb_key}&language=zh-CN"
-            res = requests.get(url, timeout=8, proxies=proxies)
-            if res.status_code == 200:
-                data = res.json()
+            # 趋势榜走 TMDB 缓存，登录页不再每次都请求外网
+            data = tmdb.get("/trending/all/week", {"language": "zh-CN"}, ttl=TMDB_TTL_SHORT, timeout=8)
+            if data:
                 results = [i for i in data.get("results", []) if i.get("backdrop_path")]
                 if results:
                     target = random.choice(results)
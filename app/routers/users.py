@@ -1,21 +1,22 @@
 from fastapi import APIRouter, Request, Response
 from app.schemas.models import UserUpdateModel, NewUserModel, InviteGenModel
 from app.core.config import cfg
-from app.core.database import query_db
-import requests
+from app.core.database import query_db, run_db, db_handler
+from app.services.user_directory import user_directory
+from app.core.emby import emby
+from app.services.image_cache import image_cache
 import datetime
 import secrets
 
 router = APIRouter()
 
 # 🔥 自动检查过期用户并禁用 (保留功能)
-def check_expired_users():
+async def check_expired_users():
     try:
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-        if not key or not host: return
+        if not emby.is_configured(): return
         
         # 1. 查出所有设置了过期时间的用户
-        rows = query_db("SELECT user_id, expire_date FROM users_meta WHERE expire_date IS NOT NULL")
+        rows = await run_db(query_db, "SELECT user_id, expire_date FROM users_meta WHERE expire_date IS NOT NULL")
         if not rows: return
         
         now_str = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -24,7 +25,7 @@ def check_expired_users():
             if row['expire_date'] < now_str: # 已过期
                 uid = row['user_id']
                 try:
-                    u_res = requests.get(f"{host}/emby/Users/{uid}?api_key={key}", timeout=5)
+                    u_res = await emby.aget(f"/emby/Users/{uid}", timeout=5)
                     if u_res.status_code == 200:
                         user = u_res.json()
                         policy = user.get('Policy', {})
@@ -32,34 +33,36 @@ def check_expired_users():
                         if not policy.get('IsDisabled', False):
                             print(f"🚫 Auto-Disabling Expired User: {user.get('Name')} (Expire: {row['expire_date']})")
                             policy['IsDisabled'] = True
-                            requests.post(f"{host}/emby/Users/{uid}/Policy?api_key={key}", json=policy)
+                            await emby.apost(f"/emby/Users/{uid}/Policy", json=policy)
                 except: pass
     except Exception as e:
         print(f"Check Expire Error: {e}")
 
 @router.get("/api/manage/users")
-def api_manage_users(request: Request):
+async def api_manage_users(request: Request):
     """
     获取用户列表及元数据
     """
     if not request.session.get("user"): return {"status": "error"}
     
     # 每次获取列表时，顺手检查一下过期状态
-    check_expired_users()
+    await check_expired_users()
     
-    key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
+    host = cfg.get("emby_host")
     
     # 🔥 获取公开地址，用于前端显示头像
     public_host = cfg.get("emby_public_host") or host
     if public_host.endswith('/'): public_host = public_host[:-1]
     
     try:
-        res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=5)
+        res = await emby.aget("/emby/Users", timeout=5)
         if res.status_code != 200: return {"status": "error", "message": "Emby API Error"}
         emby_users = res.json()
+        # 顺手回填共享用户目录，省掉其他页面的一次 /Users 请求
+        user_directory.update(emby_users)
         
         # 获取本地数据库中的扩展信息（过期时间、备注）
-        meta_rows = query_db("SELECT * FROM users_meta")
+        meta_rows = await run_db(query_db, "SELECT * FROM users_meta")
         meta_map = {r['user_id']: dict(r) for r in meta_rows} if meta_rows else {}
         
         final_list = []
@@ -87,25 +90,28 @@ def api_manage_users(request: Request):
 
 # 🔥 新增：用户头像代理接口 (解决头像裂开问题)
 @router.get("/api/user/image/{user_id}")
-def get_user_avatar(user_id: str):
-    key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-    if not key or not host: return Response(status_code=404)
+async def get_user_avatar(user_id: str, request: Request):
+    if not emby.is_configured(): return Response(status_code=404)
+    cache_key = image_cache.make_key("user", user_id, "full")
+    entry = await run_db(image_cache.get, cache_key)
+    if entry: return image_cache.respond(entry, request)
     
     try:
         # 尝试获取用户头像
-        img_url = f"{host}/emby/Users/{user_id}/Images/Primary?api_key={key}&quality=90"
-        res = requests.get(img_url, timeout=5)
+        res = await emby.aget(f"/emby/Users/{user_id}/Images/Primary", params={"quality": 90}, timeout=5, stream=True)
         
         if res.status_code == 200:
-            return Response(content=res.content, media_type="image/jpeg")
-        else:
-            # 如果没有头像，返回 404，前端会显示默认圆圈
-            return Response(status_code=404)
+            entry = await image_cache.aput(cache_key, res)
+            if entry: return image_cache.respond(entry, request)
+        else: await res.aclose()
+        # 如果没有头像，返回 404，前端会显示默认圆圈
+        return Response(status_code=404)
     except:
         return Response(status_code=404)
 
 # 生成邀请码接口 (保留功能)
 @router.post("/api/manage/invite/gen")
+@db_handler
 def api_gen_invite(data: InviteGenModel, request: Request):
     if not request.session.get("user"): return {"status": "error"}
     try:
@@ -120,12 +126,11 @@ def api_gen_invite(data: InviteGenModel, request: Request):
     except Exception as e: return {"status": "error", "message": str(e)}
 
 @router.post("/api/manage/user/update")
-def api_manage_user_update(data: UserUpdateModel, request: Request):
+async def api_manage_user_update(data: UserUpdateModel, request: Request):
     """
     更新用户：支持修改 密码、停用状态、过期时间
     """
     if not request.session.get("user"): return {"status": "error"}
-    key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
     print(f"📝 Update User Request: {data.user_id}")
     
     try:
@@ -134,22 +139,22 @@ def api_manage_user_update(data: UserUpdateModel, request: Request):
             # 如果传的是空字符串，转为 None 存入数据库（表示永久）
             expire_val = data.expire_date if data.expire_date else None
             
-            exist = query_db("SELECT 1 FROM users_meta WHERE user_id = ?", (data.user_id,), one=True)
-            if exist: query_db("UPDATE users_meta SET expire_date = ? WHERE user_id = ?", (expire_val, data.user_id))
-            else: query_db("INSERT INTO users_meta (user_id, expire_date, created_at) VALUES (?, ?, ?)", (data.user_id, expire_val, datetime.datetime.now().isoformat()))
+            exist = await run_db(query_db, "SELECT 1 FROM users_meta WHERE user_id = ?", (data.user_id,), one=True)
+            if exist: await run_db(query_db, "UPDATE users_meta SET expire_date = ? WHERE user_id = ?", (expire_val, data.user_id))
+            else: await run_db(query_db, "INSERT INTO users_meta (user_id, expire_date, created_at) VALUES (?, ?, ?)", (data.user_id, expire_val, datetime.datetime.now().isoformat()))
         
         # 2. 修改密码
         if data.password:
             print(f"🔐 Resetting Password for {data.user_id}")
-            pwd_res = requests.post(f"{host}/emby/Users/{data.user_id}/Password?api_key={key}", 
-                                  json={"Id": data.user_id, "NewPw": data.password})
+            pwd_res = await emby.apost(f"/emby/Users/{data.user_id}/Password", 
+                               json={"Id": data.user_id, "NewPw": data.password})
             if pwd_res.status_code not in [200, 204]:
                 return {"status": "error", "message": "密码修改失败，请检查日志"}
 
         # 3. 刷新策略 (处理 停用/启用)
         if data.is_disabled is not None:
             print(f"🔧 Updating Policy (IsDisabled={data.is_disabled})...")
-            p_res = requests.get(f"{host}/emby/Users/{data.user_id}?api_key={key}")
+            p_res = await emby.aget(f"/emby/Users/{data.user_id}")
             if p_res.status_code == 200:
                 policy = p_res.json().get('Policy', {})
                 policy['IsDisabled'] = data.is_disabled
@@ -157,9 +162,10 @@ def api_manage_user_update(data: UserUpdateModel, request: Request):
                 if not data.is_disabled:
                     policy['LoginAttemptsBeforeLockout'] = -1 
                 
-                r = requests.post(f"{host}/emby/Users/{data.user_id}/Policy?api_key={key}", json=policy)
+                r = await emby.apost(f"/emby/Users/{data.user_id}/Policy", json=policy)
                 if r.status_code != 204:
                     print(f"⚠️ Policy Update Warning: {r.status_code}")
+                user_directory.invalidate()
 
         return {"status": "success", "message": "用户信息已更新"}
     except Exception as e: 
@@ -167,59 +173,57 @@ def api_manage_user_update(data: UserUpdateModel, request: Request):
         return {"status": "error", "message": str(e)}
 
 @router.post("/api/manage/user/new")
-def api_manage_user_new(data: NewUserModel, request: Request):
+async def api_manage_user_new(data: NewUserModel, request: Request):
     """
     新建用户：创建用户 + 设置密码 + 初始化策略 + 设置过期时间
     """
     if not request.session.get("user"): return {"status": "error"}
-    key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
     print(f"📝 New User: {data.name}")
     try:
         # 1. 创建用户
-        res = requests.post(f"{host}/emby/Users/New?api_key={key}", json={"Name": data.name})
+        res = await emby.apost("/emby/Users/New", json={"Name": data.name})
         if res.status_code != 200: return {"status": "error", "message": f"创建失败: {res.text}"}
         new_id = res.json()['Id']
+        user_directory.invalidate()
         
         # 2. 设置密码 (如果提供了)
         if data.password:
-            requests.post(f"{host}/emby/Users/{new_id}/Password?api_key={key}", json={"Id": new_id, "NewPw": data.password})
+            await emby.apost(f"/emby/Users/{new_id}/Password", json={"Id": new_id, "NewPw": data.password})
         
         # 3. 立即初始化策略 (防止默认被禁用)
-        requests.post(f"{host}/emby/Users/{new_id}/Policy?api_key={key}", json={"IsDisabled": False, "LoginAttemptsBeforeLockout": -1})
+        await emby.apost(f"/emby/Users/{new_id}/Policy", json={"IsDisabled": False, "LoginAttemptsBeforeLockout": -1})
         
         # 4. 记录有效期
         if data.expire_date:
-            query_db("INSERT INTO users_meta (user_id, expire_date, created_at) VALUES (?, ?, ?)", (new_id, data.expire_date, datetime.datetime.now().isoformat()))
+            await run_db(query_db, "INSERT INTO users_meta (user_id, expire_date, created_at) VALUES (?, ?, ?)", (new_id, data.expire_date, datetime.datetime.now().isoformat()))
             
         return {"status": "success", "message": "用户创建成功"}
 
     except Exception as e: return {"status": "error", "message": str(e)}
 
 @router.delete("/api/manage/user/{user_id}")
-def api_manage_user_delete(user_id: str, request: Request):
+async def api_manage_user_delete(user_id: str, request: Request):
     if not request.session.get("user"): return {"status": "error"}
-    key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
     try:
-        res = requests.delete(f"{host}/emby/Users/{user_id}?api_key={key}")
+        res = await emby.adelete(f"/emby/Users/{user_id}")
         if res.status_code in [200, 204]:
-            query_db("DELETE FROM users_meta WHERE user_id = ?", (user_id,))
+            await run_db(query_db, "DELETE FROM users_meta WHERE user_id = ?", (user_id,))
+            user_directory.invalidate()
             return {"status": "success", "message": "用户已删除"}
         return {"status": "error", "message": "删除失败"}
     except Exception as e: return {"status": "error", "message": str(e)}
 
 @router.get("/api/users")
-def api_get_users():
+async def api_get_users():
     """
     简易用户列表 (用于下拉框等)
     """
-    key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
+    key = cfg.get("emby_api_key")
     if not key: return {"status": "error"}
     try:
-        res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=5)
-        if res.status_code == 200:
-            users = res.json(); hidden = cfg.get("hidden_users") or []; data = []
-            for u in users: data.append({"UserId": u['Id'], "UserName": u['Name'], "IsHidden": u['Id'] in hidden})
-            data.sort(key=lambda x: x['UserName'])
-            return {"status": "success", "data": data}
-        return {"status": "success", "data": []}
+        await user_directory.ensure_async()
+        users = user_directory.get_users(); hidden = user_directory.get_hidden(); data = []
+        for u in users: data.append({"UserId": u['Id'], "UserName": u['Name'], "IsHidden": u['Id'] in hidden})
+        data.sort(key=lambda x: x['UserName'])
+        return {"status": "success", "data": data}
     except Exception as e: return {"status": "error", "message": str(e)}
\ No newline at end of file
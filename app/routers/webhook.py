@@ -1,14 +1,27 @@
-from fastapi import APIRouter, Request, BackgroundTasks, HTTPException
+from fastapi import APIRouter, Request, HTTPException
 from app.services.bot_service import bot
+from app.services.user_directory import user_directory
+from app.services.quality_service import quality_service
+from app.services.webhook_queue import webhook_queue
+from app.services.playback_events import playback_store
 from app.core.config import cfg
+import hmac
 import json
 import logging
 
 logger = logging.getLogger("uvicorn")
 router = APIRouter()
 
+# 播放事件先写入本地事件表 (实时统计用)，再推送通知；查 IP、下载封面、调 Telegram 都在队列 worker 里做
+def _handle_playback(data, action):
+    playback_store.record(data, action)
+    bot.push_playback_event(data, action)
+
+webhook_queue.register("playback.start", lambda data: _handle_playback(data, "start"))
+webhook_queue.register("playback.stop", lambda data: _handle_playback(data, "stop"))
+
 @router.post("/api/v1/webhook")
-async def emby_webhook(request: Request, background_tasks: BackgroundTasks):
+async def emby_webhook(request: Request):
     query_token = request.query_params.get("token")
     if query_token != cfg.get("webhook_token"):
         raise HTTPException(status_code=403, detail="Invalid Token")
@@ -29,19 +42,41 @@ async def emby_webhook(request: Request, background_tasks: BackgroundTasks):
         if event: logger.info(f"🔔 Webhook: {event}")
 
         # 🔥 核心修改：入库通知不再直接推送，而是丢入缓冲队列进行聚合
+        accepted = True
         if event in ["library.new", "item.added"]:
             item = data.get("Item", {})
             if item.get("Id") and item.get("Type") in ["Movie", "Episode", "Series"]:
                 # 这一步非常快，不会阻塞 Webhook
-                bot.add_library_task(item)
+                accepted = bot.add_library_task(item)
+                # 唤醒质量索引的增量同步
+                quality_service.request_sync()
+
+        # 🔥 用户变动：后台刷新共享用户目录
+        elif event.startswith("user."):
+            if event in ["user.created", "user.deleted"]: user_directory.invalidate()
+            user_directory.refresh_async()
 
-        # 2. 播放状态 (保持不变)
-        elif event == "playback.start":
-            background_tasks.add_task(bot.push_playback_event, data, "start")
-        elif event == "playback.stop":
-            background_tasks.add_task(bot.push_playback_event, data, "stop")
+        # 2. 播放状态：只入队，立即返回
+        elif event in ["playback.start", "playback.stop"]:
+            accepted = webhook_queue.enqueue(event, data)
 
+        # 队列积压到上限时让 Emby 稍后重试，而不是无限堆内存
+        if not accepted: raise HTTPException(status_code=503, detail="Webhook queue is full")
         return {"status": "success"}
+    except HTTPException: raise
     except Exception as e:
         logger.error(f"Webhook Error: {e}")
-        return {"status": "error", "message": str(e)}
\ No newline at end of file
+        return {"status": "error", "message": str(e)}
+
+# 🔥 Telegram 推送模式回调：校验 setWebhook 时登记的 secret_token，更新交给指令分发池后立即返回
+@router.post("/api/v1/telegram/webhook")
+async def telegram_webhook(request: Request):
+    secret = cfg.get("tg_webhook_secret")
+    if not secret or not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+        raise HTTPException(status_code=403, detail="Invalid Token")
+    # 机器人未启用推送模式时直接确认，避免 Telegram 反复重投
+    if not bot.webhook_active: return {"status": "ignored"}
+    try: update = await request.json()
+    except Exception: return {"status": "error", "message": "Empty"}
+    bot.handle_update(update)
+    return {"status": "success"}
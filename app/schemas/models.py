@@ -19,6 +19,8 @@ class BotSettingsModel(BaseModel):
     enable_bot: bool
     enable_notify: bool
     enable_library_notify: Optional[bool] = False
+    tg_webhook_mode: Optional[bool] = False
+    tg_webhook_url: Optional[str] = ""
 
 class PushRequestModel(BaseModel):
     user_id: str
@@ -51,4 +53,8 @@ class InviteGenModel(BaseModel):
 class UserRegisterModel(BaseModel):
     code: str
     username: str
-    password: str
\ No newline at end of file
+    password: str
+
+# 图片批量解析参数 (海报墙一次解析多张)
+class ImageResolveModel(BaseModel):
+    ids: List[str]
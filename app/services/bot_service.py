@@ -6,35 +6,66 @@ import io
 import logging
 import urllib.parse
 import json 
-from collections import defaultdict
+import secrets
+from collections import defaultdict, deque
 # from dateutil import parser # ❌ 移除这个库
 from app.core.config import cfg, REPORT_COVER_URL, FALLBACK_IMAGE_URL
+from app.core.emby import emby
 from app.core.database import query_db, get_base_filter
 from app.services.report_service import report_gen, HAS_PIL
+from app.services.user_directory import user_directory
+from app.services.session_service import session_monitor
+from app.services.webhook_queue import webhook_queue
+from app.services.playback_events import playback_store
+from app.services.telegram_outbox import tg_outbox, tg_api_url, PRIORITY_REPLY, PRIORITY_NOTIFY
+from app.services.telegram_media import tg_file_ids
+from app.services.telegram_dispatch import tg_dispatcher
+from app.services.geoip import geoip
+from app.services.image_cache import image_cache
 
 logger = logging.getLogger("uvicorn")
 
+# 入库通知在 Webhook 队列里的通道名，以及单次聚合处理的上限
+LIBRARY_LANE = "library"
+LIBRARY_BATCH = 500
+# Telegram 推送模式的回调路径，以及用于去重的最近 update_id 数量 (Telegram 超时会重投)
+TG_WEBHOOK_PATH = "/api/v1/telegram/webhook"
+TG_RECENT_UPDATES = 200
+
 class TelegramBot:
     def __init__(self):
         self.running = False
         self.poll_thread = None
         self.schedule_thread = None 
-        self.library_queue = []
-        self.library_lock = threading.Lock()
         self.library_thread = None
+        self._ctx = threading.local()
+        self.webhook_active = False
+        self._retired_poller = None
+        self._recent_updates = deque(maxlen=TG_RECENT_UPDATES)
+        self._update_lock = threading.Lock()
         
         self.offset = 0
         self.last_check_min = -1
-        self.user_cache = {}
         
     def start(self):
         if self.running: return
         if not cfg.get("tg_bot_token"): return
         self.running = True
+        tg_outbox.start()
+        tg_dispatcher.on_timeout = self._on_command_timeout
+        tg_dispatcher.start()
         self._set_commands()
         
-        self.poll_thread = threading.Thread(target=self._polling_loop, daemon=True)
-        self.poll_thread.start()
+        # 保存配置时会 stop() 后马上 start()，旧的长轮询线程可能还卡在 getUpdates 里。
+        # 等它退出后再 setWebhook / deleteWebhook，避免新旧两边同时向 Telegram 取更新 (409)
+        old = self._retired_poller
+        if old and old.is_alive() and old is not threading.current_thread(): old.join(timeout=40)
+        
+        # 推送模式：Telegram 直接回调 FastAPI 路由，不再长轮询；注册失败退回长轮询
+        self.webhook_active = bool(cfg.get("tg_webhook_mode")) and self._set_webhook()
+        if not self.webhook_active:
+            self.poll_thread = threading.Thread(target=self._polling_loop, daemon=True)
+            self.poll_thread.start()
         
         self.schedule_thread = threading.Thread(target=self._scheduler_loop, daemon=True)
         self.schedule_thread.start()
@@ -44,7 +75,14 @@ class TelegramBot:
         
         print("🤖 Bot Service Started (Cluster Mode - Native)")
 
-    def stop(self): self.running = False
+    def stop(self):
+        self.running = False
+        self.webhook_active = False
+        # 旧的长轮询线程发现自己不再是 poll_thread 后退出 (即使马上又 start() 了)
+        if self.poll_thread: self._retired_poller = self.poll_thread
+        self.poll_thread = None
+        tg_dispatcher.stop()
+        tg_outbox.stop()
 
     def _get_proxies(self):
         proxy = cfg.get("proxy_url")
@@ -52,107 +90,113 @@ class TelegramBot:
 
     # 获取管理员ID
     def _get_admin_id(self):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-        if not key or not host: return None
-        try:
-            res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=5)
-            if res.status_code == 200:
-                users = res.json()
-                for u in users:
-                    if u.get("Policy", {}).get("IsAdministrator"):
-                        return u['Id']
-                if users: return users[0]['Id']
-        except: pass
-        return None
+        return user_directory.get_admin_id()
 
     def _get_username(self, user_id):
-        if user_id in self.user_cache: return self.user_cache[user_id]
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-        if not key or not host: return user_id
-        try:
-            res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=2)
-            if res.status_code == 200:
-                for u in res.json(): self.user_cache[u['Id']] = u['Name']
-        except: pass
-        return self.user_cache.get(user_id, "Unknown User")
-
-    def _get_location(self, ip):
-        if not ip or ip in ['127.0.0.1', '::1', '0.0.0.0']: return "本地连接"
-        try:
-            res = requests.get(f"http://ip-api.com/json/{ip}?lang=zh-CN", timeout=3)
-            if res.status_code == 200:
-                d = res.json()
-                if d.get('status') == 'success':
-                    return f"{d.get('country')} {d.get('regionName')} {d.get('city')}"
-        except: pass
-        return "未知位置"
+        return user_directory.get_name(user_id, "Unknown User")
 
     def _download_emby_image(self, item_id, img_type='Primary', image_tag=None):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-        if not key or not host: return None
+        if not emby.is_configured(): return None
+        # 下载过的海报放进磁盘图片缓存，同一张图 (比如 file_id 失效重传) 不再向 Emby 拉取
+        cache_key = image_cache.make_key("bot", item_id, img_type, image_tag)
+        entry = image_cache.get(cache_key)
+        content = image_cache.read(entry) if entry else None
+        if content: return io.BytesIO(content)
         try:
-            if image_tag:
-                url = f"{host}/emby/Items/{item_id}/Images/{img_type}?maxHeight=800&maxWidth=600&quality=90&tag={image_tag}"
-            else:
-                url = f"{host}/emby/Items/{item_id}/Images/{img_type}?maxHeight=800&maxWidth=600&quality=90&api_key={key}"
-            res = requests.get(url, timeout=15)
-            if res.status_code == 200: return io.BytesIO(res.content)
+            params = {"maxHeight": 800, "maxWidth": 600, "quality": 90}
+            if image_tag: params["tag"] = image_tag
+            res = emby.get(f"/emby/Items/{item_id}/Images/{img_type}", params=params, timeout=15, stream=True)
+            if res.status_code == 200:
+                entry = image_cache.put(cache_key, res, tagged=bool(image_tag))
+                content = image_cache.read(entry) if entry else None
+                if content: return io.BytesIO(content)
+            else: res.close()
         except: pass
         return None
 
-    def send_photo(self, chat_id, photo_io, caption, parse_mode="HTML", reply_markup=None):
-        token = cfg.get("tg_bot_token")
-        if not token: return
-        try:
-            url = f"https://api.telegram.org/bot{token}/sendPhoto"
-            data = {"chat_id": chat_id, "caption": caption, "parse_mode": parse_mode}
-            if reply_markup: data["reply_markup"] = json.dumps(reply_markup)
-            if isinstance(photo_io, str):
-                data['photo'] = photo_io
-                requests.post(url, data=data, proxies=self._get_proxies(), timeout=20)
-            else:
-                photo_io.seek(0)
-                files = {"photo": ("image.jpg", photo_io, "image/jpeg")}
-                requests.post(url, data=data, files=files, proxies=self._get_proxies(), timeout=30)
-        except Exception as e: 
-            logger.error(f"Send Photo Error: {e}")
-            self.send_message(chat_id, caption)
-
-    def send_message(self, chat_id, text, parse_mode="HTML"):
-        token = cfg.get("tg_bot_token")
-        if not token: return
-        try:
-            url = f"https://api.telegram.org/bot{token}/sendMessage"
-            requests.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": parse_mode}, proxies=self._get_proxies(), timeout=10)
-        except Exception as e: logger.error(f"Send Message Error: {e}")
+    def _priority(self):
+        # 指令处理期间发出的消息走回复通道，优先于推送通知
+        return getattr(self._ctx, "priority", PRIORITY_NOTIFY)
+
+    def _photo_request(self, chat_id, photo_io, caption, parse_mode="HTML", reply_markup=None, on_result=None):
+        """组装 sendPhoto 请求：photo_io 为 file_id / URL 字符串或图片字节流"""
+        data = {"chat_id": chat_id, "caption": caption, "parse_mode": parse_mode}
+        if reply_markup: data["reply_markup"] = json.dumps(reply_markup)
+        if isinstance(photo_io, str):
+            data['photo'] = photo_io
+            return {"method": "sendPhoto", "data": data, "files": None, "on_result": on_result}
+        photo_io.seek(0)
+        files = {"photo": ("image.jpg", photo_io.read(), "image/jpeg")}
+        return {"method": "sendPhoto", "data": data, "files": files, "on_result": on_result}
+
+    def send_photo(self, chat_id, photo_io, caption, parse_mode="HTML", reply_markup=None, fallback=None, on_result=None, on_reject=None, priority=None):
+        if not cfg.get("tg_bot_token") or self._cancelled(): return
+        if priority is None: priority = self._priority()
+        # 默认：图片发送失败时退回纯文本
+        if fallback is None: fallback = ("sendMessage", chat_id, {"chat_id": chat_id, "text": caption, "parse_mode": parse_mode})
+        req = self._photo_request(chat_id, photo_io, caption, parse_mode, reply_markup, on_result)
+        tg_outbox.send(req["method"], chat_id, req["data"], files=req["files"], priority=priority, fallback=fallback,
+                       on_result=req["on_result"], on_reject=on_reject)
+
+    def send_message(self, chat_id, text, parse_mode="HTML", priority=None):
+        if not cfg.get("tg_bot_token") or self._cancelled(): return
+        if priority is None: priority = self._priority()
+        tg_outbox.send("sendMessage", chat_id, {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}, priority=priority)
+
+    def send_item_photo(self, chat_id, candidates, caption, reply_markup=None, default_photo=None, priority=None):
+        """
+        发送条目海报：candidates 为 [(item_id, 图片类型, tag), ...]，按顺序取第一张可用的
+        - 命中 file_id 缓存：直接按 file_id 发送，不下载不上传；被 Telegram 拒绝时删掉缓存重新上传
+        - 未命中：下载并上传，记下 Telegram 返回的 file_id
+        都没有图时发 default_photo (URL)，再没有就发纯文本
+        """
+        if priority is None: priority = self._priority()
+        for item_id, img_type, tag in candidates:
+            if not item_id: continue
+            file_id = tg_file_ids.get(item_id, img_type, tag)
+            def remember(result, item_id=item_id, img_type=img_type, tag=tag):
+                # photo 数组是同一张图的多个尺寸，最后一个最大
+                photos = (result or {}).get("photo") or []
+                if photos: tg_file_ids.put(item_id, img_type, tag, photos[-1].get("file_id"))
+            if file_id:
+                def reupload(item_id=item_id, img_type=img_type, tag=tag, remember=remember):
+                    # file_id 失效：删缓存、重新下载，返回的上传请求由发送队列放回队首；没图时退回纯文本
+                    tg_file_ids.invalidate(item_id, img_type, tag)
+                    img_io = self._download_emby_image(item_id, img_type, tag)
+                    if img_io: return self._photo_request(chat_id, img_io, caption, reply_markup=reply_markup, on_result=remember)
+                self.send_photo(chat_id, file_id, caption, reply_markup=reply_markup, on_reject=reupload, priority=priority)
+                return
+            img_io = self._download_emby_image(item_id, img_type, tag)
+            if img_io:
+                self.send_photo(chat_id, img_io, caption, reply_markup=reply_markup, on_result=remember, priority=priority)
+                return
+        if default_photo: self.send_photo(chat_id, default_photo, caption, reply_markup=reply_markup, priority=priority)
+        else: self.send_message(chat_id, caption, priority=priority)
 
     # ================= 🚀 修复后的入库逻辑 (时间聚类算法 - 原生版) =================
     
     def add_library_task(self, item):
-        with self.library_lock:
-            if not any(x['Id'] == item['Id'] for x in self.library_queue):
-                self.library_queue.append(item)
+        # 🔥 入库事件进持久化队列的 library 通道，按条目 ID 去重，重启不丢
+        # 机器人没在运行时也照常入队，由下次启动的推送线程补发
+        return webhook_queue.enqueue("library.new", item, dedup_key=f"library:{item['Id']}", lane=LIBRARY_LANE)
 
     def _library_notify_loop(self):
         while self.running:
             try:
-                has_data = False
-                with self.library_lock:
-                    has_data = len(self.library_queue) > 0
-                
-                if not has_data:
+                if not webhook_queue.pending(LIBRARY_LANE):
                     time.sleep(2)
                     continue
 
                 time.sleep(15)
 
-                items_to_process = []
-                with self.library_lock:
-                    items_to_process = self.library_queue[:]
-                    self.library_queue = [] 
-                
-                if items_to_process:
-                    self._process_library_group(items_to_process)
+                batch = webhook_queue.claim(LIBRARY_LANE, limit=LIBRARY_BATCH)
+                if batch:
+                    try: self._process_library_group([e["payload"] for e in batch])
+                    except Exception:
+                        # 整批放回队列退避重试，不能停在已认领状态直到重启
+                        for e in batch: webhook_queue.release(e)
+                        raise
+                    webhook_queue.ack(batch)
                     
             except Exception as e:
                 logger.error(f"Library Loop Error: {e}")
@@ -192,8 +236,6 @@ class TelegramBot:
                         self._push_single_item(series_item)
                 else:
                     self._push_single_item(group_items[0])
-                
-                time.sleep(2) 
             except Exception as e:
                 logger.error(f"Group Process Error: {e}")
 
@@ -213,12 +255,10 @@ class TelegramBot:
 
     # 🔥 修复：使用原生解析
     def _check_fresh_episodes(self, series_id):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
         admin_id = self._get_admin_id()
         if not admin_id: return []
         
         try:
-            url = f"{host}/emby/Users/{admin_id}/Items"
             params = {
                 "ParentId": series_id,
                 "Recursive": "true",
@@ -226,10 +266,9 @@ class TelegramBot:
                 "Limit": 20, 
                 "SortBy": "DateCreated",
                 "SortOrder": "Descending",
-                "Fields": "DateCreated,Name,ParentIndexNumber,IndexNumber",
-                "api_key": key
+                "Fields": "DateCreated,Name,ParentIndexNumber,IndexNumber"
             }
-            res = requests.get(url, params=params, timeout=10)
+            res = emby.get(f"/emby/Users/{admin_id}/Items", params=params, timeout=10)
             if res.status_code != 200: return []
             
             items = res.json().get("Items", [])
@@ -265,13 +304,11 @@ class TelegramBot:
 
     def _push_episode_group(self, series_id, episodes):
         cid = str(cfg.get("tg_chat_id"))
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
         admin_id = self._get_admin_id()
         
         series_info = {}
         try:
-            url = f"{host}/emby/Users/{admin_id}/Items/{series_id}?api_key={key}"
-            res = requests.get(url, timeout=10)
+            res = emby.get(f"/emby/Users/{admin_id}/Items/{series_id}", timeout=10)
             if res.status_code == 200: series_info = res.json()
         except: pass
         
@@ -304,19 +341,17 @@ class TelegramBot:
                    f"🕒 时间：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
                    f"📝 剧情：{overview}")
 
-        img_io = self._download_emby_image(series_id, 'Primary')
-        if not img_io: img_io = self._download_emby_image(series_id, 'Backdrop') 
-        
-        if img_io: self.send_photo(cid, img_io, caption)
-        else: self.send_photo(cid, REPORT_COVER_URL, caption)
+        # 拿不到剧集信息时 series_info 是单集，它的 ImageTags 不属于剧集，不能拿来当 tag
+        has_series = series_info.get("Id") == series_id
+        tags = (series_info.get("ImageTags") or {}) if has_series else {}
+        backdrop_tags = (series_info.get("BackdropImageTags") or []) if has_series else []
+        self.send_item_photo(cid, [(series_id, 'Primary', tags.get('Primary')), (series_id, 'Backdrop', backdrop_tags[0] if backdrop_tags else None)],
+                             caption, default_photo=REPORT_COVER_URL)
 
     def _push_single_item(self, item):
         cid = str(cfg.get("tg_chat_id"))
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-        
         try:
-            url = f"{host}/emby/Items/{item['Id']}?api_key={key}"
-            res = requests.get(url, timeout=10)
+            res = emby.get(f"/emby/Items/{item['Id']}", timeout=10)
             if res.status_code == 200: item = res.json()
         except: pass
 
@@ -342,9 +377,7 @@ class TelegramBot:
                    f"🕒 时间：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
                    f"📝 剧情：{overview}")
         
-        img_io = self._download_emby_image(item['Id'], 'Primary')
-        if img_io: self.send_photo(cid, img_io, caption)
-        else: self.send_photo(cid, REPORT_COVER_URL, caption)
+        self.send_item_photo(cid, [(item['Id'], 'Primary', (item.get("ImageTags") or {}).get('Primary'))], caption, default_photo=REPORT_COVER_URL)
 
     # ================= 业务逻辑 (保持不变) =================
 
@@ -363,7 +396,8 @@ class TelegramBot:
             
             type_cn = "剧集" if item.get("Type") == "Episode" else "电影"
             emoji = "▶️" if action == "start" else "⏹️"; act = "开始播放" if action == "start" else "停止播放"
-            ip = session.get("RemoteEndPoint", "127.0.0.1"); loc = self._get_location(ip)
+            # 先查本地缓存 / 离线库，在线查询在后台进行，不拖慢通知
+            ip = session.get("RemoteEndPoint", "127.0.0.1"); loc = geoip.lookup(ip)
             
             msg = (f"{emoji} <b>【{user.get('Name')}】{act}</b>\n"
                    f"📺 {title}\n"
@@ -372,14 +406,13 @@ class TelegramBot:
                    f"📱 设备：{session.get('Client')} on {session.get('DeviceName')}\n"
                    f"🕒 时间：{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
             
-            target_id = item.get("Id")
-            if item.get("Type") == "Episode" and item.get("SeriesId"): target_id = item.get("SeriesId")
+            target_id = item.get("Id"); target_tag = (item.get("ImageTags") or {}).get("Primary")
+            if item.get("Type") == "Episode" and item.get("SeriesId"):
+                target_id = item.get("SeriesId"); target_tag = item.get("SeriesPrimaryImageTag")
+            backdrop_tags = item.get("BackdropImageTags") or []
             
-            img_io = self._download_emby_image(target_id, 'Primary') 
-            if not img_io: img_io = self._download_emby_image(item.get("Id"), 'Backdrop')
-            
-            if img_io: self.send_photo(chat_id, img_io, msg)
-            else: self.send_message(chat_id, msg)
+            # 追剧时同一张海报会反复发送，命中 file_id 缓存后不再下载上传
+            self.send_item_photo(chat_id, [(target_id, 'Primary', target_tag), (item.get("Id"), 'Backdrop', backdrop_tags[0] if backdrop_tags else None)], msg)
         except Exception as e:
             logger.error(f"Playback Push Error: {e}")
 
@@ -397,25 +430,87 @@ class TelegramBot:
                 {"command": "recent", "description": "📜 播放历史"},
                 {"command": "check", "description": "📡 系统检查"},
                 {"command": "help", "description": "🤖 帮助菜单"}]
-        try: requests.post(f"https://api.telegram.org/bot{token}/setMyCommands", json={"commands": cmds}, proxies=self._get_proxies(), timeout=10)
+        try: requests.post(tg_api_url(token, "setMyCommands"), json={"commands": cmds}, proxies=self._get_proxies(), timeout=10)
         except: pass
 
+    def _set_webhook(self):
+        token = cfg.get("tg_bot_token"); base = cfg.get("tg_webhook_url")
+        if not base:
+            logger.warning("⚠️ 未填写对外地址，Telegram 推送模式无法启用，改用长轮询")
+            return False
+        if not cfg.get("tg_webhook_secret"):
+            cfg.set("tg_webhook_secret", secrets.token_urlsafe(32))
+        try:
+            res = requests.post(tg_api_url(token, "setWebhook"),
+                                json={"url": f"{base.rstrip('/')}{TG_WEBHOOK_PATH}", "secret_token": cfg.get("tg_webhook_secret"), "allowed_updates": ["message"]},
+                                proxies=self._get_proxies(), timeout=10)
+            if res.status_code == 200 and res.json().get("ok"):
+                logger.info(f"🤖 Telegram 推送模式已启用: {base.rstrip('/')}{TG_WEBHOOK_PATH}")
+                return True
+            logger.error(f"Telegram setWebhook 失败: {res.text}")
+        except Exception as e:
+            logger.error(f"Telegram setWebhook 失败: {e}")
+        return False
+
+    def _is_current_poller(self, thread):
+        return self.running and not self.webhook_active and self.poll_thread is thread
+
     def _polling_loop(self):
-        token = cfg.get("tg_bot_token"); admin_id = str(cfg.get("tg_chat_id"))
-        while self.running:
+        me = threading.current_thread()
+        token = cfg.get("tg_bot_token")
+        # 之前用过推送模式的话 Telegram 上还登记着 Webhook，getUpdates 会一直返回 409
+        try: requests.post(tg_api_url(token, "deleteWebhook"), proxies=self._get_proxies(), timeout=10)
+        except: pass
+        while self._is_current_poller(me):
             try:
-                res = requests.get(f"https://api.telegram.org/bot{token}/getUpdates", params={"offset": self.offset, "timeout": 30}, proxies=self._get_proxies(), timeout=35)
+                res = requests.get(tg_api_url(token, "getUpdates"), params={"offset": self.offset, "timeout": 30}, proxies=self._get_proxies(), timeout=35)
+                # 等待期间机器人已重启 / 切换到推送模式：不处理这批结果 (不推进 offset)，交给新的接收方
+                if not self._is_current_poller(me): break
                 if res.status_code == 200:
                     for u in res.json().get("result", []):
                         self.offset = u["update_id"] + 1
-                        if "message" in u:
-                            cid = str(u["message"]["chat"]["id"]); 
-                            if admin_id and cid != admin_id: continue
-                            self._handle_message(u["message"], cid)
+                        self.handle_update(u)
                 else: time.sleep(5)
             except: time.sleep(5)
 
-    def _handle_message(self, msg, cid):
+    def handle_update(self, u):
+        """处理一条 Telegram Update (长轮询与推送模式共用)，只做过滤和入队，不阻塞调用方"""
+        update_id = u.get("update_id")
+        with self._update_lock:
+            if update_id in self._recent_updates: return
+            self._recent_updates.append(update_id)
+        msg = u.get("message")
+        if not msg: return
+        cid = str(msg.get("chat", {}).get("id")); admin_id = str(cfg.get("tg_chat_id"))
+        if admin_id and cid != admin_id: return
+        self._submit_message(msg, cid)
+
+    def _submit_message(self, msg, cid):
+        """交给指令分发池执行，收消息的线程立即返回"""
+        text = msg.get("text", "").strip()
+        if not text.startswith("/"): return
+        # "/stats@MyBot" 与 "/stats" 视为同一指令
+        command = text.split()[0].split("@")[0].lower()
+        key = (cid, command + text[len(text.split()[0]):])
+        tg_dispatcher.submit(cid, key, lambda job: self._handle_message(msg, cid, job), tg_dispatcher.timeout_for(command))
+
+    def _handle_message(self, msg, cid, job=None):
+        self._ctx.priority = PRIORITY_REPLY
+        self._ctx.job = job
+        try: self._dispatch_command(msg, cid)
+        finally:
+            self._ctx.priority = PRIORITY_NOTIFY
+            self._ctx.job = None
+
+    def _on_command_timeout(self, job):
+        self.send_message(job.chat_id, "⏳ 指令处理超时，请稍后再试", priority=PRIORITY_REPLY)
+
+    def _cancelled(self):
+        # 已超时的指令，迟到的回复直接丢弃 (用户已经收到超时提示)
+        job = getattr(self._ctx, "job", None)
+        return bool(job and job.cancelled)
+
+    def _dispatch_command(self, msg, cid):
         text = msg.get("text", "").strip()
         if text.startswith("/search"): self._cmd_search(cid, text)
         elif text.startswith("/stats"): self._cmd_stats(cid, 'day')
@@ -429,16 +524,14 @@ class TelegramBot:
         elif text.startswith("/help"): self._cmd_help(cid)
 
     def _cmd_latest(self, cid):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
         try:
             user_id = self._get_admin_id()
             if not user_id: return self.send_message(cid, "❌ 错误: 无法获取 Emby 用户身份")
 
             fields = "DateCreated,Name,SeriesName,ProductionYear,Type"
-            url = f"{host}/emby/Users/{user_id}/Items/Latest"
-            params = {"Limit": 8, "MediaTypes": "Video", "Fields": fields, "api_key": key}
+            params = {"Limit": 8, "MediaTypes": "Video", "Fields": fields}
             
-            res = requests.get(url, params=params, timeout=15)
+            res = emby.get(f"/emby/Users/{user_id}/Items/Latest", params=params, timeout=15)
             if res.status_code != 200: return self.send_message(cid, f"❌ 查询失败: Emby 返回 HTTP {res.status_code}")
 
             items = res.json()
@@ -493,24 +586,22 @@ class TelegramBot:
         parts = text.split(' ', 1)
         if len(parts) < 2: return self.send_message(chat_id, "🔍 <b>搜索格式错误</b>\n请使用: <code>/search 关键词</code>")
         keyword = parts[1].strip()
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
+        host = cfg.get("emby_host")
         
         try:
             user_id = self._get_admin_id()
-            if not user_id: return self.send_message(cid, "❌ 错误: 无法获取 Emby 用户身份")
+            if not user_id: return self.send_message(chat_id, "❌ 错误: 无法获取 Emby 用户身份")
 
             # 1️⃣ 第一步：只搜基础信息
             fields = "ProductionYear,Type,Id" 
-            url = f"{host}/emby/Users/{user_id}/Items"
             params = {
                 "SearchTerm": keyword,
                 "IncludeItemTypes": "Movie,Series",
                 "Recursive": "true",
                 "Fields": fields,
-                "Limit": 5,
-                "api_key": key
+                "Limit": 5
             }
-            res = requests.get(url, params=params, timeout=10)
+            res = emby.get(f"/emby/Users/{user_id}/Items", params=params, timeout=10)
             if res.status_code != 200: return self.send_message(chat_id, f"❌ 搜索失败 (HTTP {res.status_code})")
             
             items = res.json().get("Items", [])
@@ -523,19 +614,17 @@ class TelegramBot:
 
             try:
                 if type_raw == "Series":
-                    meta_url = f"{host}/emby/Users/{user_id}/Items/{top['Id']}?Fields=Overview,CommunityRating,Genres,RecursiveItemCount&api_key={key}"
-                    details = requests.get(meta_url, timeout=5).json()
+                    details = emby.get(f"/emby/Users/{user_id}/Items/{top['Id']}", params={"Fields": "Overview,CommunityRating,Genres,RecursiveItemCount"}, timeout=5).json()
                     ep_count = details.get("RecursiveItemCount", 0)
                     ep_count_str = f"📊 共 {ep_count} 集"
                     
-                    sample_url = f"{host}/emby/Users/{user_id}/Items?ParentId={top['Id']}&Recursive=true&IncludeItemTypes=Episode&Limit=1&Fields=MediaSources&api_key={key}"
-                    sample_res = requests.get(sample_url, timeout=5)
+                    sample_params = {"ParentId": top['Id'], "Recursive": "true", "IncludeItemTypes": "Episode", "Limit": 1, "Fields": "MediaSources"}
+                    sample_res = emby.get(f"/emby/Users/{user_id}/Items", params=sample_params, timeout=5)
                     if sample_res.status_code == 200 and sample_res.json().get("Items"):
                         sample_ep = sample_res.json().get("Items")[0]
                         tech_info_str = self._extract_tech_info(sample_ep)
                 else:
-                    detail_url = f"{host}/emby/Users/{user_id}/Items/{top['Id']}?Fields=Overview,CommunityRating,Genres,MediaSources&api_key={key}"
-                    details = requests.get(detail_url, timeout=8).json()
+                    details = emby.get(f"/emby/Users/{user_id}/Items/{top['Id']}", params={"Fields": "Overview,CommunityRating,Genres,MediaSources"}, timeout=8).json()
                     tech_info_str = self._extract_tech_info(details)
             except Exception as e:
                 logger.error(f"Detail Fetch Error: {e}")
@@ -572,14 +661,24 @@ class TelegramBot:
             play_url = f"{base_url}/web/index.html#!/item?id={top.get('Id')}&serverId={top.get('ServerId')}"
             keyboard = {"inline_keyboard": [[{"text": "▶️ 立即播放", "url": play_url}]]}
             
-            img_io = self._download_emby_image(top.get("Id"), 'Primary')
-            if img_io: self.send_photo(chat_id, img_io, caption, reply_markup=keyboard)
-            else: self.send_photo(chat_id, REPORT_COVER_URL, caption, reply_markup=keyboard)
+            self.send_item_photo(chat_id, [(top.get("Id"), 'Primary', (top.get("ImageTags") or {}).get('Primary'))], caption,
+                                 reply_markup=keyboard, default_photo=REPORT_COVER_URL)
             
         except Exception as e:
             logger.error(f"Search Error: {e}")
             self.send_message(chat_id, "❌ 搜索时发生错误")
 
+    def _period_bounds(self, period):
+        """与 _cmd_stats 的时间条件对应的 (since, until)，用于筛选实时播放"""
+        today = datetime.date.today()
+        if period == 'week': since = datetime.datetime.now() - datetime.timedelta(days=7)
+        elif period == 'month': since = today.replace(day=1)
+        elif period == 'year': since = today.replace(month=1, day=1)
+        elif period == 'yesterday':
+            return (today - datetime.timedelta(days=1)).strftime('%Y-%m-%d 00:00:00'), today.strftime('%Y-%m-%d 00:00:00')
+        else: since = today
+        return since.strftime('%Y-%m-%d %H:%M:%S'), None
+
     def _cmd_stats(self, chat_id, period='day'):
         where, params = get_base_filter('all') 
         titles = {'day': '今日日报', 'yesterday': '昨日日报', 'week': '本周周报', 'month': '本月月报', 'year': '年度报告'}
@@ -595,24 +694,37 @@ class TelegramBot:
             plays = plays_res[0]['c']
             dur_res = query_db(f"SELECT SUM(PlayDuration) as c FROM PlaybackActivity {where}", params)
             dur = dur_res[0]['c'] if dur_res and dur_res[0]['c'] else 0
+            # 用户按时长全量分组 (人数不多)，便于与实时播放合并后再取 Top 5
+            user_rows = query_db(f"SELECT UserId, SUM(PlayDuration) as t FROM PlaybackActivity {where} GROUP BY UserId", params) or []
+            user_time = {u['UserId']: u['t'] or 0 for u in user_rows}
+            live = playback_store.get_live_plays('all', *self._period_bounds(period))
+            tops = query_db(f"SELECT ItemName, COUNT(*) as c FROM PlaybackActivity {where} GROUP BY ItemName ORDER BY c DESC LIMIT ?", params + [10 + len(live)]) or []
+            item_count = {t['ItemName']: t['c'] for t in tops}
+
+            # 🔥 并入插件还没落库的播放
+            for p in live:
+                plays += 1
+                dur += p['PlayDuration']
+                user_time[p['UserId']] = user_time.get(p['UserId'], 0) + p['PlayDuration']
+                item_count[p['ItemName']] = item_count.get(p['ItemName'], 0) + 1
             hours = round(dur / 3600, 1)
-            users_res = query_db(f"SELECT COUNT(DISTINCT UserId) as c FROM PlaybackActivity {where}", params)
-            users = users_res[0]['c'] if users_res else 0
-            top_users = query_db(f"SELECT UserId, SUM(PlayDuration) as t FROM PlaybackActivity {where} GROUP BY UserId ORDER BY t DESC LIMIT 5", params)
+            users = len(user_time)
+
+            top_users = sorted(user_time.items(), key=lambda x: x[1], reverse=True)[:5]
             user_str = ""
             if top_users:
-                for i, u in enumerate(top_users):
-                    name = self._get_username(u['UserId'])
-                    h = round(u['t'] / 3600, 1)
+                for i, (uid, t) in enumerate(top_users):
+                    name = self._get_username(uid)
+                    h = round(t / 3600, 1)
                     prefix = ['🥇','🥈','🥉'][i] if i < 3 else f"{i+1}."
                     user_str += f"{prefix} {name} ({h}h)\n"
             else: user_str = "暂无数据"
-            tops = query_db(f"SELECT ItemName, COUNT(*) as c FROM PlaybackActivity {where} GROUP BY ItemName ORDER BY c DESC LIMIT 10", params)
+            tops = sorted(item_count.items(), key=lambda x: x[1], reverse=True)[:10]
             top_content = ""
             if tops:
-                for i, item in enumerate(tops):
+                for i, (name, c) in enumerate(tops):
                     prefix = ['🥇','🥈','🥉'][i] if i < 3 else f"{i+1}."
-                    top_content += f"{prefix} {item['ItemName']} ({item['c']}次)\n"
+                    top_content += f"{prefix} {name} ({c}次)\n"
             else: top_content = "暂无数据"
             
             yesterday_date = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%m-%d")
@@ -640,10 +752,8 @@ class TelegramBot:
         else: self._cmd_stats(chat_id, 'yesterday')
 
     def _cmd_now(self, cid):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
         try:
-            res = requests.get(f"{host}/emby/Sessions?api_key={key}", timeout=5)
-            sessions = [s for s in res.json() if s.get("NowPlayingItem")]
+            sessions = session_monitor.get_sessions()
             if not sessions: return self.send_message(cid, "🟢 当前无播放")
             msg = f"🟢 <b>正在播放 ({len(sessions)})</b>\n"
             for s in sessions:
@@ -668,10 +778,9 @@ class TelegramBot:
             self.send_message(cid, f"❌ 查询失败")
 
     def _cmd_check(self, cid):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
         start = time.time()
         try:
-            res = requests.get(f"{host}/emby/System/Info?api_key={key}", timeout=5)
+            res = emby.get("/emby/System/Info", timeout=5, retries=0)
             if res.status_code == 200:
                 info = res.json()
                 local = (info.get('LocalAddresses') or [info.get('LocalAddress')])[0]
@@ -699,10 +808,9 @@ class TelegramBot:
             users = query_db("SELECT user_id, expire_date FROM users_meta WHERE expire_date IS NOT NULL AND expire_date != ''")
             if not users: return
             today = datetime.datetime.now().strftime("%Y-%m-%d")
-            key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
             for u in users:
                 if u['expire_date'] < today:
-                    try: requests.post(f"{host}/emby/Users/{u['user_id']}/Policy?api_key={key}", json={"IsDisabled": True})
+                    try: emby.post(f"/emby/Users/{u['user_id']}/Policy", json={"IsDisabled": True})
                     except: pass
         except: pass
     
@@ -1,53 +1,130 @@
-import requests
 import datetime
 import logging
 import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from app.core.config import cfg
+from app.core.emby import emby
+from app.core.tmdb import tmdb, TMDB_TTL_SHORT, TMDB_TTL_LONG
+from app.services.user_directory import user_directory
 
 logger = logging.getLogger("uvicorn")
 
+# 后台预热的周偏移 (上周/本周/下周) 与检查间隔 (秒)
+PREWARM_OFFSETS = (-1, 0, 1)
+PREWARM_INTERVAL = 600
+# 没有缓存时等待正在进行的同一周重建的最长时间
+BUILD_WAIT_TIMEOUT = 120
+
+def week_start(week_offset):
+    target_date = datetime.date.today() + datetime.timedelta(weeks=week_offset)
+    return target_date - datetime.timedelta(days=target_date.weekday())
+
 class CalendarService:
     def __init__(self):
-        # 缓存结构: { offset: {'data': ..., 'time': timestamp} }
+        # 缓存结构: { offset: {'data': ..., 'time': timestamp, 'week_start': date} }
         self._cache = {} 
         self._cache_lock = threading.Lock()
         # CACHE_TTL 不再硬编码，改为动态获取
+        # 正在重建的周: { offset: Event }，同一周并发请求只触发一次重建
+        self._inflight = {}
+        self.running = False
+
+    # ---------- 后台预热 ----------
+    def start(self):
+        if self.running: return
+        self.running = True
+        threading.Thread(target=self._prewarm_loop, daemon=True).start()
 
-    def _get_proxies(self):
-        """获取全局代理配置"""
-        proxy = cfg.get("proxy_url")
-        if proxy:
-            return {"http": proxy, "https": proxy}
-        return None
+    def stop(self): self.running = False
+
+    def _prewarm_loop(self):
+        while self.running:
+            for offset in PREWARM_OFFSETS:
+                if not self.running: break
+                try:
+                    if cfg.get("tmdb_api_key") and self._cached(offset)[1]:
+                        self._refresh(offset)
+                except Exception as e:
+                    logger.error(f"Calendar Prewarm Error: {e}")
+            time.sleep(PREWARM_INTERVAL)
+
+    # ---------- 缓存 ----------
+    def _cached(self, week_offset):
+        """返回 (缓存数据或 None, 是否需要重建)"""
+        # 🔥 动态获取配置，默认 1 天 (86400秒)
+        cache_ttl = int(cfg.get("calendar_cache_ttl") or 86400)
+        with self._cache_lock:
+            cached_item = self._cache.get(week_offset)
+        # 跨周之后同一个 offset 指向的已经是另一周，旧数据作废
+        if not cached_item or cached_item['week_start'] != week_start(week_offset):
+            return None, True
+        return cached_item['data'], time.time() - cached_item['time'] >= cache_ttl
+
+    def _refresh(self, week_offset):
+        """
+        单飞重建：同一周只有一个线程真正去构建，其余的等它完成
+        构建结果挂在 in-flight 条目上交给等待者 (没写缓存的结果，如 "days": [] 也能拿到)
+        """
+        with self._cache_lock:
+            flight = self._inflight.get(week_offset)
+            leader = flight is None
+            if leader:
+                flight = {"event": threading.Event(), "result": None}
+                self._inflight[week_offset] = flight
+        if not leader:
+            if not flight["event"].wait(BUILD_WAIT_TIMEOUT): return None
+            return flight["result"]
+        try:
+            flight["result"] = self._build_week(week_offset)
+            return flight["result"]
+        finally:
+            with self._cache_lock: self._inflight.pop(week_offset, None)
+            flight["event"].set()
+
+    def _refresh_async(self, week_offset):
+        with self._cache_lock:
+            if week_offset in self._inflight: return
+        threading.Thread(target=self._refresh, args=(week_offset,), daemon=True).start()
+
+    def is_refreshing(self, week_offset):
+        with self._cache_lock: return week_offset in self._inflight
 
     def get_weekly_calendar(self, force_refresh=False, week_offset=0):
         """
         获取周历
+        有缓存时立即返回 (过期或强制刷新则在后台重建，refreshing=true)，
+        只有从没构建过的周才会等待构建完成
         """
+        if not cfg.get("tmdb_api_key"):
+            return {"error": "未配置 TMDB API Key"}
+
+        data, stale = self._cached(week_offset)
+        if data is None:
+            data = self._refresh(week_offset)
+            if data is None: return {"error": "日历数据构建超时，请稍后重试"}
+            # 没配置 Emby / 没有连载剧等情况不写缓存，原样返回
+            if "date_range" not in data: return data
+        elif stale or force_refresh:
+            self._refresh_async(week_offset)
+
+        # 注入 current_ttl 以便前端回显
+        result = dict(data)
+        result['current_ttl'] = int(cfg.get("calendar_cache_ttl") or 86400)
+        result['refreshing'] = self.is_refreshing(week_offset)
+        return result
+
+    def _build_week(self, week_offset):
+        """完整构建一周数据并写入缓存 (查询 Emby + TMDB)"""
         now = time.time()
-        
-        # 🔥 动态获取配置，默认 1 天 (86400秒)
         cache_ttl = int(cfg.get("calendar_cache_ttl") or 86400)
 
-        # 1. 检查对应周的缓存
-        if not force_refresh:
-            with self._cache_lock:
-                cached_item = self._cache.get(week_offset)
-                if cached_item and (now - cached_item['time'] < cache_ttl):
-                    # 注入 current_ttl 以便前端回显
-                    data = cached_item['data']
-                    data['current_ttl'] = cache_ttl
-                    return data
-
         api_key = cfg.get("tmdb_api_key")
         if not api_key:
             return {"error": "未配置 TMDB API Key"}
 
         # 2. 计算目标周的时间范围
-        target_date = datetime.date.today() + datetime.timedelta(weeks=week_offset)
-        start_of_week = target_date - datetime.timedelta(days=target_date.weekday())
+        start_of_week = week_start(week_offset)
         end_of_week = start_of_week + datetime.timedelta(days=6)
         
         # 3. 从 Emby 获取所有“连载中”的剧集
@@ -57,11 +134,12 @@ class CalendarService:
 
         # 4. 并发查询 TMDB
         week_data = {i: [] for i in range(7)}
-        proxies = self._get_proxies()
+        # 管理员 ID 只取一次，所有线程共用
+        admin_id = self._get_admin_id()
         
         with ThreadPoolExecutor(max_workers=20) as executor:
             future_to_series = {
-                executor.submit(self._fetch_series_status, s, api_key, start_of_week, end_of_week, proxies): s 
+                executor.submit(self._fetch_series_status, s, start_of_week, end_of_week, admin_id): s 
                 for s in continuing_series
             }
             
@@ -159,26 +237,24 @@ class CalendarService:
         with self._cache_lock:
             self._cache[week_offset] = {
                 'data': result,
-                'time': now
+                'time': now,
+                'week_start': start_of_week
             }
             
         return result
 
     def _get_emby_continuing_series(self):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
         user_id = self._get_admin_id()
-        if not key or not host or not user_id: return []
+        if not emby.is_configured() or not user_id: return []
 
-        url = f"{host}/emby/Users/{user_id}/Items"
         params = {
             "IncludeItemTypes": "Series",
             "Recursive": "true",
             "Fields": "ProviderIds,Status,AirDays",
-            "IsVirtual": "false",
-            "api_key": key
+            "IsVirtual": "false"
         }
         try:
-            res = requests.get(url, params=params, timeout=10)
+            res = emby.get(f"/emby/Users/{user_id}/Items", params=params, timeout=10)
             if res.status_code == 200:
                 items = res.json().get("Items", [])
                 return [i for i in items if i.get("Status") == "Continuing" and i.get("ProviderIds", {}).get("Tmdb")]
@@ -187,17 +263,16 @@ class CalendarService:
             return []
         return []
 
-    def _fetch_series_status(self, series, api_key, start_date, end_date, proxies):
+    def _fetch_series_status(self, series, start_date, end_date, admin_id=None):
         """查询 TMDB 并比对本地库存"""
         tmdb_id = series.get("ProviderIds", {}).get("Tmdb")
         if not tmdb_id: return []
 
         try:
-            url_series = f"https://api.themoviedb.org/3/tv/{tmdb_id}?api_key={api_key}&language=zh-CN"
-            res_series = requests.get(url_series, timeout=5, proxies=proxies)
-            if res_series.status_code != 200: return []
+            # TMDB 响应走持久化缓存 (ETag 重新验证 + 限速)
+            data_series = tmdb.get(f"/tv/{tmdb_id}", {"language": "zh-CN"}, ttl=TMDB_TTL_SHORT)
+            if not data_series: return []
             
-            data_series = res_series.json()
             target_seasons = set()
             
             # 确定要查哪些季
@@ -210,16 +285,23 @@ class CalendarService:
                 last_season = data_series["seasons"][-1]
                 target_seasons.add(last_season.get("season_number"))
 
+            # 仍在更新的季短缓存，已经完结 (后面还有新季) 的季长缓存
+            next_season = (data_series.get("next_episode_to_air") or {}).get("season_number")
+            last_season = (data_series.get("last_episode_to_air") or {}).get("season_number")
+            current_season = next_season if next_season is not None else last_season
+
             final_episodes = []
+            # 本地已有的单集 (季, 集) 集合，每部剧只查一次 Emby，之后都是集合查找
+            local_episodes = None
 
             for season_num in target_seasons:
                 if season_num is None: continue
                 
-                url_season = f"https://api.themoviedb.org/3/tv/{tmdb_id}/season/{season_num}?api_key={api_key}&language=zh-CN"
-                res_season = requests.get(url_season, timeout=5, proxies=proxies)
-                if res_season.status_code != 200: continue
+                season_ttl = TMDB_TTL_SHORT if season_num == current_season else TMDB_TTL_LONG
+                data_season = tmdb.get(f"/tv/{tmdb_id}/season/{season_num}", {"language": "zh-CN"}, ttl=season_ttl)
+                if not data_season: continue
                 
-                episodes_list = res_season.json().get("episodes", [])
+                episodes_list = data_season.get("episodes", [])
                 
                 for ep in episodes_list:
                     air_date_str = ep.get("air_date")
@@ -233,7 +315,9 @@ class CalendarService:
                         season_val = ep.get("season_number")
                         ep_val = ep.get("episode_number")
                         
-                        has_file = self._check_emby_has_episode(series["Id"], season_val, ep_val)
+                        if local_episodes is None:
+                            local_episodes = self._get_local_episodes(series["Id"], admin_id)
+                        has_file = (season_val, ep_val) in local_episodes
                         
                         status = "upcoming"
                         today = datetime.date.today()
@@ -266,40 +350,36 @@ class CalendarService:
         except Exception as e:
             return []
 
-    def _check_emby_has_episode(self, series_id, season, episode):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-        user_id = self._get_admin_id()
-        if not key or not host or not user_id: return False
-        
-        url = f"{host}/emby/Users/{user_id}/Items"
+    def _get_local_episodes(self, series_id, user_id=None):
+        """一次拉取该剧全部本地单集，返回 {(季号, 集号)} 集合"""
+        user_id = user_id or self._get_admin_id()
+        if not emby.is_configured() or not user_id: return set()
+
         params = {
             "ParentId": series_id,
             "Recursive": "true",
             "IncludeItemTypes": "Episode",
-            "ParentIndexNumber": season,
-            "IndexNumber": episode,
-            "Limit": 1,
-            "Fields": "Id", 
-            "api_key": key
+            "IsMissing": "false",
+            "Fields": "Id",
+            "EnableImages": "false",
+            "EnableUserData": "false"
         }
         try:
-            res = requests.get(url, params=params, timeout=2)
+            res = emby.get(f"/emby/Users/{user_id}/Items", params=params, timeout=10)
             if res.status_code == 200:
-                return res.json().get("TotalRecordCount", 0) > 0
-        except: pass
-        return False
+                episodes = set()
+                for ep in res.json().get("Items", []):
+                    season, start = ep.get("ParentIndexNumber"), ep.get("IndexNumber")
+                    if season is None or start is None: continue
+                    # 合集文件 (如 E01-E02) 覆盖 IndexNumber..IndexNumberEnd
+                    for num in range(start, (ep.get("IndexNumberEnd") or start) + 1):
+                        episodes.add((season, num))
+                return episodes
+        except Exception as e:
+            logger.error(f"Emby Episodes Fetch Error: {e}")
+        return set()
 
     def _get_admin_id(self):
-        key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-        try:
-            res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=3)
-            if res.status_code == 200:
-                users = res.json()
-                for u in users:
-                    if u.get("Policy", {}).get("IsAdministrator"):
-                        return u['Id']
-                return users[0]['Id']
-        except: pass
-        return None
+        return user_directory.get_admin_id()
 
 calendar_service = CalendarService()
\ No newline at end of file
@@ -0,0 +1,228 @@
+import time
+import threading
+import ipaddress
+import logging
+import requests
+from collections import OrderedDict, deque
+from app.core.config import cfg
+from app.core.database import query_sidecar, sidecar_pool
+from app.core.ratelimit import TokenBucket
+
+try:
+    import maxminddb
+    HAS_MAXMIND = True
+except ImportError:
+    HAS_MAXMIND = False
+
+logger = logging.getLogger("uvicorn")
+
+LOCATION_LOCAL = "本地连接"
+LOCATION_LAN = "局域网"
+LOCATION_UNKNOWN = "未知位置"
+# 内存 LRU 条目数
+GEOIP_LRU_SIZE = 4096
+# 旁路库里的结果有效期 (秒)；在线查询失败的 IP 隔一段时间再试
+GEOIP_CACHE_TTL = 30 * 86400
+GEOIP_RETRY_AFTER = 3600
+# 通知线程最多等在线查询这么久 (秒)，超时先发 "未知位置"，结果落库后下次命中
+GEOIP_ONLINE_WAIT = 0.5
+GEOIP_ONLINE_QUEUE_MAX = 256
+# ip-api 免费接口限制 45 次/分钟
+GEOIP_ONLINE_RATE, GEOIP_ONLINE_BURST = 40 / 60, 5
+# 离线库加载失败后隔这么久 (秒) 再试，避免每条通知都重复打开并报错
+GEOIP_DB_RETRY = 600
+
+class GeoIPService:
+    """
+    IP → 地理位置 (播放通知用)
+    依次查：内存 LRU → 旁路库 geoip_cache 表 → 离线库 (geoip_db_path 指定的 MaxMind .mmdb，整库读入内存)
+    都没有时才交给后台线程走 ip-api 在线查询，通知线程只短暂等待，不会被外网拖慢
+    """
+    def __init__(self):
+        self.running = False
+        self.thread = None
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()
+        self._schema_ready = False
+        self._reader = None
+        self._reader_path = None
+        self._reader_retry_at = 0
+        self._pending = {}
+        self._queue = deque()
+        self._wake = threading.Event()
+        self._bucket = TokenBucket(GEOIP_ONLINE_RATE, GEOIP_ONLINE_BURST)
+        self._stats = {"lru_hits": 0, "db_hits": 0, "offline_hits": 0, "online_lookups": 0, "online_failed": 0,
+                       "online_timeouts": 0, "unknown": 0}
+
+    def _ensure_schema(self):
+        if self._schema_ready: return
+        with sidecar_pool.writer() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS geoip_cache (Ip TEXT PRIMARY KEY, Location TEXT, Source TEXT, UpdatedAt REAL)")
+        self._schema_ready = True
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        self.thread = threading.Thread(target=self._online_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    # ---------- 查询 ----------
+    @staticmethod
+    def normalize(ip):
+        """RemoteEndPoint 可能带端口 ("1.2.3.4:5678" / "[::1]:8096") 或 IPv4 映射前缀，统一成纯 IP；非法返回 None"""
+        if not ip: return None
+        ip = str(ip).strip()
+        if ip.startswith("["): ip = ip[1:].split("]", 1)[0]
+        elif ip.count(":") == 1: ip = ip.split(":", 1)[0]
+        try: addr = ipaddress.ip_address(ip)
+        except ValueError: return None
+        if addr.version == 6 and addr.ipv4_mapped: addr = addr.ipv4_mapped
+        return str(addr)
+
+    def lookup(self, ip, wait=GEOIP_ONLINE_WAIT):
+        ip = self.normalize(ip)
+        if not ip: return LOCATION_UNKNOWN
+        addr = ipaddress.ip_address(ip)
+        if addr.is_loopback or addr.is_unspecified: return LOCATION_LOCAL
+        if addr.is_private or addr.is_link_local: return LOCATION_LAN
+
+        with self._lock:
+            loc = self._lru.get(ip)
+            if loc is not None:
+                self._lru.move_to_end(ip)
+                self._stats["lru_hits"] += 1
+                return loc
+
+        loc = self._from_db(ip)
+        if loc is None: loc = self._from_offline(ip)
+        if loc is None: loc = self._from_online(ip, wait)
+        if loc is None or loc == LOCATION_UNKNOWN:
+            with self._lock: self._stats["unknown"] += 1
+            return LOCATION_UNKNOWN
+        self._remember(ip, loc)
+        return loc
+
+    def _remember(self, ip, loc):
+        with self._lock:
+            self._lru[ip] = loc
+            self._lru.move_to_end(ip)
+            while len(self._lru) > GEOIP_LRU_SIZE: self._lru.popitem(last=False)
+
+    def _from_db(self, ip):
+        try:
+            self._ensure_schema()
+            row = query_sidecar("SELECT Location, Source, UpdatedAt FROM geoip_cache WHERE Ip = ?", (ip,), one=True)
+        except Exception as e:
+            logger.error(f"GeoIP Cache Error: {e}")
+            return None
+        if not row: return None
+        ttl = GEOIP_RETRY_AFTER if row['Source'] == "failed" else GEOIP_CACHE_TTL
+        if time.time() - row['UpdatedAt'] > ttl: return None
+        with self._lock: self._stats["db_hits"] += 1
+        return row['Location']
+
+    def _store(self, ip, loc, source):
+        try:
+            self._ensure_schema()
+            query_sidecar("INSERT OR REPLACE INTO geoip_cache (Ip, Location, Source, UpdatedAt) VALUES (?, ?, ?, ?)", (ip, loc, source, time.time()))
+        except Exception as e: logger.error(f"GeoIP Cache Error: {e}")
+
+    # ---------- 离线库 ----------
+    def _get_reader(self):
+        path = cfg.get("geoip_db_path")
+        if not path or not HAS_MAXMIND: return None
+        with self._lock:
+            if self._reader_path == path:
+                if self._reader is not None or time.time() < self._reader_retry_at: return self._reader
+            # 路径改了 (或首次使用、上次失败已过退避) 重新加载；MODE_MEMORY 把整库读进内存，查询不碰磁盘
+            try:
+                self._reader = maxminddb.open_database(path, maxminddb.MODE_MEMORY)
+                logger.info(f"🌐 GeoIP 离线库已加载: {path}")
+            except Exception as e:
+                logger.error(f"GeoIP 离线库加载失败 ({GEOIP_DB_RETRY}s 后重试): {e}")
+                self._reader = None
+                self._reader_retry_at = time.time() + GEOIP_DB_RETRY
+            self._reader_path = path
+            return self._reader
+
+    @staticmethod
+    def _name(node):
+        names = (node or {}).get("names") or {}
+        return names.get("zh-CN") or names.get("en") or ""
+
+    def _from_offline(self, ip):
+        reader = self._get_reader()
+        if not reader: return None
+        try: rec = reader.get(ip)
+        except Exception: return None
+        if not rec: return None
+        subdivisions = rec.get("subdivisions") or [{}]
+        parts = [self._name(rec.get("country")), self._name(subdivisions[0]), self._name(rec.get("city"))]
+        loc = " ".join(p for p in parts if p)
+        if not loc: return None
+        with self._lock: self._stats["offline_hits"] += 1
+        # 离线库本身就在内存里，不必写旁路库
+        return loc
+
+    # ---------- 在线兜底 ----------
+    def _from_online(self, ip, wait):
+        if not self.running or not cfg.get("geoip_online"): return None
+        with self._lock:
+            done = self._pending.get(ip)
+            if done is None:
+                if len(self._queue) >= GEOIP_ONLINE_QUEUE_MAX: return None
+                done = self._pending[ip] = threading.Event()
+                self._queue.append(ip)
+                self._wake.set()
+        if wait and done.wait(wait):
+            with self._lock: loc = self._lru.get(ip)
+            return loc
+        with self._lock: self._stats["online_timeouts"] += 1
+        return None
+
+    def _online_loop(self):
+        session = requests.Session()
+        while self.running:
+            self._wake.clear()
+            with self._lock: ip = self._queue.popleft() if self._queue else None
+            if ip is None:
+                self._wake.wait(5)
+                continue
+            self._bucket.acquire()
+            loc = self._fetch(session, ip)
+            if loc:
+                self._remember(ip, loc)
+                self._store(ip, loc, "online")
+            with self._lock:
+                done = self._pending.pop(ip, None)
+            if done: done.set()
+
+    def _fetch(self, session, ip):
+        with self._lock: self._stats["online_lookups"] += 1
+        try:
+            res = session.get(f"http://ip-api.com/json/{ip}?lang=zh-CN", timeout=5)
+            if res.status_code == 200:
+                d = res.json()
+                if d.get('status') == 'success':
+                    return f"{d.get('country')} {d.get('regionName')} {d.get('city')}"
+        except Exception as e:
+            logger.warning(f"GeoIP 在线查询失败 {ip}: {e}")
+        with self._lock: self._stats["online_failed"] += 1
+        # 失败结果短期缓存，避免同一个 IP 每次通知都排队打外网
+        self._store(ip, LOCATION_UNKNOWN, "failed")
+        return None
+
+    def get_stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["lru_size"] = len(self._lru)
+            s["online_queue"] = len(self._queue)
+            s["offline_db"] = bool(self._reader)
+        s["maxminddb_installed"] = HAS_MAXMIND
+        return s
+
+geoip = GeoIPService()
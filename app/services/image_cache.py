@@ -0,0 +1,214 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import logging
+from fastapi import Response
+from fastapi.responses import FileResponse
+from app.core.config import cfg, CONFIG_DIR
+from app.core.database import query_sidecar, sidecar_pool, run_db
+
+logger = logging.getLogger("uvicorn")
+
+IMAGE_CACHE_DIR = os.path.join(CONFIG_DIR, "image_cache")
+# 没有 tag 的图片 (内容可能变化) 的有效期 (秒)，带 tag 的图片内容不变，只受 LRU 淘汰
+IMAGE_UNTAGGED_TTL = 86400
+IMAGE_IMMUTABLE_AGE = 31536000
+# 访问时间攒够这么多条再批量写回索引
+TOUCH_FLUSH_SIZE = 64
+# 超过上限后淘汰到上限的这个比例，避免每次写入都触发淘汰
+EVICT_TARGET = 0.9
+CHUNK_SIZE = 64 * 1024
+
+class ImageCache:
+    """
+    磁盘图片缓存 (按内容寻址)
+    文件以内容 sha256 命名存放在 /app/config/image_cache，索引 (缓存键 → 文件) 在旁路库里，
+    总大小超过 image_cache_max_mb 时按最近访问时间淘汰
+    """
+    def __init__(self, root=IMAGE_CACHE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._total_bytes = 0
+        self._touched = {}
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _ensure_schema(self):
+        if self._schema_ready: return
+        with self._lock:
+            if self._schema_ready: return
+            os.makedirs(self.root, exist_ok=True)
+            with sidecar_pool.writer() as conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS image_cache (
+                                    CacheKey TEXT PRIMARY KEY, Digest TEXT, Size INTEGER,
+                                    ContentType TEXT, Tagged INTEGER, CreatedAt REAL, LastAccess REAL
+                                )""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_image_cache_access ON image_cache (LastAccess)")
+            res = query_sidecar("SELECT SUM(Size) as s FROM (SELECT DISTINCT Digest, Size FROM image_cache)", one=True)
+            self._total_bytes = (res['s'] or 0) if res else 0
+            self._schema_ready = True
+
+    @staticmethod
+    def make_key(*parts):
+        return ":".join(str(p) if p is not None else "" for p in parts)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        """命中返回条目 dict，未命中/已过期返回 None"""
+        self._ensure_schema()
+        row = query_sidecar("SELECT * FROM image_cache WHERE CacheKey = ?", (key,), one=True)
+        now = time.time()
+        fresh = row and (row['Tagged'] or now - row['CreatedAt'] < IMAGE_UNTAGGED_TTL)
+        if fresh and not os.path.exists(self._path(row['Digest'])):
+            # 文件被手动清理过，索引作废
+            query_sidecar("DELETE FROM image_cache WHERE CacheKey = ?", (key,))
+            fresh = False
+        with self._lock:
+            self._stats["hits" if fresh else "misses"] += 1
+            if fresh: self._touched[key] = now
+            flush = len(self._touched) >= TOUCH_FLUSH_SIZE
+        if flush: self._flush_touches()
+        return dict(row) if fresh else None
+
+    def read(self, entry):
+        """读出缓存文件的内容 (给需要字节而不是 HTTP 响应的调用方，如 Telegram 上传)"""
+        try:
+            with open(self._path(entry["Digest"]), "rb") as f: return f.read()
+        except OSError: return None
+
+    def put(self, key, resp, tagged=False):
+        """
+        把 Emby 的流式响应边下载边写入临时文件并计算摘要，完成后原子改名
+        返回条目 dict；非图片或下载失败返回 None
+        """
+        try:
+            return self.store(key, resp.headers.get("Content-Type", "image/jpeg"), resp.iter_content(CHUNK_SIZE), tagged)
+        finally:
+            resp.close()
+
+    async def aput(self, key, resp, tagged=False):
+        """
+        put() 的异步版本 (async 路由用 httpx 流式拉取)：边收边写临时文件，
+        改名和写索引放到数据库线程里做；调用方不用再把整张图读进内存
+        """
+        try:
+            content_type = resp.headers.get("Content-Type") or "image/jpeg"
+            if not content_type.startswith("image/"): return None
+            await run_db(self._ensure_schema)
+            digest = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    async for chunk in resp.aiter_bytes(CHUNK_SIZE):
+                        digest.update(chunk)
+                        size += len(chunk)
+                        f.write(chunk)
+                if size == 0: return None
+                return await run_db(self._commit, key, tmp_path, digest.hexdigest(), size, content_type, tagged)
+            except Exception as e:
+                logger.error(f"Image Cache Write Error: {e}")
+                return None
+            finally:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+        finally:
+            await resp.aclose()
+
+    def store(self, key, content_type, chunks, tagged=False):
+        self._ensure_schema()
+        if not content_type.startswith("image/"): return None
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    if not chunk: continue
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            if size == 0: return None
+            return self._commit(key, tmp_path, digest.hexdigest(), size, content_type, tagged)
+        except Exception as e:
+            logger.error(f"Image Cache Write Error: {e}")
+            return None
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    def _commit(self, key, tmp_path, hexdigest, size, content_type, tagged):
+        """临时文件按摘要改名 (内容相同的文件只留一份) 并写索引"""
+        path = self._path(hexdigest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        is_new_file = not os.path.exists(path)
+        if is_new_file: os.replace(tmp_path, path)
+
+        now = time.time()
+        old = query_sidecar("SELECT Digest FROM image_cache WHERE CacheKey = ?", (key,), one=True)
+        query_sidecar("INSERT OR REPLACE INTO image_cache (CacheKey, Digest, Size, ContentType, Tagged, CreatedAt, LastAccess) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                      (key, hexdigest, size, content_type, 1 if tagged else 0, now, now))
+        if old and old['Digest'] != hexdigest: self._drop_orphans([old['Digest']])
+        with self._lock:
+            self._stats["stores"] += 1
+            if is_new_file: self._total_bytes += size
+            over = self._total_bytes > self._max_bytes()
+        if over: self._evict()
+        return {"CacheKey": key, "Digest": hexdigest, "Size": size, "ContentType": content_type, "Tagged": 1 if tagged else 0}
+
+    def _max_bytes(self):
+        return int(cfg.get("image_cache_max_mb") or 512) * 1024 * 1024
+
+    def _flush_touches(self):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if not touched: return
+        with sidecar_pool.writer() as conn:
+            conn.executemany("UPDATE image_cache SET LastAccess = ? WHERE CacheKey = ?", [(t, k) for k, t in touched.items()])
+
+    def _drop_orphans(self, digests):
+        """删除已经没有任何缓存键引用的文件"""
+        freed = 0
+        for d in set(digests):
+            if query_sidecar("SELECT 1 FROM image_cache WHERE Digest = ? LIMIT 1", (d,), one=True): continue
+            path = self._path(d)
+            try:
+                freed += os.path.getsize(path)
+                os.remove(path)
+            except OSError: pass
+        with self._lock: self._total_bytes = max(0, self._total_bytes - freed)
+
+    def _evict(self):
+        self._flush_touches()
+        target = self._max_bytes() * EVICT_TARGET
+        while True:
+            with self._lock:
+                if self._total_bytes <= target: return
+            rows = query_sidecar("SELECT CacheKey, Digest FROM image_cache ORDER BY LastAccess LIMIT 100")
+            if not rows: return
+            with sidecar_pool.writer() as conn:
+                conn.executemany("DELETE FROM image_cache WHERE CacheKey = ?", [(r['CacheKey'],) for r in rows])
+            with self._lock: self._stats["evictions"] += len(rows)
+            self._drop_orphans([r['Digest'] for r in rows])
+
+    def get_stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["bytes"] = self._total_bytes
+        s["max_bytes"] = self._max_bytes()
+        total = s["hits"] + s["misses"]
+        s["hit_rate"] = round(s["hits"] / total, 3) if total else 0
+        return s
+
+    def respond(self, entry, request):
+        """强 ETag (内容摘要) + 长缓存；浏览器带 If-None-Match 命中时直接 304"""
+        etag = f'"{entry["Digest"]}"'
+        max_age = IMAGE_IMMUTABLE_AGE if entry["Tagged"] else IMAGE_UNTAGGED_TTL
+        headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}" + (", immutable" if entry["Tagged"] else "")}
+        if etag in (request.headers.get("if-none-match") or ""):
+            return Response(status_code=304, headers=headers)
+        return FileResponse(self._path(entry["Digest"]), media_type=entry["ContentType"], headers=headers)
+
+image_cache = ImageCache()
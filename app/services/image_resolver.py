@@ -0,0 +1,176 @@
+import time
+import asyncio
+import threading
+import logging
+from app.core.emby import emby
+from app.core.database import query_sidecar, sidecar_pool, run_db
+
+logger = logging.getLogger("uvicorn")
+
+# 映射有效期 (秒)：条目的归属剧集基本不会变，解析失败的结果也缓存，避免反复三连查
+RESOLVE_TTL = 30 * 86400
+NEGATIVE_TTL = 86400
+# 批量解析时单次 Items?Ids= 的 ID 数量上限 (避免 URL 过长)
+RESOLVE_BATCH = 100
+# 批量接口漏掉的 ID 逐个兜底：单次请求最多兜底这么多个，同时最多这么多个并发
+RESOLVE_FALLBACK_MAX = 20
+RESOLVE_FALLBACK_CONCURRENCY = 4
+
+class ImageIdResolver:
+    """
+    条目 ID → 封面 ID 映射 (单集/季 → 剧集)
+    内存 dict + 旁路库持久化，未命中才向 Emby 查询
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._memo = {}
+        self._schema_ready = False
+        self._stats = {"hits": 0, "misses": 0, "lookups": 0, "batch_lookups": 0}
+
+    def _ensure_schema(self):
+        if self._schema_ready: return
+        with sidecar_pool.writer() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS image_id_map (
+                                ItemId TEXT PRIMARY KEY, ImageId TEXT, ImageTag TEXT,
+                                Resolved INTEGER, UpdatedAt REAL
+                            )""")
+        self._schema_ready = True
+
+    @staticmethod
+    def _fresh(entry, now):
+        ttl = RESOLVE_TTL if entry["resolved"] else NEGATIVE_TTL
+        return now - entry["updated_at"] < ttl
+
+    def _lookup(self, item_ids):
+        """先查内存再查旁路库，返回 {item_id: entry} (只包含未过期的)"""
+        now = time.time()
+        found = {}
+        with self._lock:
+            for iid in item_ids:
+                entry = self._memo.get(iid)
+                if entry and self._fresh(entry, now): found[iid] = entry
+        missing = [iid for iid in item_ids if iid not in found]
+        if missing:
+            self._ensure_schema()
+            placeholders = ','.join(['?'] * len(missing))
+            rows = query_sidecar(f"SELECT * FROM image_id_map WHERE ItemId IN ({placeholders})", missing) or []
+            with self._lock:
+                for r in rows:
+                    entry = {"image_id": r['ImageId'], "tag": r['ImageTag'], "resolved": bool(r['Resolved']), "updated_at": r['UpdatedAt']}
+                    if not self._fresh(entry, now): continue
+                    self._memo[r['ItemId']] = entry
+                    found[r['ItemId']] = entry
+        with self._lock:
+            self._stats["hits"] += len(found)
+            self._stats["misses"] += len(item_ids) - len(found)
+        return found
+
+    def _store(self, results):
+        """results: {item_id: (image_id, tag, resolved)}"""
+        if not results: return
+        now = time.time()
+        self._ensure_schema()
+        with sidecar_pool.writer() as conn:
+            conn.executemany("INSERT OR REPLACE INTO image_id_map (ItemId, ImageId, ImageTag, Resolved, UpdatedAt) VALUES (?, ?, ?, ?, ?)",
+                             [(iid, img, tag, 1 if ok else 0, now) for iid, (img, tag, ok) in results.items()])
+        with self._lock:
+            for iid, (img, tag, ok) in results.items():
+                self._memo[iid] = {"image_id": img, "tag": tag, "resolved": ok, "updated_at": now}
+
+    # ---------- 对外接口 ----------
+    async def aresolve_many(self, item_ids):
+        """
+        批量解析：未命中的部分合并成 Items?Ids=a,b,c 一次查询，缓存读写走 db_executor
+        批量接口没返回的 ID 再逐个走详情/祖先查询，都失败才按失败缓存
+        返回 {item_id: {"image_id": ..., "tag": ...}}
+        """
+        item_ids = list(dict.fromkeys(i for i in item_ids if i))
+        found = await run_db(self._lookup, item_ids)
+        missing = [iid for iid in item_ids if iid not in found]
+        for i in range(0, len(missing), RESOLVE_BATCH):
+            chunk = missing[i:i + RESOLVE_BATCH]
+            if not emby.is_configured(): break
+            with self._lock: self._stats["batch_lookups"] += 1
+            try:
+                res = await emby.aget("/emby/Items", params={"Ids": ",".join(chunk), "Fields": "SeriesId,ParentId,SeriesPrimaryImageTag", "Recursive": "true"}, timeout=10)
+                if res.status_code != 200: continue
+                results = self._parse_batch(res.json().get("Items", []))
+            except Exception as e:
+                logger.error(f"Image Id Batch Resolve Error: {e}")
+                continue
+            leftovers = [iid for iid in chunk if iid not in results]
+            if leftovers: results.update(await self._aresolve_leftovers(leftovers))
+            await run_db(self._store, results)
+            found.update(await run_db(self._lookup, chunk))
+        return {iid: {"image_id": e["image_id"], "tag": e["tag"]} for iid, e in found.items()}
+
+    async def aresolve(self, item_id):
+        """单个解析 (图片代理用)，解析失败时返回原 ID"""
+        entry = (await self.aresolve_many([item_id])).get(item_id)
+        return entry["image_id"] if entry else item_id
+
+    def get_stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["memo_size"] = len(self._memo)
+        return s
+
+    # ---------- Emby 查询 ----------
+    @staticmethod
+    def _parse_batch(items):
+        results = {}
+        for item in items:
+            iid = item.get("Id")
+            if item.get("SeriesId"):
+                results[iid] = (item["SeriesId"], item.get("SeriesPrimaryImageTag"), True)
+            elif item.get("Type") == "Episode" and item.get("ParentId"):
+                results[iid] = (item["ParentId"], None, True)
+            else:
+                # 电影等条目自己就是封面
+                results[iid] = (iid, (item.get("ImageTags") or {}).get("Primary"), True)
+        return results
+
+    async def _aresolve_leftovers(self, item_ids):
+        """批量接口没返回的 ID (权限/层级问题) 并发逐个兜底，并发数受限"""
+        sem = asyncio.Semaphore(RESOLVE_FALLBACK_CONCURRENCY)
+        async def one(iid):
+            async with sem:
+                image_id, resolved = await self._aresolve_remote(iid)
+                return iid, (image_id, None, resolved)
+        return dict(await asyncio.gather(*(one(iid) for iid in item_ids[:RESOLVE_FALLBACK_MAX])))
+
+    async def _aresolve_remote(self, item_id):
+        """
+        单个条目兜底解析
+        依次尝试详情接口、祖先链，返回 (封面ID, 是否解析成功)
+        """
+        with self._lock: self._stats["lookups"] += 1
+
+        # 方案 A: 标准查询 (查询单集详情)
+        try:
+            res_a = await emby.aget(f"/emby/Items/{item_id}", params={"Fields": "SeriesId,ParentId"}, timeout=3)
+            if res_a.status_code == 200:
+                data = res_a.json()
+                if data.get("SeriesId"): return data['SeriesId'], True
+                if data.get("Type") == "Episode" and data.get("ParentId"): return data['ParentId'], True
+                if data.get("Type") not in ("Episode", "Season"):
+                    # 电影/剧集本身就有封面，不必继续查祖先
+                    return item_id, True
+        except Exception as e: logger.debug(f"Image Id Resolve (detail) Error {item_id}: {e}")
+
+        # 方案 B: 祖先查询 (查询父级链) -> 专门解决权限/层级问题
+        try:
+            res_b = await emby.aget(f"/emby/Items/{item_id}/Ancestors", timeout=3)
+            if res_b.status_code == 200:
+                # 祖先列表通常是从近到远 [Season, Series, ...]
+                for ancestor in res_b.json():
+                    if ancestor.get("Type") == "Series": return ancestor['Id'], True
+                    if ancestor.get("Type") == "Season" and not ancestor.get("SeriesId"):
+                        # 如果只有季ID，先拿着
+                        return ancestor['Id'], True
+        except Exception as e: logger.debug(f"Image Id Resolve (ancestors) Error {item_id}: {e}")
+
+        logger.warning(f"❌ 无法解析 {item_id} 的 SeriesId (请检查 API Key 权限)")
+        return item_id, False
+
+image_resolver = ImageIdResolver()
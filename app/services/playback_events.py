@@ -0,0 +1,145 @@
+import time
+import datetime
+import threading
+import logging
+from app.core.database import query_db, query_sidecar, sidecar_pool, get_base_filter
+
+logger = logging.getLogger("uvicorn")
+
+# 收到 start 却一直没有 stop 的播放，超过这个时长视为丢失的会话
+PLAYBACK_OPEN_MAX = 6 * 3600
+# 已 stop 的播放最多再算这么久 (秒)：插件通常 stop 后立即落库，过了这段时间仍没有记录说明插件不会写 (如播放太短)
+PLAYBACK_STOPPED_GRACE = 600
+# 只在这段时间内的播放里找插件尚未落库的部分 (更早的要么已落库，要么已超过上面两个时限)
+PLAYBACK_LIVE_WINDOW = PLAYBACK_OPEN_MAX + PLAYBACK_STOPPED_GRACE
+# 事件表只追加，定期清理这个时间之前的记录
+PLAYBACK_EVENTS_RETENTION = 30 * 86400
+PLAYBACK_PRUNE_INTERVAL = 3600
+
+class PlaybackEventStore:
+    """
+    Webhook 播放事件的本地追加表 (旁路库 playback_events)
+    插件按自己的节奏写 PlaybackActivity，统计会滞后于实际播放。
+    每条 start 事件记下当时插件的 MAX(rowid) 作为水位线：只要插件在水位线之后还没有
+    同一用户 + 同一条目的记录，这次播放就是 "实时" 的，可以并入今天的统计。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._last_prune = 0
+        self._stats = {"recorded": 0}
+
+    def _ensure_schema(self):
+        if self._schema_ready: return
+        with sidecar_pool.writer() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS playback_events (
+                                Id INTEGER PRIMARY KEY AUTOINCREMENT, Event TEXT, SessionKey TEXT,
+                                UserId TEXT, ItemId TEXT, ItemName TEXT, ItemType TEXT,
+                                DeviceName TEXT, ClientName TEXT, RunTimeTicks INTEGER,
+                                PluginRowid INTEGER, DateCreated TEXT, ReceivedAt REAL, DedupKey TEXT
+                            )""")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_playback_events_dedup ON playback_events (DedupKey)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_playback_events_time ON playback_events (ReceivedAt)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_playback_events_session ON playback_events (SessionKey, Id)")
+        self._schema_ready = True
+
+    @staticmethod
+    def _item_name(item):
+        """与插件一致的命名：剧集为 "剧名 - S01E02 - 标题"，便于 clean_item_name 聚合"""
+        name = item.get("Name", "")
+        if item.get("SeriesName"):
+            return f"{item['SeriesName']} - S{str(item.get('ParentIndexNumber', 1)).zfill(2)}E{str(item.get('IndexNumber', 0)).zfill(2)} - {name}"
+        return name
+
+    @staticmethod
+    def dedup_key(data, action):
+        """同一条 Webhook 重试时 payload 不变，按 播放会话 + 条目 + 动作 + 事件时间 去重"""
+        play_session = (data.get("PlaybackInfo") or {}).get("PlaySessionId") or (data.get("Session") or {}).get("Id", "")
+        return f"{play_session}:{(data.get('Item') or {}).get('Id', '')}:{action}:{data.get('Date', '')}"
+
+    def record(self, data, action):
+        """记录一条 playback.start / playback.stop Webhook；同一事件重复投递 (队列重试) 只记一次"""
+        user = data.get("User", {})
+        item = data.get("Item", {})
+        session = data.get("Session", {})
+        if not user.get("Id") or not item.get("Id"): return
+        self._ensure_schema()
+        key = self.dedup_key(data, action)
+        if query_sidecar("SELECT 1 FROM playback_events WHERE DedupKey = ?", (key,), one=True): return
+        watermark = None
+        if action == "start":
+            res = query_db("SELECT MAX(rowid) as m FROM PlaybackActivity", one=True)
+            watermark = (res['m'] or 0) if res else 0
+        now = time.time()
+        query_sidecar("""INSERT OR IGNORE INTO playback_events (Event, SessionKey, UserId, ItemId, ItemName, ItemType, DeviceName, ClientName,
+                                                                RunTimeTicks, PluginRowid, DateCreated, ReceivedAt, DedupKey)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                      (action, f"{session.get('Id', '')}:{item['Id']}", user['Id'], item['Id'], self._item_name(item), item.get("Type"),
+                       session.get("DeviceName"), session.get("Client"), item.get("RunTimeTicks"), watermark,
+                       datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), now, key))
+        with self._lock:
+            self._stats["recorded"] += 1
+            prune = now - self._last_prune > PLAYBACK_PRUNE_INTERVAL
+            if prune: self._last_prune = now
+        if prune: query_sidecar("DELETE FROM playback_events WHERE ReceivedAt < ?", (now - PLAYBACK_EVENTS_RETENTION,))
+
+    def get_live_plays(self, user_id=None, since=None, until=None):
+        """
+        插件尚未落库的播放 (进行中 + 已结束未同步)
+        返回 [{DateCreated, UserId, ItemId, ItemName, ItemType, DeviceName, ClientName, PlayDuration, InProgress}]，按时间倒序
+        since / until 为 'YYYY-MM-DD HH:MM:SS' 字符串 (与插件 DateCreated 同格式)
+        """
+        self._ensure_schema()
+        now = time.time()
+        where, params = get_base_filter(user_id, alias="s")
+        where += " AND s.Event = 'start' AND s.ReceivedAt > ?"
+        params.append(now - PLAYBACK_LIVE_WINDOW)
+        if since:
+            where += " AND s.DateCreated >= ?"
+            params.append(since)
+        if until:
+            where += " AND s.DateCreated < ?"
+            params.append(until)
+        rows = query_sidecar(f"""SELECT s.*, (SELECT MIN(e.ReceivedAt) FROM playback_events e
+                                             WHERE e.SessionKey = s.SessionKey AND e.Event = 'stop' AND e.Id > s.Id) AS StoppedAt
+                                 FROM playback_events s {where} ORDER BY s.Id DESC""", params) or []
+        if not rows: return []
+
+        # 一次查询取出最早水位线之后插件新增的记录，用于判断哪些播放已经落库
+        # 只查这些播放涉及的用户和条目，不把一整天的插件记录拉进来
+        min_rowid = min(r['PluginRowid'] or 0 for r in rows)
+        users = sorted({r['UserId'] for r in rows})
+        items = sorted({r['ItemId'] for r in rows})
+        flushed = query_db(f"""SELECT rowid as rid, UserId, ItemId FROM PlaybackActivity
+                               WHERE rowid > ? AND UserId IN ({','.join(['?'] * len(users))}) AND ItemId IN ({','.join(['?'] * len(items))})""",
+                           [min_rowid] + users + items) or []
+        synced = {}
+        for f in flushed:
+            key = (f['UserId'], f['ItemId'])
+            synced[key] = max(synced.get(key, 0), f['rid'])
+
+        plays = []
+        for r in rows:
+            if synced.get((r['UserId'], r['ItemId']), 0) > (r['PluginRowid'] or 0): continue
+            in_progress = r['StoppedAt'] is None
+            if in_progress and now - r['ReceivedAt'] > PLAYBACK_OPEN_MAX: continue
+            if not in_progress and now - r['StoppedAt'] > PLAYBACK_STOPPED_GRACE: continue
+            duration = (r['StoppedAt'] or now) - r['ReceivedAt']
+            if r['RunTimeTicks']: duration = min(duration, r['RunTimeTicks'] / 10_000_000)
+            plays.append({
+                "DateCreated": r['DateCreated'], "UserId": r['UserId'], "ItemId": r['ItemId'],
+                "ItemName": r['ItemName'], "ItemType": r['ItemType'],
+                "DeviceName": r['DeviceName'], "ClientName": r['ClientName'],
+                "PlayDuration": int(duration), "InProgress": in_progress,
+            })
+        return plays
+
+    def get_stats(self):
+        with self._lock: s = dict(self._stats)
+        try:
+            self._ensure_schema()
+            s["live_plays"] = len(self.get_live_plays('all'))
+        except Exception: pass
+        return s
+
+playback_store = PlaybackEventStore()
@@ -0,0 +1,413 @@
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+from app.core.emby import emby
+from app.core.database import query_sidecar, sidecar_pool
+
+logger = logging.getLogger("uvicorn")
+
+# 分页扫描：每页条数与同时在途的页数 (峰值内存 ≈ 页大小 × 在途页数)
+QUALITY_PAGE_SIZE = 500
+QUALITY_INFLIGHT = 3
+QUALITY_PAGE_TIMEOUT = 30
+# 后台增量同步间隔；全量重扫 (清理已删除条目) 间隔
+QUALITY_SYNC_INTERVAL = 600
+QUALITY_FULL_INTERVAL = 86400
+# 入库 Webhook 到达后稍等一会再同步 (等 Emby 完成媒体探测，也顺便合并同一批入库)
+QUALITY_WEBHOOK_DELAY = 30
+# 只取统计需要的字段
+SCAN_FIELDS = "MediaSources,Path,MediaStreams"
+# 参与盘点的媒体库类型 (None 为混合库)
+SCAN_COLLECTION_TYPES = {"movies", "tvshows", "mixed", "homevideos", None, ""}
+BAD_QUALITY_LIMIT = 100
+# 每部剧附带的最差单集数量
+WORST_EPISODES = 3
+
+QUALITY_COLUMNS = ["ItemId", "ItemType", "Name", "SeriesName", "Year", "LibraryId", "LibraryName",
+                   "Width", "Height", "Resolution", "Codec", "HdrType", "Bitrate", "Path", "ScanId", "UpdatedAt",
+                   "SeriesId", "SeasonNumber", "EpisodeNumber"]
+# 旧版索引缺少的剧集列 (升级时补齐并触发一次全量重扫)
+EPISODE_COLUMNS = [("SeriesId", "TEXT"), ("SeasonNumber", "INTEGER"), ("EpisodeNumber", "INTEGER")]
+ITEM_TYPES = {"movie": "Movie", "episode": "Episode"}
+# 剧集列表可排序字段 -> SQL 表达式
+SERIES_SORTS = {
+    "name": "SeriesName",
+    "episodes": "episodes",
+    "hevc": "hevc_pct",
+    "hdr": "hdr_pct",
+    "sd": "sd_count",
+    "quality": "avg_width",
+}
+# 画质从差到好的排序 (分辨率宽度优先，其次码率)
+WORST_ORDER = "COALESCE(Width, 0), COALESCE(Bitrate, 0)"
+
+def classify_item(item):
+    """从条目的首个视频流提取画质信息，没有视频流时各项为 None"""
+    info = {"Width": None, "Height": None, "Resolution": None, "Codec": None, "HdrType": None, "Bitrate": None}
+    # 安全检查：确保 item 包含 MediaSources
+    media_sources = item.get("MediaSources")
+    if not media_sources or not isinstance(media_sources, list):
+        return info
+
+    source = media_sources[0]
+    media_streams = source.get("MediaStreams")
+    if not media_streams:
+        return info
+
+    # 找到视频流 (Type=Video)
+    video_stream = next((s for s in media_streams if s.get("Type") == "Video"), None)
+    if not video_stream:
+        return info
+
+    # --- A. 分辨率 ---
+    width = video_stream.get("Width", 0)
+    if width >= 3800: resolution = "4k"
+    elif width >= 1900: resolution = "1080p"
+    elif width >= 1200: resolution = "720p"
+    else: resolution = "sd"
+
+    # --- B. 编码格式 ---
+    codec = video_stream.get("Codec", "").lower()
+    if "hevc" in codec or "h265" in codec: codec_type = "hevc"
+    elif "h264" in codec or "avc" in codec: codec_type = "h264"
+    elif "av1" in codec: codec_type = "av1"
+    else: codec_type = "other"
+
+    # --- C. HDR/杜比视界 ---
+    video_range = video_stream.get("VideoRange", "").lower()
+    display_title = video_stream.get("DisplayTitle", "").lower()
+    if "dolby" in display_title or "dv" in display_title or "dolby" in video_range: hdr = "dolby_vision"
+    elif "hdr" in video_range or "hdr" in display_title or "pq" in video_range: hdr = "hdr10"
+    else: hdr = "sdr"
+
+    info.update({"Width": width, "Height": video_stream.get("Height"), "Resolution": resolution,
+                 "Codec": codec_type, "HdrType": hdr, "Bitrate": source.get("Bitrate") or video_stream.get("BitRate")})
+    return info
+
+class QualityService:
+    """
+    媒体库质量索引
+    每个条目的分辨率/编码/HDR/码率/路径持久化在旁路库 media_quality 表，
+    后台按 MinDateLastSaved 增量同步 (入库 Webhook 会提前唤醒)，每天全量重扫一次清理已删除条目，
+    洞察接口直接用 SQL 聚合索引
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.ready = False
+        self.last_sync_time = 0
+        self.last_full_time = 0
+        self.progress = {"running": False, "full": False, "manual": False, "scanned": 0, "total": 0, "started_at": 0, "error": None}
+
+    # ---------- 生命周期 ----------
+    def start(self):
+        if self.running: return
+        self.init_schema()
+        self.running = True
+        self.thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def init_schema(self):
+        try:
+            with sidecar_pool.writer() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("""CREATE TABLE IF NOT EXISTS media_quality (
+                                    ItemId TEXT PRIMARY KEY, ItemType TEXT, Name TEXT, SeriesName TEXT, Year INTEGER,
+                                    LibraryId TEXT, LibraryName TEXT,
+                                    Width INTEGER, Height INTEGER, Resolution TEXT, Codec TEXT, HdrType TEXT, Bitrate INTEGER,
+                                    Path TEXT, ScanId TEXT, UpdatedAt REAL,
+                                    SeriesId TEXT, SeasonNumber INTEGER, EpisodeNumber INTEGER
+                                )""")
+                existing = {r[1] for r in conn.execute("PRAGMA table_info(media_quality)").fetchall()}
+                migrated = False
+                for col, col_type in EPISODE_COLUMNS:
+                    if col not in existing:
+                        conn.execute(f"ALTER TABLE media_quality ADD COLUMN {col} {col_type}")
+                        migrated = True
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_media_quality_lib ON media_quality (ItemType, LibraryId)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_media_quality_series ON media_quality (SeriesId, SeasonNumber)")
+            state = {r['name']: r['value'] for r in (query_sidecar("SELECT name, value FROM sync_state WHERE name LIKE 'quality_%'") or [])}
+            self.ready = state.get("quality_ready") == "1"
+            self.last_sync_time = float(state.get("quality_sync_time") or 0)
+            # 刚补齐剧集列：旧索引里还没有单集，下一轮立即全量重扫 (电影统计照常可用)
+            self.last_full_time = 0 if migrated else float(state.get("quality_full_time") or 0)
+        except Exception as e:
+            logger.error(f"Quality Schema Error: {e}")
+
+    def _sync_loop(self):
+        while self.running:
+            try:
+                if emby.is_configured() and not self.is_running():
+                    full = not self.ready or time.time() - self.last_full_time > QUALITY_FULL_INTERVAL
+                    self._run_scan(full)
+            except Exception as e:
+                logger.error(f"Quality Sync Error: {e}")
+            woke = self._wake.wait(QUALITY_SYNC_INTERVAL)
+            if woke and self.running:
+                self._wake.clear()
+                time.sleep(QUALITY_WEBHOOK_DELAY)
+
+    def request_sync(self):
+        """入库 Webhook 调用：提前唤醒后台增量同步"""
+        self._wake.set()
+
+    # ---------- 状态 ----------
+    def is_running(self):
+        with self._lock: return self.progress["running"]
+
+    def get_progress(self):
+        with self._lock: return dict(self.progress)
+
+    def get_status(self):
+        return {"ready": self.ready, "last_sync_time": self.last_sync_time, "last_full_time": self.last_full_time, "progress": self.get_progress()}
+
+    # ---------- 扫描 ----------
+    def start_scan(self, full=True):
+        """手动触发 (强制刷新)：在后台线程启动一次扫描，已有扫描在进行时直接返回"""
+        if self.is_running(): return False
+        threading.Thread(target=self._run_scan, args=(full, True), daemon=True).start()
+        return True
+
+    def _run_scan(self, full, manual=False):
+        with self._lock:
+            if self.progress["running"]: return
+            self.progress = {"running": True, "full": full, "manual": manual, "scanned": 0, "total": 0, "started_at": time.time(), "error": None}
+        error = None
+        try:
+            logger.info(f"🔄 开始{'全量' if full else '增量'}同步媒体质量索引...")
+            self.scan(full)
+        except Exception as e:
+            error = str(e)
+            logger.error(f"质量盘点错误: {error}")
+        finally:
+            with self._lock:
+                self.progress["running"] = False
+                self.progress["error"] = error
+
+    def _get_libraries(self):
+        res = emby.get("/emby/Library/MediaFolders", timeout=10)
+        if res.status_code != 200:
+            raise RuntimeError(f"Emby API Error: {res.status_code}")
+        return [lib for lib in res.json().get("Items", []) if lib.get("CollectionType") in SCAN_COLLECTION_TYPES]
+
+    def _fetch_page(self, library_id, start, min_saved):
+        # 分页后单集也不再撑爆单个请求，电影与单集一起扫
+        params = {"Recursive": "true", "IncludeItemTypes": "Movie,Episode", "Fields": SCAN_FIELDS, "ParentId": library_id,
+                  "StartIndex": start, "Limit": QUALITY_PAGE_SIZE, "EnableImages": "false", "EnableUserData": "false"}
+        if min_saved: params["MinDateLastSaved"] = min_saved
+        res = emby.get("/emby/Items", params=params, timeout=QUALITY_PAGE_TIMEOUT)
+        if res.status_code != 200:
+            raise RuntimeError(f"Emby API Error: {res.status_code}")
+        return res.json()
+
+    def _store_page(self, library, page, scan_id):
+        items = page.get("Items", [])
+        now = time.time()
+        rows = []
+        for item in items:
+            info = classify_item(item)
+            rows.append((item.get("Id"), item.get("Type"), item.get("Name"), item.get("SeriesName", ""), item.get("ProductionYear"),
+                         library.get("Id"), library.get("Name"), info["Width"], info["Height"], info["Resolution"],
+                         info["Codec"], info["HdrType"], info["Bitrate"], item.get("Path"), scan_id, now,
+                         item.get("SeriesId"), item.get("ParentIndexNumber"), item.get("IndexNumber")))
+        if rows:
+            with sidecar_pool.writer() as conn:
+                conn.executemany(f"INSERT OR REPLACE INTO media_quality ({', '.join(QUALITY_COLUMNS)}) VALUES ({', '.join(['?'] * len(QUALITY_COLUMNS))})", rows)
+        with self._lock: self.progress["scanned"] += len(items)
+
+    def _scan_library(self, library, scan_id, min_saved):
+        first = self._fetch_page(library["Id"], 0, min_saved)
+        total = first.get("TotalRecordCount", 0)
+        with self._lock: self.progress["total"] += total
+        self._store_page(library, first, scan_id)
+        del first
+
+        starts = iter(range(QUALITY_PAGE_SIZE, total, QUALITY_PAGE_SIZE))
+        with ThreadPoolExecutor(max_workers=QUALITY_INFLIGHT) as executor:
+            # 滑动窗口：完成一页再补一页，在途页数始终不超过 QUALITY_INFLIGHT
+            pending = {executor.submit(self._fetch_page, library["Id"], s, min_saved) for _, s in zip(range(QUALITY_INFLIGHT), starts)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._store_page(library, future.result(), scan_id)
+                    nxt = next(starts, None)
+                    if nxt is not None: pending.add(executor.submit(self._fetch_page, library["Id"], nxt, min_saved))
+
+    def scan(self, full=True):
+        # 以本轮开始时间作为下一轮增量的水位线，扫描期间的改动下一轮还会再取到
+        started = time.time()
+        min_saved = None
+        if not full and self.last_sync_time:
+            min_saved = datetime.fromtimestamp(self.last_sync_time, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        scan_id = uuid.uuid4().hex
+        libraries = self._get_libraries()
+        for library in libraries:
+            self._scan_library(library, scan_id, min_saved)
+
+        state = [("quality_sync_time", str(started))]
+        with sidecar_pool.writer() as conn:
+            if full:
+                # 全量扫描没碰到的条目已被删除 (或所在媒体库已移除)
+                conn.execute("DELETE FROM media_quality WHERE ScanId != ?", (scan_id,))
+                state += [("quality_full_time", str(started)), ("quality_ready", "1")]
+            conn.executemany("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", state)
+        self.last_sync_time = started
+        if full:
+            self.last_full_time = started
+            self.ready = True
+        logger.info(f"✅ 媒体质量索引同步完成 ({self.get_progress()['scanned']} 条)")
+
+    # ---------- 聚合查询 ----------
+    def get_libraries(self):
+        return query_sidecar("SELECT LibraryId, LibraryName, COUNT(*) as Count FROM media_quality GROUP BY LibraryId ORDER BY LibraryName") or []
+
+    @staticmethod
+    def _filter(item_type="movie", library_id=None):
+        where = "WHERE ItemType = ?"
+        params = [ITEM_TYPES.get(item_type, "Movie")]
+        if library_id:
+            where += " AND LibraryId = ?"
+            params.append(library_id)
+        return where, params
+
+    def aggregate(self, library_id=None, item_type="movie"):
+        """按索引聚合出洞察页需要的统计结构 (item_type: movie / episode)"""
+        where, params = self._filter(item_type, library_id)
+
+        def counts(col, keys):
+            rows = query_sidecar(f"SELECT {col} as k, COUNT(*) as c FROM media_quality {where} AND {col} IS NOT NULL GROUP BY {col}", params) or []
+            data = {k: 0 for k in keys}
+            for r in rows: data[r['k']] = r['c']
+            return data
+
+        total = query_sidecar(f"SELECT COUNT(*) as c FROM media_quality {where}", params, one=True)
+        bad = self.get_bad_quality(1, BAD_QUALITY_LIMIT, item_type, library_id)
+        by_library = query_sidecar(f"""
+            SELECT LibraryId, LibraryName, COUNT(*) as total_count,
+                   SUM(Resolution = '4k') as r_4k, SUM(Resolution = '1080p') as r_1080p,
+                   SUM(Resolution = '720p') as r_720p, SUM(Resolution = 'sd') as r_sd,
+                   SUM(Codec = 'hevc') as c_hevc, SUM(Codec = 'h264') as c_h264, SUM(Codec = 'av1') as c_av1,
+                   SUM(HdrType IN ('hdr10', 'dolby_vision')) as hdr
+            FROM media_quality {where} GROUP BY LibraryId ORDER BY total_count DESC
+        """, params) or []
+        matrix = query_sidecar(f"""
+            SELECT Codec, Resolution, COUNT(*) as c FROM media_quality {where} AND Resolution IS NOT NULL
+            GROUP BY Codec, Resolution
+        """, params) or []
+        codec_by_resolution = {}
+        for r in matrix: codec_by_resolution.setdefault(r['Codec'], {})[r['Resolution']] = r['c']
+
+        return {
+            "total_count": total['c'] if total else 0,
+            "scan_time_str": datetime.fromtimestamp(self.last_sync_time).strftime("%Y-%m-%d %H:%M:%S") if self.last_sync_time else "",
+            "resolution": counts("Resolution", ["4k", "1080p", "720p", "sd"]),
+            "video_codec": counts("Codec", ["hevc", "h264", "av1", "other"]),
+            "hdr_type": counts("HdrType", ["sdr", "hdr10", "dolby_vision"]),
+            "bad_quality_list": bad["items"],
+            "bad_quality_total": bad["total"],
+            "by_library": [dict(r) for r in by_library],
+            "codec_by_resolution": codec_by_resolution
+        }
+
+    def get_bad_quality(self, page=1, limit=50, item_type="movie", library_id=None):
+        """低画质 (SD) 列表，分页返回，不再截断"""
+        where, params = self._filter(item_type, library_id)
+        where += " AND Resolution = 'sd'"
+        total = query_sidecar(f"SELECT COUNT(*) as c FROM media_quality {where}", params, one=True)
+        rows = query_sidecar(f"""
+            SELECT ItemId, Name, SeriesName, SeasonNumber, EpisodeNumber, Year,
+                   Width || 'x' || Height as Resolution, COALESCE(Path, '未知路径') as Path
+            FROM media_quality {where}
+            ORDER BY {WORST_ORDER}, SeriesName, Name LIMIT ? OFFSET ?
+        """, params + [limit, (page - 1) * limit]) or []
+        return {"items": [dict(r) for r in rows], "total": total['c'] if total else 0, "page": page, "limit": limit}
+
+    @staticmethod
+    def _eps_sql(extra=""):
+        return f"SELECT * FROM media_quality WHERE ItemType = 'Episode' AND SeriesId IS NOT NULL {extra}"
+
+    def _rollup_sql(self, group_cols, extra=""):
+        """
+        按给定列汇总单集：集数、主流分辨率、HEVC/HDR 占比、SD 集数 (用 TOTAL 而不是 SUM，整组缺流信息时也返回 0 而不是 NULL)
+        主流分辨率先在 dominant 里按组取第一名 (每组一行)，再与汇总结果 JOIN，不再每组跑一次相关子查询
+        """
+        group = ", ".join(group_cols)
+        # SeriesId 在 eps 里非空可以用等值连接，其余分组列 (SeasonNumber) 可能为 NULL，用 IS
+        join_on = " AND ".join(f"d.{c} {'=' if c == 'SeriesId' else 'IS'} b.{c}" for c in group_cols)
+        return f"""
+            WITH eps AS ({self._eps_sql(extra)}),
+            base AS (
+                SELECT {group}, MAX(SeriesName) as SeriesName, MAX(LibraryName) as LibraryName,
+                       COUNT(*) as episodes,
+                       ROUND(100.0 * TOTAL(Codec = 'hevc') / COUNT(*), 1) as hevc_pct,
+                       ROUND(100.0 * TOTAL(HdrType IN ('hdr10', 'dolby_vision')) / COUNT(*), 1) as hdr_pct,
+                       CAST(TOTAL(Resolution = 'sd') AS INTEGER) as sd_count,
+                       AVG(Width) as avg_width
+                FROM eps GROUP BY {group}
+            ),
+            dominant AS (
+                SELECT {group}, Resolution FROM (
+                    SELECT {group}, Resolution,
+                           ROW_NUMBER() OVER (PARTITION BY {group} ORDER BY COUNT(*) DESC, MAX(Width) DESC) as rn
+                    FROM eps WHERE Resolution IS NOT NULL GROUP BY {group}, Resolution
+                ) WHERE rn = 1
+            )
+            SELECT {", ".join(f"b.{c}" for c in group_cols)}, b.SeriesName, b.LibraryName, b.episodes,
+                   d.Resolution as dominant_resolution,
+                   b.hevc_pct, b.hdr_pct, b.sd_count, b.avg_width
+            FROM base b LEFT JOIN dominant d ON {join_on}
+        """
+
+    def _worst_episodes(self, series_ids, by_season=False):
+        """每部剧 (by_season 时每一季) 画质最差的几集，一次查询取回；按季时键为 (SeriesId, SeasonNumber)"""
+        if not series_ids: return {}
+        placeholders = ','.join(['?'] * len(series_ids))
+        partition = "SeriesId, SeasonNumber" if by_season else "SeriesId"
+        rows = query_sidecar(f"""
+            SELECT * FROM (
+                SELECT SeriesId, SeasonNumber, EpisodeNumber, Name, Width || 'x' || Height as Resolution, Codec, HdrType, Bitrate,
+                       ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY {WORST_ORDER}) as rn
+                FROM media_quality
+                WHERE ItemType = 'Episode' AND SeriesId IN ({placeholders})
+            ) WHERE rn <= {WORST_EPISODES}
+        """, list(series_ids)) or []
+        worst = {}
+        for r in rows:
+            item = dict(r); item.pop("rn", None)
+            key = (r['SeriesId'], r['SeasonNumber']) if by_season else r['SeriesId']
+            worst.setdefault(key, []).append(item)
+        return worst
+
+    def get_series(self, page=1, limit=20, sort="sd", order="desc", library_id=None):
+        """按剧集汇总的画质列表，支持排序与分页"""
+        sort_col = SERIES_SORTS.get(sort, "sd_count")
+        direction = "ASC" if order == "asc" else "DESC"
+        extra, params = ("AND LibraryId = ?", [library_id]) if library_id else ("", [])
+        # 总数只需要剧集个数，不必跑完整汇总
+        total = query_sidecar(f"SELECT COUNT(DISTINCT SeriesId) as c FROM ({self._eps_sql(extra)})", params, one=True)
+        rows = query_sidecar(f"SELECT * FROM ({self._rollup_sql(['SeriesId'], extra)}) ORDER BY {sort_col} {direction}, SeriesName LIMIT ? OFFSET ?",
+                             params + [limit, (page - 1) * limit]) or []
+        items = [dict(r) for r in rows]
+        worst = self._worst_episodes([r['SeriesId'] for r in items])
+        for item in items: item["worst_episodes"] = worst.get(item['SeriesId'], [])
+        return {"items": items, "total": total['c'] if total else 0, "page": page, "limit": limit}
+
+    def get_seasons(self, series_id):
+        """单部剧按季汇总"""
+        sql = self._rollup_sql(["SeriesId", "SeasonNumber"], "AND SeriesId = ?")
+        rows = query_sidecar(f"SELECT * FROM ({sql}) ORDER BY SeasonNumber", [series_id]) or []
+        items = [dict(r) for r in rows]
+        worst = self._worst_episodes([series_id], by_season=True)
+        for item in items: item["worst_episodes"] = worst.get((series_id, item['SeasonNumber']), [])
+        return items
+
+quality_service = QualityService()
@@ -3,8 +3,10 @@ import io
 import requests
 import datetime
 from app.core.config import cfg, FONT_PATH, FONT_URL, THEMES
-from app.core.database import query_db, get_base_filter
+from app.core.database import query_db, query_sidecar, get_base_filter
 from app.core.database import DB_PATH # check existence
+from app.services.rollup_service import rollup_service
+from app.services.user_directory import user_directory
 
 try:
     from PIL import Image, ImageDraw, ImageFont, ImageFilter
@@ -13,17 +15,14 @@ except ImportError:
     HAS_PIL = False
     print("⚠️ Pillow not found. Report generation disabled.")
 
-def get_user_map_internal():
-    # 简单的内部获取，避免循环引用
-    user_map = {}
-    key = cfg.get("emby_api_key"); host = cfg.get("emby_host")
-    if key and host:
-        try:
-            res = requests.get(f"{host}/emby/Users?api_key={key}", timeout=2)
-            if res.status_code == 200:
-                for u in res.json(): user_map[u['Id']] = u['Name']
-        except: pass
-    return user_map
+# 汇总表上的时间过滤 (与下方 DateCreated 过滤一一对应，按天粒度等价)
+ROLLUP_PERIOD_FILTERS = {
+    'week': " AND Day >= date('now', '-7 days')",
+    'month': " AND Day >= date('now', '-30 days')",
+    'year': " AND Day >= date('now', '-1 year')",
+    'day': " AND Day >= date('now', 'start of day')",
+    'yesterday': " AND Day >= date('now', '-1 day', 'start of day') AND Day < date('now', 'start of day')",
+}
 
 class ReportGenerator:
     def __init__(self):
@@ -74,20 +73,36 @@ class ReportGenerator:
 
         full_where = where_base + date_filter
         
-        plays_res = query_db(f"SELECT COUNT(*) as c FROM PlaybackActivity {full_where}", params)
-        plays = plays_res[0]['c'] if plays_res else 0
-        
-        dur_res = query_db(f"SELECT SUM(PlayDuration) as c FROM PlaybackActivity {full_where}", params)
-        dur = dur_res[0]['c'] or 0
+        if rollup_service.ready:
+            # 🔥 走旁路汇总表：全量用月表，其余按日表过滤
+            if period in ROLLUP_PERIOD_FILTERS:
+                user_table, item_table = "rollup_user_daily", "rollup_item_daily"
+                rollup_where = where_base + ROLLUP_PERIOD_FILTERS[period]
+            else:
+                user_table, item_table = "rollup_user_monthly", "rollup_item_monthly"
+                rollup_where = where_base
+            totals = query_sidecar(f"SELECT SUM(Plays) as c, SUM(PlayDuration) as d FROM {user_table} {rollup_where}", params)
+            plays = (totals[0]['c'] or 0) if totals else 0
+            dur = (totals[0]['d'] or 0) if totals else 0
+        else:
+            plays_res = query_db(f"SELECT COUNT(*) as c FROM PlaybackActivity {full_where}", params)
+            plays = plays_res[0]['c'] if plays_res else 0
+            
+            dur_res = query_db(f"SELECT SUM(PlayDuration) as c FROM PlaybackActivity {full_where}", params)
+            dur = dur_res[0]['c'] or 0
         hours = round(dur / 3600, 1)
         
         user_name = "Emby Server"
-        if user_id != 'all': user_name = get_user_map_internal().get(user_id, "User")
+        if user_id != 'all': user_name = user_directory.get_name(user_id, "User")
         
         top_list = []
         if plays > 0:
-            sql = f"SELECT ItemName, ItemId, COUNT(*) as C, SUM(PlayDuration) as D FROM PlaybackActivity {full_where} GROUP BY ItemName ORDER BY C DESC LIMIT 8"
-            top_list = query_db(sql, params)
+            if rollup_service.ready:
+                sql = f"SELECT ItemName, MAX(ItemId) as ItemId, SUM(Plays) as C, SUM(PlayDuration) as D FROM {item_table} {rollup_where} GROUP BY ItemName ORDER BY C DESC LIMIT 8"
+                top_list = query_sidecar(sql, params)
+            else:
+                sql = f"SELECT ItemName, ItemId, COUNT(*) as C, SUM(PlayDuration) as D FROM PlaybackActivity {full_where} GROUP BY ItemName ORDER BY C DESC LIMIT 8"
+                top_list = query_db(sql, params)
 
         try: font_lg = ImageFont.truetype(FONT_PATH, 60); font_md = ImageFont.truetype(FONT_PATH, 40); font_sm = ImageFont.truetype(FONT_PATH, 28); font_xs = ImageFont.truetype(FONT_PATH, 22)
         except: font_lg = font_md = font_sm = font_xs = ImageFont.load_default()
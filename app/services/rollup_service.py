@@ -0,0 +1,150 @@
+import threading
+import time
+import logging
+from collections import defaultdict
+from app.core.database import query_db, query_sidecar, sidecar_pool
+
+logger = logging.getLogger("uvicorn")
+
+# 每轮增量同步的间隔 (秒) 与单批读取行数
+ROLLUP_INTERVAL = 60
+ROLLUP_BATCH = 20000
+
+# 汇总表定义: 表名 -> (时间粒度列, 维度列)
+# 列名沿用插件的 PascalCase (UserId / PlayDuration)，这样 get_base_filter 可以直接复用
+ROLLUP_TABLES = {
+    "rollup_user_hourly":    ("Hour",  ["UserId"]),
+    "rollup_user_daily":     ("Day",   ["UserId"]),
+    "rollup_user_monthly":   ("Month", ["UserId"]),
+    "rollup_item_daily":     ("Day",   ["UserId", "ItemId"]),
+    "rollup_item_monthly":   ("Month", ["UserId", "ItemId"]),
+    "rollup_device_daily":   ("Day",   ["UserId", "Device"]),
+    "rollup_device_monthly": ("Month", ["UserId", "Device"]),
+}
+# 条目表额外保存最近一次的名称/类型 (不参与主键)
+ITEM_EXTRA_COLS = ["ItemName", "ItemType"]
+
+class RollupService:
+    """
+    旁路汇总服务
+    按 rowid 增量追踪插件的 PlaybackActivity，把播放记录折叠进
+    小时/日/月 × 用户/条目/设备 的汇总表，统计接口直接查汇总表
+    """
+    def __init__(self):
+        self.running = False
+        self.thread = None
+        self.ready = False
+        self.sync_lock = threading.Lock()
+        self.last_sync_time = 0
+        self.last_rowid = 0
+
+    def start(self):
+        if self.running: return
+        self.init_schema()
+        self.running = True
+        self.thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self): self.running = False
+
+    def init_schema(self):
+        try:
+            with sidecar_pool.writer() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)")
+                for table, (bucket, dims) in ROLLUP_TABLES.items():
+                    extra = "".join(f"{c} TEXT, " for c in ITEM_EXTRA_COLS) if "ItemId" in dims else ""
+                    dim_cols = "".join(f"{d} TEXT, " for d in dims)
+                    conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                                        {bucket} TEXT, {dim_cols}{extra}
+                                        Plays INTEGER DEFAULT 0,
+                                        PlayDuration INTEGER DEFAULT 0,
+                                        PRIMARY KEY ({bucket}, {', '.join(dims)})
+                                    ) WITHOUT ROWID""")
+            row = query_sidecar("SELECT value FROM sync_state WHERE name = 'rollup_rowid'", one=True)
+            self.last_rowid = int(row['value']) if row else 0
+            ready = query_sidecar("SELECT value FROM sync_state WHERE name = 'rollup_ready'", one=True)
+            # 上次已完成全量回填，重启后立即可用 (最多落后一个同步周期)
+            self.ready = bool(ready and ready['value'] == '1')
+        except Exception as e:
+            logger.error(f"Rollup Schema Error: {e}")
+
+    def _sync_loop(self):
+        while self.running:
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Rollup Sync Error: {e}")
+            time.sleep(ROLLUP_INTERVAL)
+
+    def sync(self):
+        """增量同步：读取 rowid 大于水位线的新记录并累加到汇总表"""
+        with self.sync_lock:
+            max_res = query_db("SELECT MAX(rowid) as m FROM PlaybackActivity", one=True)
+            if max_res is None: return
+            max_rowid = max_res['m'] or 0
+
+            # 插件库被重建/清理过 (rowid 回退)，从头重算
+            if max_rowid < self.last_rowid:
+                logger.info("🔄 PlaybackActivity 已重建，重新生成汇总表")
+                self._reset()
+
+            while self.running and self.last_rowid < max_rowid:
+                rows = query_db(
+                    "SELECT rowid as rid, DateCreated, UserId, ItemId, ItemName, ItemType, PlayDuration, "
+                    "COALESCE(DeviceName, ClientName, 'Unknown') as Device "
+                    "FROM PlaybackActivity WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (self.last_rowid, ROLLUP_BATCH))
+                if not rows: break
+                self._apply_batch(rows)
+                if len(rows) < ROLLUP_BATCH: break
+
+            if not self.ready and self.last_rowid >= max_rowid:
+                query_sidecar("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('rollup_ready', '1')")
+                self.ready = True
+                logger.info("✅ 汇总表回填完成")
+            self.last_sync_time = time.time()
+
+    def _reset(self):
+        self.ready = False
+        with sidecar_pool.writer() as conn:
+            for table in ROLLUP_TABLES: conn.execute(f"DELETE FROM {table}")
+            conn.execute("DELETE FROM sync_state WHERE name IN ('rollup_rowid', 'rollup_ready')")
+        self.last_rowid = 0
+
+    def _apply_batch(self, rows):
+        # 先在内存里按 (表, 主键) 折叠，再一次性 upsert
+        acc = {table: defaultdict(lambda: [0, 0, None, None]) for table in ROLLUP_TABLES}
+        for r in rows:
+            date_str = (r['DateCreated'] or "").replace('T', ' ')
+            if len(date_str) < 13: continue
+            buckets = {"Hour": date_str[:13], "Day": date_str[:10], "Month": date_str[:7]}
+            values = {"UserId": r['UserId'], "ItemId": r['ItemId'], "Device": r['Device']}
+            dur = r['PlayDuration'] or 0
+            for table, (bucket, dims) in ROLLUP_TABLES.items():
+                slot = acc[table][(buckets[bucket],) + tuple(values[d] for d in dims)]
+                slot[0] += 1
+                slot[1] += dur
+                slot[2] = r['ItemName']
+                slot[3] = r['ItemType']
+
+        last_rowid = rows[-1]['rid']
+        with sidecar_pool.writer() as conn:
+            for table, (bucket, dims) in ROLLUP_TABLES.items():
+                has_item = "ItemId" in dims
+                cols = [bucket] + dims + (ITEM_EXTRA_COLS if has_item else []) + ["Plays", "PlayDuration"]
+                update = "Plays = Plays + excluded.Plays, PlayDuration = PlayDuration + excluded.PlayDuration"
+                if has_item: update += ", ItemName = excluded.ItemName, ItemType = excluded.ItemType"
+                sql = (f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(['?'] * len(cols))}) "
+                       f"ON CONFLICT ({bucket}, {', '.join(dims)}) DO UPDATE SET {update}")
+                data = []
+                for key, (plays, dur, name, itype) in acc[table].items():
+                    data.append(key + ((name, itype) if has_item else ()) + (plays, dur))
+                conn.executemany(sql, data)
+            # 水位线与汇总数据在同一事务内提交，中途崩溃不会重复累加
+            conn.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('rollup_rowid', ?)", (str(last_rowid),))
+        self.last_rowid = last_rowid
+
+    def get_status(self):
+        return {"ready": self.ready, "last_rowid": self.last_rowid, "last_sync_time": self.last_sync_time}
+
+rollup_service = RollupService()
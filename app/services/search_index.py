@@ -0,0 +1,105 @@
+import threading
+import time
+import logging
+from app.core.database import query_db, query_sidecar, sidecar_pool
+
+logger = logging.getLogger("uvicorn")
+
+# 增量同步间隔 (秒) 与单批行数
+SEARCH_INDEX_INTERVAL = 60
+SEARCH_INDEX_BATCH = 20000
+# trigram 分词至少需要 3 个字符才能走索引
+TRIGRAM_MIN_LEN = 3
+
+class HistorySearchIndex:
+    """
+    播放历史全文索引 (FTS5 + trigram 分词，中文子串也能命中)
+    存放在旁路库中，rowid 与插件 PlaybackActivity 的 rowid 一致，按 rowid 增量追加
+    """
+    def __init__(self):
+        self.running = False
+        self.thread = None
+        self.available = False
+        self.ready = False
+        self.last_rowid = 0
+        self.sync_lock = threading.Lock()
+
+    def start(self):
+        if self.running: return
+        self.init_schema()
+        if not self.available: return
+        self.running = True
+        self.thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self): self.running = False
+
+    def init_schema(self):
+        try:
+            with sidecar_pool.writer() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)")
+                conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                                    ItemName, UserId UNINDEXED, DateCreated UNINDEXED,
+                                    tokenize = 'trigram'
+                                )""")
+            self.available = True
+        except Exception as e:
+            # 旧版 SQLite (< 3.34) 不支持 trigram，历史搜索回退到 LIKE
+            logger.error(f"Search Index Unavailable: {e}")
+            return
+        row = query_sidecar("SELECT value FROM sync_state WHERE name = 'fts_rowid'", one=True)
+        self.last_rowid = int(row['value']) if row else 0
+        ready = query_sidecar("SELECT value FROM sync_state WHERE name = 'fts_ready'", one=True)
+        self.ready = bool(ready and ready['value'] == '1')
+
+    def _sync_loop(self):
+        while self.running:
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Search Index Sync Error: {e}")
+            time.sleep(SEARCH_INDEX_INTERVAL)
+
+    def sync(self):
+        with self.sync_lock:
+            max_res = query_db("SELECT MAX(rowid) as m FROM PlaybackActivity", one=True)
+            if max_res is None: return
+            max_rowid = max_res['m'] or 0
+
+            if max_rowid < self.last_rowid:
+                logger.info("🔄 PlaybackActivity 已重建，重新生成搜索索引")
+                self.ready = False
+                with sidecar_pool.writer() as conn:
+                    conn.execute("DELETE FROM history_fts")
+                    conn.execute("DELETE FROM sync_state WHERE name IN ('fts_rowid', 'fts_ready')")
+                self.last_rowid = 0
+
+            while self.running and self.last_rowid < max_rowid:
+                rows = query_db("SELECT rowid as rid, ItemName, UserId, DateCreated FROM PlaybackActivity WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                (self.last_rowid, SEARCH_INDEX_BATCH))
+                if not rows: break
+                last_rowid = rows[-1]['rid']
+                with sidecar_pool.writer() as conn:
+                    conn.executemany("INSERT OR REPLACE INTO history_fts (rowid, ItemName, UserId, DateCreated) VALUES (?, ?, ?, ?)",
+                                     [(r['rid'], r['ItemName'] or "", r['UserId'], r['DateCreated']) for r in rows])
+                    conn.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('fts_rowid', ?)", (str(last_rowid),))
+                self.last_rowid = last_rowid
+                if len(rows) < SEARCH_INDEX_BATCH: break
+
+            if not self.ready and self.last_rowid >= max_rowid:
+                query_sidecar("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('fts_ready', '1')")
+                self.ready = True
+                logger.info("✅ 历史搜索索引构建完成")
+
+    def can_search(self, keyword):
+        return self.available and self.ready and keyword and len(keyword) >= TRIGRAM_MIN_LEN
+
+    @staticmethod
+    def match_expr(keyword):
+        # 作为整体短语匹配，转义双引号，避免用户输入被解析成 FTS 语法
+        return '"' + keyword.replace('"', '""') + '"'
+
+    def get_status(self):
+        return {"available": self.available, "ready": self.ready, "last_rowid": self.last_rowid}
+
+history_index = HistorySearchIndex()
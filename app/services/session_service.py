@@ -0,0 +1,130 @@
+import threading
+import time
+import logging
+from app.core.emby import emby
+from app.core.sse import ChangeFeed
+
+logger = logging.getLogger("uvicorn")
+
+# 有人在看 (SSE 连接) 或有播放时的轮询间隔；空闲时放慢
+LIVE_POLL_ACTIVE = 5
+LIVE_POLL_IDLE = 15
+# 快照超过这个时间没更新 (后台线程没跑) 时，读取方自己拉一次
+SNAPSHOT_MAX_AGE = 30
+# 拉取失败后这段时间内读取方不再同步重试，直接返回旧快照
+LIVE_ERROR_BACKOFF = 30
+
+def session_progress(s):
+    """进度相关的精简字段，用于 progress 增量事件"""
+    state = s.get("PlayState") or {}
+    item = s.get("NowPlayingItem") or {}
+    runtime = item.get("RunTimeTicks") or 0
+    pos = state.get("PositionTicks") or 0
+    return {
+        "Id": s.get("Id"),
+        "PositionTicks": pos,
+        "IsPaused": bool(state.get("IsPaused")),
+        "Percentage": int(pos / runtime * 100) if runtime else 0,
+    }
+
+class SessionMonitor:
+    """
+    共享的正在播放轮询器
+    一个后台线程定时拉 /emby/Sessions，持有最新快照并计算差异 (started/stopped/progress)
+    通过 SSE 推给所有页面；REST 接口与机器人 /now 都直接读快照，Emby 负载与在线人数无关
+    """
+    def __init__(self):
+        self.running = False
+        self.thread = None
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._last_poll = 0
+        self._retry_after = 0
+        self._inline_polling = False
+        self._wake = threading.Event()
+        self.feed = ChangeFeed(snapshot_fn=self.get_sessions_cached)
+        self._stats = {"polls": 0, "errors": 0, "events": 0}
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        self.thread = threading.Thread(target=self._poll_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def _poll_loop(self):
+        while self.running:
+            self.poll()
+            with self._lock: busy = bool(self._sessions)
+            interval = LIVE_POLL_ACTIVE if busy or self.feed.subscriber_count() else LIVE_POLL_IDLE
+            self._wake.wait(interval)
+            self._wake.clear()
+
+    def poll(self):
+        if not emby.is_configured(): return
+        try:
+            res = emby.get("/emby/Sessions", timeout=5)
+            if res.status_code != 200: raise RuntimeError(f"HTTP {res.status_code}")
+            current = {s.get("Id"): s for s in res.json() if s.get("NowPlayingItem")}
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+                self._retry_after = time.time() + LIVE_ERROR_BACKOFF
+            logger.error(f"❌ Live Sessions Error: {e}")
+            return
+        with self._lock:
+            previous = self._sessions
+            self._sessions = current
+            self._last_poll = time.time()
+            self._stats["polls"] += 1
+        self._publish_diff(previous, current)
+
+    def _publish_diff(self, previous, current):
+        started, progress = [], []
+        for sid, s in current.items():
+            old = previous.get(sid)
+            if not old or (old.get("NowPlayingItem") or {}).get("Id") != s["NowPlayingItem"].get("Id"):
+                started.append(s)
+                continue
+            p = session_progress(s)
+            if p != session_progress(old): progress.append(p)
+        stopped = [sid for sid in previous if sid not in current]
+
+        events = 0
+        for s in started: self.feed.publish("started", s); events += 1
+        for sid in stopped: self.feed.publish("stopped", {"Id": sid}); events += 1
+        if progress: self.feed.publish("progress", progress); events += 1
+        with self._lock: self._stats["events"] += events
+
+    # ---------- 对外接口 ----------
+    def get_sessions_cached(self):
+        with self._lock: return list(self._sessions.values())
+
+    def get_sessions(self):
+        """
+        读取快照；后台线程在跑时只读快照 (Emby 故障时也返回旧快照，不在请求线程里重试)
+        后台线程未运行且快照过旧时，由一个调用方同步拉一次，失败后退避
+        """
+        now = time.time()
+        with self._lock:
+            inline = (not self.running and not self._inline_polling
+                      and now - self._last_poll > SNAPSHOT_MAX_AGE and now >= self._retry_after)
+            if inline: self._inline_polling = True
+        if inline:
+            try: self.poll()
+            finally:
+                with self._lock: self._inline_polling = False
+        return self.get_sessions_cached()
+
+    def get_stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["sessions"] = len(self._sessions)
+            s["snapshot_age"] = round(time.time() - self._last_poll, 1) if self._last_poll else None
+        s["subscribers"] = self.feed.subscriber_count()
+        return s
+
+session_monitor = SessionMonitor()
@@ -0,0 +1,238 @@
+import threading
+import time
+import logging
+from app.core.emby import emby
+from app.core.sse import ChangeFeed
+
+logger = logging.getLogger("uvicorn")
+
+# 轮询间隔：有任务在跑时快 (SSE 与 REST 轮询的页面都要看到进度)，空闲时慢
+TASK_POLL_RUNNING = 2
+TASK_POLL_IDLE = 30
+# 快照超过这个时间没更新 (后台线程没跑) 时，读取方自己拉一次
+SNAPSHOT_MAX_AGE = 60
+# 会随执行变化的字段，只比较这些来判断任务是否变化
+TASK_DYNAMIC_FIELDS = ("State", "CurrentProgressPercentage", "LastExecutionResult")
+
+# 🔥 任务名称汉化字典 (仅作为标题美化，描述使用 Emby 原生的)
+TRANS_MAP = {
+    # 核心/系统
+    "Scan Media Library": "扫描媒体库",
+    "Refresh People": "刷新人物信息",
+    "Rotate Log File": "日志轮转与归档",
+    "Check for application updates": "检查主程序更新",
+    "Check for plugin updates": "检查插件更新",
+    "Cache file cleanup": "清理系统缓存",
+    "Clean Transcode Directory": "清理转码临时文件",
+    "Hardware Detection": "硬件转码能力检测",
+    "Emby Server Backup": "服务器配置备份",
+    
+    # 媒体处理
+    "Convert media": "媒体格式转换",
+    "Create Playlists": "生成智能播放列表",
+    "Extract Chapter Images": "提取章节预览图",
+    "Chapter image extraction": "提取章节预览图",
+    "Thumbnail image extraction": "提取视频缩略图",
+    "Download subtitles": "自动下载字幕",
+    "Organize new media files": "自动整理新文件",
+    
+    # 常见插件
+    "Build Douban Cache": "构建豆瓣缓存",
+    "Download OCR Data": "下载 OCR 数据",
+    "Detect Episode Intros": "检测跳过片头",
+    "Extract Intro Fingerprint": "提取片头指纹",
+    "Extract MediaInfo": "提取媒体编码信息",
+    "Extract Video Thumbnail": "提取视频缩略图",
+    "Delete Persons": "清理无效人物",
+    "Trakt Sync": "Trakt 同步",
+    "Export Library to Trakt": "同步库到 Trakt",
+    "Import playstates from Trakt.tv": "从 Trakt 导入播放状态"
+}
+
+# 🔥 核心类别排序与汉化 (不在这个列表里的，会自动显示原名)
+CAT_MAP = {
+    "Library": {"name": "📚 媒体库", "order": 1},
+    "System": {"name": "⚡ 系统核心", "order": 2},
+    "Maintenance": {"name": "🧹 维护保养", "order": 3},
+    "Application": {"name": "📱 应用程序", "order": 4},
+    "Metadata": {"name": "📝 元数据", "order": 5},
+    "Downloads": {"name": "📥 下载管理", "order": 6},
+    "Sync": {"name": "🔄 同步与备份", "order": 7},
+    "Live TV": {"name": "📺 电视直播", "order": 8},
+    "Transcoding": {"name": "🎞️ 转码", "order": 9}
+}
+
+def build_task(t):
+    """把 Emby 原始任务转换成前端用的任务对象，返回 (分类名, 排序权重, 任务对象)"""
+    # 1. 汉化名称 (保留原名)
+    origin_name = t.get('Name', '')
+    display_name = TRANS_MAP.get(origin_name, origin_name)
+
+    # 2. 识别类别
+    cat_raw = t.get('Category', 'Other')
+    if cat_raw in CAT_MAP:
+        # 命中核心预设分类
+        cat_display = CAT_MAP[cat_raw]["name"]
+        sort_order = CAT_MAP[cat_raw]["order"]
+    else:
+        # 🔥 没命中的（插件），直接用原名！
+        # 例如: Category="Trakt" -> 显示 "🧩 Trakt"
+        cat_display = f"🧩 {cat_raw}"
+        sort_order = 99 # 排在核心分类后面
+
+    task_obj = {
+        "Id": t.get("Id"),
+        "Name": display_name,
+        "OriginalName": origin_name,
+        "Description": t.get('Description', ''),
+        "State": t.get("State"),
+        "CurrentProgressPercentage": t.get("CurrentProgressPercentage"),
+        "LastExecutionResult": t.get("LastExecutionResult"),
+        "Triggers": t.get("Triggers")
+    }
+    return cat_display, sort_order, task_obj
+
+class TaskMonitor:
+    """
+    计划任务监控
+    后台自适应轮询 /emby/ScheduledTasks，内存中保存汉化、分组后的任务模型，
+    只把状态/进度有变化的任务通过 SSE 推给页面
+    """
+    def __init__(self):
+        self.running = False
+        self.thread = None
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._groups = {}
+        self._last_poll = 0
+        self._wake = threading.Event()
+        self.feed = ChangeFeed(snapshot_fn=self.get_groups_cached)
+        self._stats = {"polls": 0, "errors": 0, "changed": 0}
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        self.thread = threading.Thread(target=self._poll_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def wake(self): self._wake.set()
+
+    def _poll_loop(self):
+        while self.running:
+            self.poll()
+            with self._lock: any_running = any(t["State"] == "Running" for t in self._tasks.values())
+            interval = TASK_POLL_RUNNING if any_running else TASK_POLL_IDLE
+            self._wake.wait(interval)
+            self._wake.clear()
+
+    def poll(self):
+        if not emby.is_configured(): return False
+        try:
+            res = emby.get("/emby/ScheduledTasks", timeout=10)
+            if res.status_code != 200: raise RuntimeError(f"Emby Error: {res.status_code}")
+            raw_tasks = res.json()
+        except Exception as e:
+            with self._lock: self._stats["errors"] += 1
+            logger.error(f"Task Monitor Error: {e}")
+            return False
+        return self._apply(raw_tasks)
+
+    async def apoll(self):
+        """poll() 的异步版本，供 async 路由在快照过旧时使用"""
+        if not emby.is_configured(): return False
+        try:
+            res = await emby.aget("/emby/ScheduledTasks", timeout=10)
+            if res.status_code != 200: raise RuntimeError(f"Emby Error: {res.status_code}")
+            raw_tasks = res.json()
+        except Exception as e:
+            with self._lock: self._stats["errors"] += 1
+            logger.error(f"Task Monitor Error: {e}")
+            return False
+        return self._apply(raw_tasks)
+
+    def _apply(self, raw_tasks):
+        tasks, groups = {}, {}
+        for t in raw_tasks:
+            cat_display, sort_order, task_obj = build_task(t)
+            tasks[task_obj["Id"]] = task_obj
+            groups[task_obj["Id"]] = (cat_display, sort_order)
+
+        with self._lock:
+            previous = self._tasks
+            self._tasks = tasks
+            self._groups = groups
+            self._last_poll = time.time()
+            self._stats["polls"] += 1
+
+        if set(previous) != set(tasks):
+            # 任务增减 (插件安装/卸载)，直接推全量
+            self.feed.publish("snapshot", self.get_groups_cached())
+            return True
+        changed = [t for tid, t in tasks.items()
+                   if any(t[f] != previous[tid][f] for f in TASK_DYNAMIC_FIELDS)]
+        if changed:
+            with self._lock: self._stats["changed"] += len(changed)
+            self.feed.publish("tasks", changed)
+        return True
+
+    def mark(self, task_id, state):
+        """启动/停止后乐观更新本地模型并立即推送，随后唤醒轮询拿真实状态"""
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task:
+                task = dict(task, State=state)
+                if state == "Running": task["CurrentProgressPercentage"] = 0
+                self._tasks[task_id] = task
+        if task: self.feed.publish("tasks", [task])
+        self.wake()
+
+    # ---------- 对外接口 ----------
+    def get_groups_cached(self):
+        with self._lock:
+            tasks = list(self._tasks.values())
+            groups_meta = dict(self._groups)
+        grouped = {}
+        for task_obj in tasks:
+            cat_display, sort_order = groups_meta[task_obj["Id"]]
+            # 归类 (使用分类名称作为 Key，防止不同插件合并)
+            if cat_display not in grouped:
+                grouped[cat_display] = {
+                    "title": cat_display,
+                    "order": sort_order, # 记录排序权重
+                    "tasks": []
+                }
+            grouped[cat_display]["tasks"].append(task_obj)
+
+        # 排序逻辑：
+        # 第一优先级: order (核心分类 1-9 先排，插件 99 后排)
+        # 第二优先级: title (插件之间按字母顺序排)
+        final_list = sorted(grouped.values(), key=lambda x: (x['order'], x['title']))
+        # 组内任务排序 (按名称)
+        for group in final_list:
+            group["tasks"].sort(key=lambda x: x['Name'])
+        return final_list
+
+    def get_groups(self):
+        """读取分组后的任务列表；快照过旧时同步拉一次，拉取失败返回 None"""
+        with self._lock: stale = time.time() - self._last_poll > SNAPSHOT_MAX_AGE
+        if stale and not self.poll(): return None
+        return self.get_groups_cached()
+
+    async def get_groups_async(self):
+        with self._lock: stale = time.time() - self._last_poll > SNAPSHOT_MAX_AGE
+        if stale and not await self.apoll(): return None
+        return self.get_groups_cached()
+
+    def get_stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["tasks"] = len(self._tasks)
+            s["running"] = sum(1 for t in self._tasks.values() if t["State"] == "Running")
+        s["subscribers"] = self.feed.subscriber_count()
+        return s
+
+task_monitor = TaskMonitor()
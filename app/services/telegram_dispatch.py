@@ -0,0 +1,163 @@
+import time
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger("uvicorn")
+
+# 同时处理指令的线程数
+TG_DISPATCH_WORKERS = 4
+# 排队中的指令上限，超过后丢弃新指令
+TG_DISPATCH_QUEUE_MAX = 200
+# 指令超时 (秒)：超时后放行同一会话的后续指令，迟到的回复丢弃
+TG_COMMAND_TIMEOUT = 30
+TG_COMMAND_TIMEOUTS = {"/stats": 90, "/weekly": 90, "/monthly": 90, "/yearly": 120, "/search": 45}
+TG_WATCHDOG_INTERVAL = 1
+
+class CommandJob:
+    __slots__ = ("chat_id", "key", "fn", "timeout", "queued_at", "started_at", "cancelled", "done")
+
+    def __init__(self, chat_id, key, fn, timeout):
+        self.chat_id = chat_id
+        self.key = key
+        self.fn = fn
+        self.timeout = timeout
+        self.queued_at = time.time()
+        self.started_at = None
+        self.cancelled = False
+        self.done = False
+
+class CommandDispatcher:
+    """
+    Telegram 指令分发池
+    - 收消息的线程只负责入队，指令由固定数量的 worker 执行，长轮询不再被慢指令卡住
+    - 同一会话的指令按到达顺序逐条执行，不同会话并行
+    - 同一会话里相同的指令还没处理完时，重复发送直接忽略 (连点 /stats 只渲染一次)
+    - 超时的指令标记为取消并放行后续指令，卡住的线程由新 worker 顶替，执行完后自行退出
+    """
+    def __init__(self, workers=TG_DISPATCH_WORKERS):
+        self.running = False
+        self.workers = workers
+        self.on_timeout = None
+        # 每次 start() 加一；stop() 后马上 start() 时，上一代的 worker / watchdog 发现代数变了就退出
+        self._generation = 0
+        self._cond = threading.Condition()
+        self._chats = {}
+        self._ready = deque()
+        self._active = {}
+        self._inflight = set()
+        self._queued = 0
+        self._stats = {"submitted": 0, "completed": 0, "deduped": 0, "dropped": 0, "failed": 0, "timed_out": 0,
+                       "wait_ms_total": 0.0, "wait_ms_max": 0.0, "run_ms_max": 0.0}
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        with self._cond: self._generation += 1
+        for _ in range(self.workers): self._spawn_worker()
+        threading.Thread(target=self._watchdog_loop, args=(self._generation,), daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        with self._cond: self._cond.notify_all()
+
+    def _spawn_worker(self):
+        threading.Thread(target=self._worker_loop, args=(self._generation,), daemon=True).start()
+
+    def _alive(self, generation):
+        return self.running and generation == self._generation
+
+    @staticmethod
+    def timeout_for(command):
+        return TG_COMMAND_TIMEOUTS.get(command, TG_COMMAND_TIMEOUT)
+
+    # ---------- 入队 ----------
+    def submit(self, chat_id, key, fn, timeout=TG_COMMAND_TIMEOUT):
+        """
+        入队一条指令，fn(job) 在 worker 线程里执行；key 相同的指令处理完之前重复提交会被忽略
+        返回是否入队
+        """
+        with self._cond:
+            if key in self._inflight:
+                self._stats["deduped"] += 1
+                return False
+            if self._queued >= TG_DISPATCH_QUEUE_MAX:
+                self._stats["dropped"] += 1
+                logger.warning("⚠️ Telegram 指令队列已满，丢弃新指令")
+                return False
+            job = CommandJob(chat_id, key, fn, timeout)
+            self._chats.setdefault(chat_id, deque()).append(job)
+            self._inflight.add(key)
+            self._queued += 1
+            self._stats["submitted"] += 1
+            if chat_id not in self._active and chat_id not in self._ready: self._ready.append(chat_id)
+            self._cond.notify()
+        return True
+
+    # ---------- 执行 ----------
+    def _worker_loop(self, generation):
+        while self._alive(generation):
+            with self._cond:
+                if not self._ready:
+                    self._cond.wait(5)
+                    continue
+                chat_id = self._ready.popleft()
+                job = self._chats[chat_id].popleft()
+                if not self._chats[chat_id]: del self._chats[chat_id]
+                self._queued -= 1
+                self._active[chat_id] = job
+                job.started_at = time.time()
+                waited = (job.started_at - job.queued_at) * 1000
+                self._stats["wait_ms_total"] += waited
+                self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited)
+            try: job.fn(job)
+            except Exception as e:
+                logger.error(f"Telegram Command Error ({job.key}): {e}")
+                with self._cond: self._stats["failed"] += 1
+            with self._cond:
+                self._stats["run_ms_max"] = max(self._stats["run_ms_max"], (time.time() - job.started_at) * 1000)
+                if job.cancelled: return  # 已有顶替的 worker，本线程退出
+                self._stats["completed"] += 1
+                self._release(job)
+
+    def _release(self, job):
+        """在锁内调用：指令结束 (或超时)，放行同一会话的下一条"""
+        if job.done: return
+        job.done = True
+        self._inflight.discard(job.key)
+        if self._active.get(job.chat_id) is job: del self._active[job.chat_id]
+        if job.chat_id in self._chats and job.chat_id not in self._ready: self._ready.append(job.chat_id)
+        self._cond.notify()
+
+    def _watchdog_loop(self, generation):
+        while self._alive(generation):
+            time.sleep(TG_WATCHDOG_INTERVAL)
+            now = time.time()
+            expired = []
+            with self._cond:
+                for job in list(self._active.values()):
+                    if now - job.started_at > job.timeout and not job.cancelled:
+                        job.cancelled = True
+                        self._stats["timed_out"] += 1
+                        expired.append(job)
+            for job in expired:
+                logger.warning(f"⏳ Telegram 指令超时: {job.key}")
+                # 先发超时提示再放行，保证提示排在同一会话后续指令的回复之前
+                if self.on_timeout:
+                    try: self.on_timeout(job)
+                    except Exception as e: logger.error(f"Telegram Timeout Callback Error: {e}")
+                with self._cond: self._release(job)
+                self._spawn_worker()
+
+    def get_stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s["queued"] = self._queued
+            s["active"] = len(self._active)
+            s["chats_waiting"] = len(self._ready)
+        started = s["submitted"] - s["queued"]
+        s["wait_ms_avg"] = round(s["wait_ms_total"] / started, 1) if started > 0 else 0
+        for k in ("wait_ms_total", "wait_ms_max", "run_ms_max"): s[k] = round(s[k], 1)
+        return s
+
+tg_dispatcher = CommandDispatcher()
@@ -0,0 +1,58 @@
+import time
+import threading
+import logging
+from app.core.database import query_sidecar, sidecar_pool
+
+logger = logging.getLogger("uvicorn")
+
+# 没有 tag 的图片 (Emby 里换了海报也不知道) 的 file_id 有效期 (秒)；带 tag 的只在被 Telegram 拒绝时失效
+FILE_ID_UNTAGGED_TTL = 7 * 86400
+
+class TelegramFileIdCache:
+    """
+    Emby 图片 → Telegram file_id 映射 (旁路库 tg_file_ids 表)
+    同一张海报第一次上传后记下 Telegram 返回的 file_id，之后直接按 file_id 发送，
+    不再从 Emby 下载、也不再上传
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "rejected": 0}
+
+    def _ensure_schema(self):
+        if self._schema_ready: return
+        with sidecar_pool.writer() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS tg_file_ids (
+                                ItemId TEXT, ImgType TEXT, Tag TEXT, FileId TEXT, CreatedAt REAL,
+                                PRIMARY KEY (ItemId, ImgType, Tag)
+                            )""")
+        self._schema_ready = True
+
+    def get(self, item_id, img_type, tag=None):
+        self._ensure_schema()
+        row = query_sidecar("SELECT FileId, CreatedAt FROM tg_file_ids WHERE ItemId = ? AND ImgType = ? AND Tag = ?",
+                            (item_id, img_type, tag or ""), one=True)
+        fresh = row and (tag or time.time() - row['CreatedAt'] < FILE_ID_UNTAGGED_TTL)
+        with self._lock: self._stats["hits" if fresh else "misses"] += 1
+        return row['FileId'] if fresh else None
+
+    def put(self, item_id, img_type, tag, file_id):
+        if not file_id: return
+        self._ensure_schema()
+        query_sidecar("INSERT OR REPLACE INTO tg_file_ids (ItemId, ImgType, Tag, FileId, CreatedAt) VALUES (?, ?, ?, ?, ?)",
+                      (item_id, img_type, tag or "", file_id, time.time()))
+        with self._lock: self._stats["stores"] += 1
+
+    def invalidate(self, item_id, img_type, tag=None):
+        """Telegram 拒绝了缓存的 file_id (文件过期/换了 Bot)，删除后重新上传"""
+        self._ensure_schema()
+        query_sidecar("DELETE FROM tg_file_ids WHERE ItemId = ? AND ImgType = ? AND Tag = ?", (item_id, img_type, tag or ""))
+        with self._lock: self._stats["rejected"] += 1
+
+    def get_stats(self):
+        with self._lock: s = dict(self._stats)
+        total = s["hits"] + s["misses"]
+        s["hit_rate"] = round(s["hits"] / total, 3) if total else 0
+        return s
+
+tg_file_ids = TelegramFileIdCache()
@@ -0,0 +1,257 @@
+import time
+import threading
+import logging
+import requests
+from collections import deque
+from app.core.config import cfg
+from app.core.ratelimit import TokenBucket
+
+logger = logging.getLogger("uvicorn")
+
+TG_API_BASE = "https://api.telegram.org"
+# 优先级通道：指令回复优先于推送通知
+PRIORITY_REPLY = 0
+PRIORITY_NOTIFY = 1
+# Telegram 限制：全局约 30 条/秒；同一私聊约 1 条/秒；同一群组 20 条/分钟
+TG_GLOBAL_RATE, TG_GLOBAL_BURST = 25, 30
+TG_CHAT_RATE, TG_CHAT_BURST = 1, 3
+TG_GROUP_RATE, TG_GROUP_BURST = 20 / 60, 3
+# 通知通道的积压上限，超过后丢弃最旧的通知 (指令回复不丢)
+TG_NOTIFY_QUEUE_MAX = 1000
+# 网络错误 / 5xx 的重试次数与退避基数 (秒)
+TG_MAX_RETRIES = 3
+TG_RETRY_BACKOFF = 2
+# 4xx 描述里出现这些字样说明是 file_id 失效，才交给 on_reject 重新上传；其余 4xx 直接走 fallback
+TG_BAD_FILE_ID_HINTS = ("file identifier", "file reference", "file_reference")
+
+def tg_api_url(token, method):
+    """Bot API 地址，tg_api_base 可替换为自建 Bot API 服务 (或本地测试替身)"""
+    base = (cfg.get("tg_api_base") or TG_API_BASE).rstrip("/")
+    return f"{base}/bot{token}/{method}"
+
+class OutboundMessage:
+    __slots__ = ("method", "chat_id", "data", "files", "priority", "fallback", "on_result", "on_reject", "attempts", "not_before", "queued_at", "started")
+
+    def __init__(self, method, chat_id, data, files, priority, fallback, on_result, on_reject):
+        self.method = method
+        self.chat_id = str(chat_id)
+        self.data = data
+        self.files = files
+        self.priority = priority
+        self.fallback = fallback
+        self.on_result = on_result
+        self.on_reject = on_reject
+        self.attempts = 0
+        self.not_before = 0
+        self.queued_at = time.time()
+        self.started = False
+
+class TelegramOutbox:
+    """
+    Telegram 统一发送队列
+    - 所有 sendMessage / sendPhoto 入队后由单个发送线程按限速发出，调用方不阻塞
+    - 全局令牌桶 + 每个会话一个令牌桶 (群组更严)，同一会话内严格保持顺序
+    - 429 按 retry_after 暂停该会话；网络错误 / 5xx 退避重试
+    - 两个优先级通道，指令回复先于推送通知
+    """
+    def __init__(self):
+        self.running = False
+        self.thread = None
+        self._cond = threading.Condition()
+        self._lanes = {PRIORITY_REPLY: deque(), PRIORITY_NOTIFY: deque()}
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_BURST)
+        self._chat_buckets = {}
+        self._chat_paused = {}
+        # 正在发送中的会话，发送完成前不取它的下一条 (重启时新旧发送线程短暂并存也不会乱序)
+        self._sending = set()
+        # on_reject 正在准备替换消息的会话，替换消息回到队首之前不发该会话的后续消息
+        self._held = set()
+        self._stats = {"queued": 0, "sent": 0, "retried": 0, "rate_limited": 0, "failed": 0, "dropped": 0,
+                       "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        self.thread = threading.Thread(target=self._send_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread = None
+        with self._cond: self._cond.notify_all()
+
+    def _proxies(self):
+        proxy = cfg.get("proxy_url")
+        return {"http": proxy, "https": proxy} if proxy else None
+
+    def _bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # 群组/频道的 chat_id 为负数
+            bucket = TokenBucket(TG_GROUP_RATE, TG_GROUP_BURST) if chat_id.startswith("-") else TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    # ---------- 入队 ----------
+    def send(self, method, chat_id, data, files=None, priority=PRIORITY_NOTIFY, fallback=None, on_result=None, on_reject=None):
+        """
+        入队一条 Bot API 调用 (sendMessage / sendPhoto ...)
+        fallback: 最终失败时改发的另一条消息 (method, chat_id, data)
+        on_result: 成功后以 Telegram 返回的 result 回调 (在发送线程里执行)
+        on_reject: file_id 失效被拒绝时的无参回调，返回替换消息 {"method", "data", "files", "on_result"} (放回队首)，
+                   返回 None 时走 fallback；其它 4xx、网络错误 / 5xx 重试耗尽都直接走 fallback
+        """
+        msg = OutboundMessage(method, chat_id, data, files, priority, fallback, on_result, on_reject)
+        with self._cond:
+            lane = self._lanes[priority]
+            if priority == PRIORITY_NOTIFY and len(lane) >= TG_NOTIFY_QUEUE_MAX:
+                lane.popleft()
+                self._stats["dropped"] += 1
+                logger.warning("⚠️ Telegram 通知队列已满，丢弃最旧的一条")
+            lane.append(msg)
+            self._stats["queued"] += 1
+            self._cond.notify()
+
+    # ---------- 发送 ----------
+    def _next_ready(self):
+        """
+        在锁内挑选下一条可发送的消息，返回 (消息, 需要等待的秒数)
+        按通道优先级扫描；某会话的队首消息没轮到时，该会话后续消息也跳过以保持顺序
+        """
+        now = time.time()
+        wait = None
+        for priority in (PRIORITY_REPLY, PRIORITY_NOTIFY):
+            lane = self._lanes[priority]
+            blocked = set()
+            for idx, msg in enumerate(lane):
+                if msg.chat_id in blocked or msg.chat_id in self._sending or msg.chat_id in self._held: continue
+                delay = max(msg.not_before, self._chat_paused.get(msg.chat_id, 0)) - now
+                if delay <= 0:
+                    bucket = self._bucket(msg.chat_id)
+                    delay = bucket.try_acquire()
+                    if delay == 0:
+                        delay = self._global.try_acquire()
+                        if delay == 0:
+                            del lane[idx]
+                            self._sending.add(msg.chat_id)
+                            return msg, 0
+                        bucket.refund()
+                blocked.add(msg.chat_id)
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _send_loop(self):
+        # stop() 后马上 start() 时，旧线程可能还卡在一次请求里；回来后发现自己不是当前线程就退出
+        me = threading.current_thread()
+        session = requests.Session()
+        while self.running and self.thread is me:
+            with self._cond:
+                msg, wait = self._next_ready()
+                if msg is None:
+                    self._cond.wait(wait if wait is not None else 5)
+                    continue
+            try: self._deliver(msg, session)
+            finally:
+                with self._cond:
+                    self._sending.discard(msg.chat_id)
+                    self._cond.notify_all()
+
+    def _deliver(self, msg, session):
+        token = cfg.get("tg_bot_token")
+        if not token: return
+        if not msg.started:
+            msg.started = True
+            waited = (time.time() - msg.queued_at) * 1000
+            with self._cond:
+                self._stats["wait_ms_total"] += waited
+                self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], waited)
+        msg.attempts += 1
+        try:
+            url = tg_api_url(token, msg.method)
+            if msg.files: res = session.post(url, data=msg.data, files=msg.files, proxies=self._proxies(), timeout=30)
+            else: res = session.post(url, json=msg.data, proxies=self._proxies(), timeout=15)
+            body = res.json() if res.headers.get("Content-Type", "").startswith("application/json") else {}
+        except Exception as e:
+            logger.warning(f"Telegram {msg.method} 网络错误: {e}")
+            return self._retry(msg)
+
+        if res.status_code == 200 and body.get("ok"):
+            with self._cond: self._stats["sent"] += 1
+            if msg.on_result:
+                try: msg.on_result(body.get("result"))
+                except Exception as e: logger.error(f"Telegram Result Callback Error: {e}")
+            return
+        if res.status_code == 429:
+            retry_after = (body.get("parameters") or {}).get("retry_after", 5)
+            with self._cond:
+                self._stats["rate_limited"] += 1
+                self._chat_paused[msg.chat_id] = time.time() + retry_after
+                # 放回原通道队首，保证该会话的顺序
+                msg.attempts -= 1
+                self._lanes[msg.priority].appendleft(msg)
+                self._cond.notify()
+            logger.warning(f"Telegram 限流 chat={msg.chat_id}，{retry_after}s 后重试")
+            return
+        if res.status_code >= 500: return self._retry(msg)
+
+        # 4xx：请求本身有问题，重试无意义，有备选消息就改发备选
+        description = body.get('description', '')
+        logger.error(f"Telegram {msg.method} 失败: HTTP {res.status_code} {description}")
+        with self._cond: self._stats["failed"] += 1
+        if msg.on_reject and any(h in description.lower() for h in TG_BAD_FILE_ID_HINTS):
+            # 回调可能要访问 Emby (如重新下载上传图片)，放到独立线程，不阻塞发送线程；期间该会话暂停
+            with self._cond: self._held.add(msg.chat_id)
+            threading.Thread(target=self._reject, args=(msg,), daemon=True).start()
+        else: self._fallback(msg)
+
+    def _reject(self, msg):
+        replacement = None
+        try: replacement = msg.on_reject()
+        except Exception as e: logger.error(f"Telegram Reject Callback Error: {e}")
+        if replacement:
+            self._requeue(OutboundMessage(replacement["method"], msg.chat_id, replacement["data"], replacement.get("files"),
+                                          msg.priority, msg.fallback, replacement.get("on_result"), None))
+        else: self._fallback(msg)
+        with self._cond:
+            self._held.discard(msg.chat_id)
+            self._cond.notify()
+
+    def _fallback(self, msg):
+        if msg.fallback:
+            method, chat_id, data = msg.fallback
+            self._requeue(OutboundMessage(method, chat_id, data, None, msg.priority, None, None, None))
+
+    def _requeue(self, msg):
+        """替换消息 / 备选消息放回原通道队首，排在同一会话的后续消息之前"""
+        with self._cond:
+            self._lanes[msg.priority].appendleft(msg)
+            self._stats["queued"] += 1
+            self._cond.notify()
+
+    def _retry(self, msg):
+        with self._cond:
+            if msg.attempts >= TG_MAX_RETRIES:
+                self._stats["failed"] += 1
+            else:
+                self._stats["retried"] += 1
+                msg.not_before = time.time() + TG_RETRY_BACKOFF * (2 ** (msg.attempts - 1))
+                self._lanes[msg.priority].appendleft(msg)
+                self._cond.notify()
+                return
+        self._fallback(msg)
+
+    def get_stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            now = time.time()
+            s["depth"] = {"reply": len(self._lanes[PRIORITY_REPLY]), "notify": len(self._lanes[PRIORITY_NOTIFY])}
+            oldest = [lane[0].queued_at for lane in self._lanes.values() if lane]
+            s["oldest_age"] = round(now - min(oldest), 1) if oldest else 0
+            s["paused_chats"] = sum(1 for t in self._chat_paused.values() if t > now)
+        delivered = s["queued"] - s["dropped"] - s["depth"]["reply"] - s["depth"]["notify"]
+        s["wait_ms_avg"] = round(s["wait_ms_total"] / delivered, 1) if delivered > 0 else 0
+        s["wait_ms_total"] = round(s["wait_ms_total"], 1)
+        s["wait_ms_max"] = round(s["wait_ms_max"], 1)
+        return s
+
+tg_outbox = TelegramOutbox()
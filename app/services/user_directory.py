@@ -0,0 +1,172 @@
+import asyncio
+import functools
+import threading
+import time
+import logging
+from app.core.config import cfg
+from app.core.emby import emby
+
+logger = logging.getLogger("uvicorn")
+
+# 用户列表缓存有效期 (秒)；超过 REFRESH_AHEAD 比例后在后台提前刷新
+USER_CACHE_TTL = 300
+REFRESH_AHEAD = 0.8
+# 拉取失败后的冷却时间，避免 Emby 不可用时每个请求都去撞超时
+ERROR_BACKOFF = 15
+
+class UserDirectory:
+    """
+    进程级 Emby 用户目录
+    统一缓存 /emby/Users 的结果 (id→name、管理员 ID)，所有路由与服务共用，
+    用户增删或 Webhook 用户事件时失效/刷新
+    """
+    def __init__(self, ttl=USER_CACHE_TTL):
+        self.ttl = ttl
+        self._users = []
+        self._name_map = {}
+        self._admin_id = None
+        self._loaded_at = 0
+        self._retry_after = 0
+        self._lock = threading.Lock()
+        # 同一时刻只有一个调用方去拉 /emby/Users (同步与异步各一把)
+        self._refresh_lock = threading.Lock()
+        self._async_refresh = None
+        self._refreshing = False
+        self._stats = {"hits": 0, "misses": 0, "refreshes": 0, "background_refreshes": 0, "errors": 0}
+
+    # ---------- 数据加载 ----------
+    def _fetch(self):
+        if not emby.is_configured(): return None
+        try:
+            res = emby.get("/emby/Users", timeout=5)
+            if res.status_code == 200: return res.json()
+        except Exception as e:
+            logger.error(f"User Directory Fetch Error: {e}")
+        return None
+
+    def update(self, users):
+        """用一份完整的用户列表覆盖缓存 (其他地方已经拉过 /Users 时可以顺手回填)"""
+        admin_id = None
+        for u in users:
+            if u.get("Policy", {}).get("IsAdministrator"):
+                admin_id = u['Id']; break
+        # 没有管理员则使用第一个用户
+        if not admin_id and users: admin_id = users[0]['Id']
+        with self._lock:
+            self._users = users
+            self._name_map = {u['Id']: u['Name'] for u in users}
+            self._admin_id = admin_id
+            self._loaded_at = time.time()
+
+    def refresh(self):
+        users = self._fetch()
+        with self._lock:
+            self._stats["refreshes"] += 1
+            if users is None:
+                self._stats["errors"] += 1
+                self._retry_after = time.time() + ERROR_BACKOFF
+        if users is not None: self.update(users)
+        return users is not None
+
+    def refresh_async(self):
+        with self._lock:
+            if self._refreshing: return
+            self._refreshing = True
+            self._stats["background_refreshes"] += 1
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try: self.refresh()
+        finally:
+            with self._lock: self._refreshing = False
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = 0
+            self._retry_after = 0
+
+    def _ensure(self):
+        now = time.time()
+        with self._lock:
+            age = now - self._loaded_at
+            fresh = age < self.ttl
+            in_backoff = now < self._retry_after
+            self._stats["hits" if fresh else "misses"] += 1
+        if fresh:
+            if age > self.ttl * REFRESH_AHEAD: self.refresh_async()
+            return
+        if in_backoff: return
+        # 单飞：一个调用方刷新，其余等它完成后直接读缓存
+        with self._refresh_lock:
+            with self._lock:
+                now = time.time()
+                still_stale = now - self._loaded_at >= self.ttl and now >= self._retry_after
+            if still_stale: self.refresh()
+
+    async def ensure_async(self):
+        """async 路由用：缓存过期时用异步客户端拉取，之后的 get_* 调用都直接命中缓存"""
+        now = time.time()
+        with self._lock:
+            stale = now - self._loaded_at >= self.ttl
+            in_backoff = now < self._retry_after
+        if not stale or in_backoff or not emby.is_configured(): return
+        # 并发的请求共用同一次拉取
+        if self._async_refresh is None or self._async_refresh.done():
+            self._async_refresh = asyncio.ensure_future(self._arefresh())
+        await asyncio.shield(self._async_refresh)
+
+    async def _arefresh(self):
+        users = None
+        try:
+            res = await emby.aget("/emby/Users", timeout=5)
+            if res.status_code == 200: users = res.json()
+        except Exception as e:
+            logger.error(f"User Directory Fetch Error: {e}")
+        with self._lock:
+            self._stats["refreshes"] += 1
+            if users is None:
+                self._stats["errors"] += 1
+                self._retry_after = time.time() + ERROR_BACKOFF
+        if users is not None: self.update(users)
+
+    # ---------- 对外接口 ----------
+    def get_users(self):
+        self._ensure()
+        with self._lock: return list(self._users)
+
+    def get_user_map(self):
+        self._ensure()
+        with self._lock: return dict(self._name_map)
+
+    def get_name(self, user_id, default=None):
+        self._ensure()
+        with self._lock: return self._name_map.get(user_id, default)
+
+    def get_admin_id(self):
+        self._ensure()
+        with self._lock: return self._admin_id
+
+    def get_hidden(self):
+        return set(cfg.get("hidden_users") or [])
+
+    def get_stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["users"] = len(self._users)
+            s["age_seconds"] = round(time.time() - self._loaded_at) if self._loaded_at else None
+        total = s["hits"] + s["misses"]
+        s["hit_rate"] = round(s["hits"] / total, 3) if total else 0
+        return s
+
+user_directory = UserDirectory()
+
+def with_user_directory(fn):
+    """
+    装饰器：放在 @db_handler 上面，进入数据库线程前先用异步客户端刷新用户缓存，
+    避免 get_user_map() 在 db_executor 的线程里同步等 Emby
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        await user_directory.ensure_async()
+        return await fn(*args, **kwargs)
+    return wrapper
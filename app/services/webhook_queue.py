@@ -0,0 +1,211 @@
+import json
+import time
+import threading
+import logging
+from collections import deque
+from app.core.database import query_sidecar, sidecar_pool
+
+logger = logging.getLogger("uvicorn")
+
+# 内存缓冲上限：超过后 enqueue 返回 False，由 Webhook 接口返回 503 让发送方放慢
+WEBHOOK_BUFFER_MAX = 5000
+# 攒够这么多条或等待这么久就批量落盘
+WEBHOOK_FLUSH_BATCH = 200
+WEBHOOK_FLUSH_INTERVAL = 0.5
+# 消费线程数 (播放通知要下载封面、调 Telegram，单线程会排长队)
+WEBHOOK_WORKERS = 2
+# 处理失败的重试次数与退避 (秒)
+WEBHOOK_MAX_ATTEMPTS = 3
+WEBHOOK_RETRY_DELAY = 10
+# 超过这个时间还没处理的事件直接丢弃 (一天前的通知已经没意义了)
+WEBHOOK_RETENTION = 86400
+# 默认通道由 worker 消费；其它通道 (如 library) 由各自的服务按批认领
+LANE_DEFAULT = "default"
+
+class WebhookQueue:
+    """
+    持久化的 Webhook 事件队列 (旁路库 webhook_events 表)
+    - 接口只把事件放进内存缓冲就返回，后台线程批量 INSERT OR IGNORE 落盘
+    - DedupKey 唯一索引做去重 (同一条目在处理前重复推送只保留一条)
+    - 固定数量的 worker 按事件名分发给注册的处理函数，失败退避重试
+    - 重启后未处理完的事件继续处理
+    """
+    def __init__(self):
+        self.running = False
+        self.threads = []
+        self._lock = threading.Lock()
+        self._buffer = deque()
+        self._buffer_keys = set()
+        self._flush_wake = threading.Event()
+        self._work_wake = threading.Event()
+        self._handlers = {}
+        self._schema_ready = False
+        self._stats = {"enqueued": 0, "deduped": 0, "rejected": 0, "flushes": 0,
+                       "processed": 0, "failed": 0, "retried": 0, "dropped": 0,
+                       "lag_ms_total": 0.0, "lag_ms_max": 0.0}
+
+    def _ensure_schema(self):
+        if self._schema_ready: return
+        with sidecar_pool.writer() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS webhook_events (
+                                Id INTEGER PRIMARY KEY AUTOINCREMENT, Lane TEXT, Event TEXT,
+                                DedupKey TEXT UNIQUE, Payload TEXT, ReceivedAt REAL,
+                                Attempts INTEGER DEFAULT 0, NextAttempt REAL DEFAULT 0, Claimed INTEGER DEFAULT 0
+                            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_lane ON webhook_events (Lane, Claimed, NextAttempt)")
+        self._schema_ready = True
+
+    def register(self, event, handler):
+        """注册默认通道的事件处理函数 handler(payload)"""
+        self._handlers[event] = handler
+
+    def start(self):
+        if self.running: return
+        self.running = True
+        self._ensure_schema()
+        # 上次退出时正在处理的事件放回队列；过期事件清理掉
+        with sidecar_pool.writer() as conn:
+            conn.execute("UPDATE webhook_events SET Claimed = 0 WHERE Claimed = 1")
+            cur = conn.execute("DELETE FROM webhook_events WHERE ReceivedAt < ?", (time.time() - WEBHOOK_RETENTION,))
+            if cur.rowcount: logger.warning(f"⚠️ Webhook 队列丢弃 {cur.rowcount} 条过期事件")
+        self.threads = [threading.Thread(target=self._flush_loop, daemon=True)]
+        self.threads += [threading.Thread(target=self._worker_loop, daemon=True) for _ in range(WEBHOOK_WORKERS)]
+        for t in self.threads: t.start()
+
+    def stop(self):
+        self.running = False
+        self._flush_wake.set()
+        self._work_wake.set()
+        # 退出前把缓冲里的事件落盘，下次启动继续处理
+        self.flush()
+
+    # ---------- 入队 ----------
+    def enqueue(self, event, payload, dedup_key=None, lane=LANE_DEFAULT):
+        """O(1) 放入内存缓冲；缓冲已满返回 False"""
+        with self._lock:
+            if dedup_key and dedup_key in self._buffer_keys:
+                self._stats["deduped"] += 1
+                return True
+            if len(self._buffer) >= WEBHOOK_BUFFER_MAX:
+                self._stats["rejected"] += 1
+                return False
+            self._buffer.append((lane, event, dedup_key, json.dumps(payload, ensure_ascii=False), time.time()))
+            if dedup_key: self._buffer_keys.add(dedup_key)
+            self._stats["enqueued"] += 1
+            full = len(self._buffer) >= WEBHOOK_FLUSH_BATCH
+        if full: self._flush_wake.set()
+        return True
+
+    def flush(self):
+        with self._lock:
+            if not self._buffer: return 0
+            rows = list(self._buffer)
+            self._buffer.clear()
+            self._buffer_keys.clear()
+        try:
+            self._ensure_schema()
+            with sidecar_pool.writer() as conn:
+                before = conn.total_changes
+                conn.executemany("INSERT OR IGNORE INTO webhook_events (Lane, Event, DedupKey, Payload, ReceivedAt) VALUES (?, ?, ?, ?, ?)", rows)
+                inserted = conn.total_changes - before
+        except Exception as e:
+            logger.error(f"Webhook Queue Flush Error: {e}")
+            # 放回缓冲等下次重试，不丢事件
+            with self._lock:
+                self._buffer.extendleft(reversed(rows))
+                self._buffer_keys.update(r[2] for r in rows if r[2])
+            return 0
+        with self._lock:
+            self._stats["flushes"] += 1
+            self._stats["deduped"] += len(rows) - inserted
+        self._work_wake.set()
+        return inserted
+
+    def _flush_loop(self):
+        while self.running:
+            self._flush_wake.wait(WEBHOOK_FLUSH_INTERVAL)
+            self._flush_wake.clear()
+            self.flush()
+
+    # ---------- 认领 / 确认 ----------
+    def claim(self, lane, limit=1):
+        """认领指定通道里到期的事件，返回 [{"id", "event", "payload", "received_at", "attempts"}]"""
+        self._ensure_schema()
+        now = time.time()
+        with sidecar_pool.writer() as conn:
+            rows = conn.execute("SELECT Id, Event, Payload, ReceivedAt, Attempts FROM webhook_events WHERE Lane = ? AND Claimed = 0 AND NextAttempt <= ? ORDER BY Id LIMIT ?",
+                                (lane, now, limit)).fetchall()
+            if rows:
+                conn.execute(f"UPDATE webhook_events SET Claimed = 1 WHERE Id IN ({','.join(['?'] * len(rows))})", [r['Id'] for r in rows])
+        return [{"id": r['Id'], "event": r['Event'], "payload": json.loads(r['Payload']),
+                 "received_at": r['ReceivedAt'], "attempts": r['Attempts']} for r in rows]
+
+    def ack(self, entries):
+        """处理完成，删除事件并记录排队延迟"""
+        if not entries: return
+        query_sidecar(f"DELETE FROM webhook_events WHERE Id IN ({','.join(['?'] * len(entries))})", [e["id"] for e in entries])
+        now = time.time()
+        with self._lock:
+            for e in entries:
+                lag_ms = (now - e["received_at"]) * 1000
+                self._stats["processed"] += 1
+                self._stats["lag_ms_total"] += lag_ms
+                self._stats["lag_ms_max"] = max(self._stats["lag_ms_max"], lag_ms)
+
+    def release(self, entry):
+        """处理失败：放回队列退避重试，超过次数则丢弃 (认领方出错时必须调用，否则事件一直处于已认领状态)"""
+        if entry["attempts"] + 1 >= WEBHOOK_MAX_ATTEMPTS:
+            query_sidecar("DELETE FROM webhook_events WHERE Id = ?", (entry["id"],))
+            with self._lock: self._stats["dropped"] += 1
+            return
+        delay = WEBHOOK_RETRY_DELAY * (2 ** entry["attempts"])
+        query_sidecar("UPDATE webhook_events SET Claimed = 0, Attempts = Attempts + 1, NextAttempt = ? WHERE Id = ?",
+                      (time.time() + delay, entry["id"]))
+        with self._lock: self._stats["retried"] += 1
+
+    def pending(self, lane):
+        """通道里待处理的事件数 (含内存缓冲)"""
+        with self._lock: buffered = sum(1 for r in self._buffer if r[0] == lane)
+        self._ensure_schema()
+        row = query_sidecar("SELECT COUNT(*) AS c FROM webhook_events WHERE Lane = ? AND Claimed = 0", (lane,), one=True)
+        return buffered + (row['c'] if row else 0)
+
+    # ---------- 消费 ----------
+    def _worker_loop(self):
+        while self.running:
+            try:
+                batch = self.claim(LANE_DEFAULT)
+            except Exception as e:
+                logger.error(f"Webhook Queue Claim Error: {e}")
+                batch = []
+            if not batch:
+                self._work_wake.wait(1)
+                self._work_wake.clear()
+                continue
+            entry = batch[0]
+            handler = self._handlers.get(entry["event"])
+            try:
+                if handler: handler(entry["payload"])
+                self.ack([entry])
+            except Exception as e:
+                logger.error(f"Webhook Handler Error ({entry['event']}): {e}")
+                with self._lock: self._stats["failed"] += 1
+                self.release(entry)
+
+    def get_stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["buffered"] = len(self._buffer)
+        s["lag_ms_avg"] = round(s["lag_ms_total"] / s["processed"], 1) if s["processed"] else 0
+        s["lag_ms_total"] = round(s["lag_ms_total"], 1)
+        s["lag_ms_max"] = round(s["lag_ms_max"], 1)
+        try:
+            self._ensure_schema()
+            rows = query_sidecar("SELECT Lane, COUNT(*) AS c, MIN(ReceivedAt) AS oldest FROM webhook_events GROUP BY Lane") or []
+            now = time.time()
+            s["depth"] = {r['Lane']: r['c'] for r in rows}
+            s["oldest_age"] = {r['Lane']: round(now - r['oldest'], 1) for r in rows}
+        except Exception: pass
+        return s
+
+webhook_queue = WebhookQueue()
@@ -0,0 +1,56 @@
+import os
+import queue
+import sqlite3
+import tempfile
+import pytest
+
+# 插件库路径在导入 app 时读取，必须在导入前指向临时文件
+_TMP_DIR = tempfile.mkdtemp(prefix="embypulse-tests-")
+os.environ["DB_PATH"] = os.path.join(_TMP_DIR, "playback_reporting.db")
+
+from app.core import database
+
+PLAYBACK_ACTIVITY_SCHEMA = """CREATE TABLE PlaybackActivity (
+    DateCreated TEXT, UserId TEXT, ItemId TEXT, ItemType TEXT, ItemName TEXT,
+    PlaybackMethod TEXT, ClientName TEXT, DeviceName TEXT, PlayDuration INTEGER
+)"""
+
+def reset_pool(pool, path):
+    """连接池改指向新文件，丢弃旧连接"""
+    if pool._writer is not None: pool._writer.close()
+    pool._writer = None
+    while not pool._idle.empty(): pool._idle.get_nowait()[0].close()
+    pool._idle = queue.LifoQueue()
+    pool._created = 0
+    pool.path = str(path)
+
+class PluginDB:
+    """插件库替身：测试里模拟插件往 PlaybackActivity 追加记录"""
+    def __init__(self, path):
+        self.path = path
+
+    def add(self, rows):
+        """rows: [(DateCreated, UserId, ItemId, ItemName, PlayDuration), ...]"""
+        conn = sqlite3.connect(self.path)
+        conn.executemany("INSERT INTO PlaybackActivity (DateCreated, UserId, ItemId, ItemType, ItemName, ClientName, DeviceName, PlayDuration) "
+                         "VALUES (?, ?, ?, 'Movie', ?, 'Web', 'Browser', ?)", rows)
+        conn.commit()
+        conn.close()
+
+@pytest.fixture
+def plugin_db():
+    path = database.DB_PATH
+    if os.path.exists(path): os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute(PLAYBACK_ACTIVITY_SCHEMA)
+    conn.close()
+    reset_pool(database.db_pool, path)
+    yield PluginDB(path)
+    reset_pool(database.db_pool, path)
+
+@pytest.fixture
+def sidecar(tmp_path):
+    """旁路库指向临时文件，各服务的建表在新库上重新执行"""
+    reset_pool(database.sidecar_pool, tmp_path / "pulse_data.db")
+    yield database.sidecar_pool
+    reset_pool(database.sidecar_pool, tmp_path / "pulse_data.db")
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import httpx
+import pytest
+from app.core.database import db_handler, run_db
+from app.services import user_directory as directory_module
+from app.services.image_cache import ImageCache
+from app.services.image_resolver import ImageIdResolver
+from app.services.user_directory import UserDirectory, with_user_directory
+
+USERS = [{"Id": "u1", "Name": "alice", "Policy": {"IsAdministrator": True}}]
+
+@pytest.fixture
+def fake_emby(monkeypatch):
+    """替换 emby.aget：按路径返回预设响应并记录调用"""
+    routes, calls = {}, []
+    async def aget(path, **kwargs):
+        calls.append((path, kwargs.get("params")))
+        await asyncio.sleep(0.01)
+        route = routes.get(path)
+        return route(kwargs.get("params")) if callable(route) else (route or httpx.Response(404))
+    monkeypatch.setattr(directory_module.emby, "aget", aget)
+    monkeypatch.setattr(directory_module.emby, "is_configured", lambda: True)
+    return routes, calls
+
+def test_run_db_executes_on_db_threads():
+    assert asyncio.run(run_db(lambda: threading.current_thread().name)).startswith("db")
+
+def test_async_user_directory_readers_share_one_fetch(fake_emby):
+    routes, calls = fake_emby
+    routes["/emby/Users"] = httpx.Response(200, json=USERS)
+    directory = UserDirectory()
+    async def main(): await asyncio.gather(*(directory.ensure_async() for _ in range(5)))
+    asyncio.run(main())
+    assert [c[0] for c in calls] == ["/emby/Users"]
+    assert directory.get_admin_id() == "u1"
+
+def test_db_routes_refresh_user_map_before_entering_executor(fake_emby, monkeypatch):
+    routes, calls = fake_emby
+    routes["/emby/Users"] = httpx.Response(200, json=USERS)
+    directory = UserDirectory()
+    monkeypatch.setattr(directory_module, "user_directory", directory)
+    # 数据库线程里不允许再同步请求 Emby
+    def blocking_fetch(): raise AssertionError("get_user_map() fetched from a DB thread")
+    directory._fetch = blocking_fetch
+
+    @with_user_directory
+    @db_handler
+    def route(user_id: str):
+        return threading.current_thread().name, directory.get_user_map().get(user_id)
+
+    thread_name, name = asyncio.run(route("u1"))
+    assert thread_name.startswith("db") and name == "alice"
+
+@pytest.fixture
+def resolver(sidecar):
+    return ImageIdResolver()
+
+def test_batch_resolve_falls_back_per_item_for_misses(resolver, fake_emby):
+    routes, calls = fake_emby
+    # 批量接口只返回 ep1；ep2 (权限/层级问题) 靠详情接口兜底；gone 都查不到，按失败缓存
+    routes["/emby/Items"] = lambda params: httpx.Response(200, json={"Items": [
+        {"Id": "ep1", "Type": "Episode", "SeriesId": "S1", "SeriesPrimaryImageTag": "t1"},
+        {"Id": "m1", "Type": "Movie", "ImageTags": {"Primary": "mt"}}]})
+    routes["/emby/Items/ep2"] = httpx.Response(200, json={"Type": "Episode", "SeriesId": "S2"})
+    result = asyncio.run(resolver.aresolve_many(["ep1", "m1", "ep2", "gone"]))
+    assert result == {"ep1": {"image_id": "S1", "tag": "t1"}, "m1": {"image_id": "m1", "tag": "mt"},
+                      "ep2": {"image_id": "S2", "tag": None}, "gone": {"image_id": "gone", "tag": None}}
+    # 再次解析全部命中缓存
+    calls.clear()
+    assert asyncio.run(resolver.aresolve("ep2")) == "S2"
+    assert calls == []
+
+def test_image_cache_streams_async_responses(sidecar, tmp_path):
+    cache = ImageCache(root=str(tmp_path / "images"))
+    chunks = [b"a" * 70000, b"b" * 70000]
+    class Stream(httpx.AsyncByteStream):
+        closed = False
+        async def __aiter__(self):
+            for c in chunks: yield c
+        async def aclose(self): Stream.closed = True
+    resp = httpx.Response(200, headers={"Content-Type": "image/png"}, stream=Stream())
+    entry = asyncio.run(cache.aput("user:u1:full", resp))
+    assert entry["Size"] == 140000 and entry["ContentType"] == "image/png"
+    assert Stream.closed
+    with open(cache._path(entry["Digest"]), "rb") as f: assert f.read() == b"".join(chunks)
+    assert cache.get("user:u1:full")["Digest"] == entry["Digest"]
@@ -0,0 +1,61 @@
+import threading
+import time
+import pytest
+from app.services import calendar_service as calendar_module
+from app.services.calendar_service import CalendarService, week_start
+
+class SlowBuild:
+    """替代 _build_week：计数并模拟耗时的 Emby + TMDB 构建"""
+    def __init__(self, service, cache=True, delay=0.2):
+        self.service = service
+        self.cache = cache
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, week_offset):
+        self.calls += 1
+        time.sleep(self.delay)
+        data = {"date_range": "w", "days": [self.calls]} if self.cache else {"days": []}
+        if self.cache:
+            with self.service._cache_lock:
+                self.service._cache[week_offset] = {"data": data, "time": time.time(), "week_start": week_start(week_offset)}
+        return data
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(calendar_module.cfg, "get", lambda key: {"tmdb_api_key": "k", "calendar_cache_ttl": 60}.get(key))
+    return CalendarService()
+
+def _concurrent(fn, n=6):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(fn())) for _ in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return results
+
+def test_concurrent_cold_requests_build_once(service):
+    service._build_week = build = SlowBuild(service)
+    results = _concurrent(lambda: service.get_weekly_calendar(week_offset=0))
+    assert build.calls == 1
+    assert all(r["days"] == [1] for r in results)
+
+def test_followers_receive_uncached_leader_result(service):
+    # 没有连载剧时结果不写缓存，等待者也要拿到同一份结果而不是超时
+    service._build_week = build = SlowBuild(service, cache=False)
+    results = _concurrent(lambda: service.get_weekly_calendar(week_offset=0))
+    assert build.calls == 1
+    assert results == [{"days": []}] * 6
+
+def test_stale_cache_is_served_while_rebuilding(service, monkeypatch):
+    service._build_week = build = SlowBuild(service, delay=0.3)
+    service.get_weekly_calendar(week_offset=0)
+    now = time.time()
+    monkeypatch.setattr(calendar_module.time, "time", lambda: now + 61)
+    started = time.perf_counter()
+    result = service.get_weekly_calendar(week_offset=0)
+    assert time.perf_counter() - started < 0.2
+    assert result["days"] == [1] and result["refreshing"]
+    # 过期期间的重复请求不会再触发重建
+    service.get_weekly_calendar(week_offset=0)
+    while service.is_refreshing(0): time.sleep(0.05)
+    assert build.calls == 2
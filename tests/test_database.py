@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import threading
+import pytest
+from app.core.database import SQLitePool, query_db
+
+@pytest.fixture
+def pool(tmp_path):
+    path = str(tmp_path / "pool.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (v INTEGER)")
+    conn.close()
+    return SQLitePool(path, size=2)
+
+def test_reader_connection_is_reused(pool):
+    for _ in range(5):
+        with pool.reader() as conn: conn.execute("SELECT * FROM t").fetchall()
+    stats = pool.get_stats()
+    assert stats["open"] == 1
+    assert stats["checkouts"] == 5
+
+def test_readers_are_capped_at_pool_size(pool):
+    held = threading.Barrier(3)
+    release = threading.Event()
+    def hold():
+        with pool.reader():
+            held.wait()
+            release.wait(5)
+    threads = [threading.Thread(target=hold) for _ in range(2)]
+    for t in threads: t.start()
+    held.wait()
+    # 两个连接都被占用，第三个调用方只能等归还
+    waiter = threading.Thread(target=lambda: pool.reader().__enter__())
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive()
+    assert pool.get_stats()["open"] == 2
+    release.set()
+    for t in threads: t.join()
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert pool.get_stats()["waits"] == 1
+
+def test_reader_rejects_writes(pool):
+    with pytest.raises(sqlite3.OperationalError):
+        with pool.reader() as conn: conn.execute("INSERT INTO t VALUES (1)")
+
+def test_writes_go_through_writer_and_are_visible_to_readers(pool):
+    with pool.writer() as conn: conn.execute("INSERT INTO t VALUES (42)")
+    with pool.reader() as conn: assert conn.execute("SELECT v FROM t").fetchone()[0] == 42
+    assert pool.get_stats()["writes"] == 1
+
+def test_replaced_database_file_reopens_readers(pool):
+    with pool.reader() as conn: conn.execute("SELECT * FROM t").fetchall()
+    # 插件重建数据库：旧连接指向已删除的 inode，必须换新连接
+    os.remove(pool.path)
+    conn = sqlite3.connect(pool.path)
+    conn.execute("CREATE TABLE t (v INTEGER)")
+    conn.execute("INSERT INTO t VALUES (7)")
+    conn.commit()
+    conn.close()
+    with pool.reader() as conn: assert conn.execute("SELECT v FROM t").fetchone()[0] == 7
+    assert pool.get_stats()["discarded"] == 1
+
+def test_query_db_reads_plugin_table(plugin_db):
+    plugin_db.add([("2026-01-01 10:00:00", "u1", "i1", "Movie A", 60)])
+    row = query_db("SELECT COUNT(*) as c FROM PlaybackActivity", one=True)
+    assert row["c"] == 1
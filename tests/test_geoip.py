@@ -0,0 +1,34 @@
+import pytest
+from app.services import geoip as geoip_module
+from app.services.geoip import GeoIPService, LOCATION_LAN, LOCATION_LOCAL, LOCATION_UNKNOWN
+
+@pytest.fixture
+def geo(sidecar, monkeypatch):
+    monkeypatch.setattr(geoip_module.cfg, "get", lambda key: None)
+    return GeoIPService()
+
+@pytest.mark.parametrize("raw, expected", [
+    ("1.2.3.4:5678", "1.2.3.4"),
+    ("[2001:db8::1]:8096", "2001:db8::1"),
+    ("::ffff:8.8.8.8", "8.8.8.8"),
+    ("not-an-ip", None),
+    ("", None),
+])
+def test_normalize(raw, expected):
+    assert GeoIPService.normalize(raw) == expected
+
+def test_private_and_loopback_addresses_skip_lookups(geo):
+    assert geo.lookup("127.0.0.1") == LOCATION_LOCAL
+    assert geo.lookup("192.168.1.10:50000") == LOCATION_LAN
+    assert geo.get_stats()["lru_hits"] == 0
+
+def test_cached_locations_are_served_from_db_then_memory(geo):
+    geo._store("8.8.8.8", "美国", "online")
+    assert geo.lookup("8.8.8.8") == "美国"
+    assert geo.lookup("8.8.8.8") == "美国"
+    stats = geo.get_stats()
+    assert (stats["db_hits"], stats["lru_hits"]) == (1, 1)
+
+def test_unknown_without_offline_db_or_online_lookup(geo):
+    assert geo.lookup("8.8.4.4") == LOCATION_UNKNOWN
+    assert geo.get_stats()["unknown"] == 1
@@ -0,0 +1,78 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from app.routers import history
+
+@pytest.fixture
+def client(plugin_db):
+    history._count_cache.clear()
+    app = FastAPI()
+    app.include_router(history.router)
+    return TestClient(app)
+
+def _walk(client, limit, **params):
+    ids, cursor = [], None
+    while True:
+        query = {"limit": limit, **params}
+        if cursor: query["cursor"] = cursor
+        body = client.get("/api/history/list", params=query).json()
+        assert body["status"] == "success"
+        ids += [r["RowId"] for r in body["data"]]
+        cursor = body["pagination"]["next_cursor"]
+        if not cursor: return ids
+
+def test_cursor_pagination_neither_repeats_nor_skips(plugin_db, client):
+    # 大量同一时间的记录，翻页边界落在相同 DateCreated 上时靠 rowid 区分
+    rows = [(f"2026-01-{10 + i // 7:02d} 12:00:00", f"u{i % 3}", f"i{i}", f"Movie {i}", 60) for i in range(53)]
+    plugin_db.add(rows)
+    ids = _walk(client, limit=5)
+    assert len(ids) == 53
+    assert len(set(ids)) == 53
+    assert ids == sorted(ids, key=lambda rid: (rows[rid - 1][0], rid), reverse=True)
+
+def test_cursor_pagination_respects_user_filter(plugin_db, client):
+    plugin_db.add([("2026-01-01 12:00:00", f"u{i % 2}", f"i{i}", f"Movie {i}", 60) for i in range(20)])
+    ids = _walk(client, limit=3, user_id="u1")
+    assert sorted(ids) == [i + 1 for i in range(20) if i % 2 == 1]
+
+def test_page_mode_reports_total_and_first_cursor(plugin_db, client):
+    plugin_db.add([("2026-01-01 12:00:00", "u1", f"i{i}", f"Movie {i}", 60) for i in range(12)])
+    body = client.get("/api/history/list", params={"page": 2, "limit": 5}).json()
+    assert body["pagination"]["total"] == 12
+    assert [r["RowId"] for r in body["data"]] == [7, 6, 5, 4, 3]
+    assert body["pagination"]["next_cursor"]
+
+@pytest.fixture
+def search_index(sidecar, monkeypatch):
+    from app.services.search_index import HistorySearchIndex
+    index = HistorySearchIndex()
+    index.init_schema()
+    index.running = True
+    monkeypatch.setattr(history, "history_index", index)
+    return index
+
+def test_fts_search_matches_substrings_and_highlights(plugin_db, client, search_index):
+    plugin_db.add([("2026-01-01 12:00:00", "u1", "i1", "星际穿越", 60),
+                   ("2026-01-02 12:00:00", "u1", "i2", "穿越时空的少女", 60),
+                   ("2026-01-03 12:00:00", "u2", "i3", "Interstellar <b>", 60)])
+    search_index.sync()
+    body = client.get("/api/history/list", params={"keyword": "穿越"}).json()
+    # 两个字的关键词不够 trigram，回退 LIKE，结果一致
+    assert sorted(r["ItemId"] for r in body["data"]) == ["i1", "i2"]
+
+    body = client.get("/api/history/list", params={"keyword": "穿越时"}).json()
+    assert [r["ItemId"] for r in body["data"]] == ["i2"]
+    assert body["data"][0]["HighlightName"] == "<mark>穿越时</mark>空的少女"
+    assert body["pagination"]["total"] == 1
+
+    body = client.get("/api/history/list", params={"keyword": "stellar"}).json()
+    # 标题里的 HTML 被转义，只有命中部分包在 <mark> 里
+    assert body["data"][0]["HighlightName"] == "Inter<mark>stellar</mark> &lt;b&gt;"
+
+def test_fts_index_follows_new_rows_and_cursor_pages(plugin_db, client, search_index):
+    plugin_db.add([("2026-01-01 12:00:00", "u1", f"i{i}", f"Episode title {i}", 60) for i in range(9)])
+    search_index.sync()
+    plugin_db.add([("2026-01-02 12:00:00", "u1", "i9", "Episode title 9", 60)])
+    search_index.sync()
+    ids = _walk(client, limit=4, keyword="title")
+    assert ids == list(range(10, 0, -1))
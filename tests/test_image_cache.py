@@ -0,0 +1,81 @@
+import os
+import time
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from app.services import image_cache as image_cache_module
+from app.services.image_cache import ImageCache
+
+class FakeImageResponse:
+    def __init__(self, content, content_type="image/jpeg"):
+        self.content = content
+        self.headers = {"Content-Type": content_type}
+        self.closed = False
+
+    def iter_content(self, size):
+        for i in range(0, len(self.content), size): yield self.content[i:i + size]
+
+    def close(self): self.closed = True
+
+@pytest.fixture
+def cache(sidecar, tmp_path):
+    return ImageCache(root=str(tmp_path / "images"))
+
+def test_put_then_get_serves_from_disk(cache):
+    resp = FakeImageResponse(b"poster-bytes" * 1000)
+    entry = cache.put("item:1:primary:t1", resp, tagged=True)
+    assert resp.closed
+    hit = cache.get("item:1:primary:t1")
+    assert hit["Digest"] == entry["Digest"]
+    with open(cache._path(hit["Digest"]), "rb") as f: assert f.read() == resp.content
+    assert cache.get("item:2:primary:t1") is None
+    assert cache.get_stats()["hits"] == 1
+
+def test_identical_content_is_stored_once(cache):
+    cache.put("a", FakeImageResponse(b"same"), tagged=True)
+    cache.put("b", FakeImageResponse(b"same"), tagged=True)
+    assert cache.get_stats()["bytes"] == 4
+    files = [f for _, _, names in os.walk(cache.root) for f in names]
+    assert len(files) == 1
+
+def test_non_image_responses_are_not_cached(cache):
+    assert cache.put("x", FakeImageResponse(b"{}", "application/json")) is None
+    assert cache.get("x") is None
+
+def test_untagged_entries_expire(cache, monkeypatch):
+    cache.put("u", FakeImageResponse(b"avatar"))
+    cache.put("t", FakeImageResponse(b"poster"), tagged=True)
+    now = time.time()
+    monkeypatch.setattr(image_cache_module.time, "time", lambda: now + image_cache_module.IMAGE_UNTAGGED_TTL + 1)
+    assert cache.get("u") is None
+    assert cache.get("t") is not None
+
+def test_eviction_drops_least_recently_used(cache, monkeypatch):
+    monkeypatch.setattr(cache, "_max_bytes", lambda: 20000)
+    now = [1000.0]
+    monkeypatch.setattr(image_cache_module.time, "time", lambda: now[0])
+    for i in range(200):
+        now[0] += 1
+        cache.put(f"k{i}", FakeImageResponse(i.to_bytes(2, "big") * 50), tagged=True)
+    # k0 刚被访问过，淘汰时留下它
+    now[0] += 1
+    cache.get("k0")
+    cache._flush_touches()
+    now[0] += 1
+    cache.put("k200", FakeImageResponse(b"\xff" * 100), tagged=True)
+    assert cache.get_stats()["bytes"] <= 20000 * image_cache_module.EVICT_TARGET
+    assert cache.get("k0") is not None
+    assert cache.get("k1") is None
+    assert cache.get("k200") is not None
+
+def test_respond_revalidates_with_etag(cache):
+    entry = cache.put("p", FakeImageResponse(b"poster"), tagged=True)
+    app = FastAPI()
+    @app.get("/img")
+    def img(request: Request): return cache.respond(entry, request)
+    client = TestClient(app)
+    first = client.get("/img")
+    assert first.status_code == 200 and first.content == b"poster"
+    assert "immutable" in first.headers["cache-control"]
+    second = client.get("/img", headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 304
@@ -0,0 +1,44 @@
+import time
+import pytest
+from app.services import playback_events as events_module
+from app.services.playback_events import PlaybackEventStore
+
+@pytest.fixture
+def store(plugin_db, sidecar):
+    return PlaybackEventStore()
+
+def _event(play_session, date, item_id="i1", user_id="u1"):
+    return {"Date": date, "User": {"Id": user_id}, "Item": {"Id": item_id, "Name": "Movie", "Type": "Movie", "RunTimeTicks": 72000 * 10_000_000},
+            "Session": {"Id": "s1", "DeviceName": "TV", "Client": "Emby"}, "PlaybackInfo": {"PlaySessionId": play_session}}
+
+def test_redelivered_events_are_recorded_once(store):
+    store.record(_event("p1", "t1"), "start")
+    store.record(_event("p1", "t1"), "start")
+    plays = store.get_live_plays("all")
+    assert len(plays) == 1 and plays[0]["InProgress"]
+
+def test_new_play_of_same_item_is_a_new_row(store):
+    store.record(_event("p1", "t1"), "start")
+    store.record(_event("p1", "t2"), "stop")
+    store.record(_event("p2", "t3"), "start")
+    assert [p["InProgress"] for p in store.get_live_plays("all")] == [True, False]
+
+def test_plays_synced_by_plugin_are_not_counted_twice(store, plugin_db):
+    store.record(_event("p1", "t1"), "start")
+    store.record(_event("p1", "t2"), "stop")
+    plugin_db.add([("2026-01-01 12:00:00", "u1", "i1", "Movie", 60)])
+    assert store.get_live_plays("all") == []
+
+def test_stopped_play_expires_after_grace(store, monkeypatch):
+    store.record(_event("p1", "t1"), "start")
+    store.record(_event("p1", "t2"), "stop")
+    assert len(store.get_live_plays("all")) == 1
+    now = time.time()
+    monkeypatch.setattr(events_module.time, "time", lambda: now + events_module.PLAYBACK_STOPPED_GRACE + 1)
+    assert store.get_live_plays("all") == []
+
+def test_open_play_without_stop_expires(store, monkeypatch):
+    store.record(_event("p1", "t1"), "start")
+    now = time.time()
+    monkeypatch.setattr(events_module.time, "time", lambda: now + events_module.PLAYBACK_OPEN_MAX + 1)
+    assert store.get_live_plays("all") == []
@@ -0,0 +1,89 @@
+import random
+from collections import Counter, defaultdict
+import pytest
+from app.core.database import sidecar_pool
+from app.services.quality_service import QualityService, WORST_EPISODES
+
+COLUMNS = ("ItemId", "ItemType", "Name", "SeriesId", "SeriesName", "SeasonNumber", "EpisodeNumber",
+           "LibraryId", "LibraryName", "Width", "Height", "Resolution", "Codec", "HdrType", "Bitrate")
+
+@pytest.fixture
+def quality(sidecar):
+    service = QualityService()
+    service.init_schema()
+    return service
+
+def _episodes(seed=1):
+    rnd = random.Random(seed)
+    rows = []
+    for s in range(12):
+        for e in range(rnd.randint(1, 15)):
+            width = rnd.choice([640, 1280, 1920, 3840])
+            resolution = {640: "sd", 1280: "720p", 1920: "1080p", 3840: "4k"}[width] if rnd.random() > 0.1 else None
+            rows.append((f"S{s}-{e}", "Episode", f"E{e}", f"S{s}", f"Series {s}", rnd.choice([1, 2, None]), e,
+                         rnd.choice(["L1", "L2"]), "TV", width, width * 9 // 16, resolution,
+                         rnd.choice(["hevc", "h264", None]), rnd.choice(["hdr10", "sdr", None]), rnd.randint(1, 9) * 1000))
+    return [dict(zip(COLUMNS, r)) for r in rows]
+
+def _insert(rows):
+    with sidecar_pool.writer() as conn:
+        conn.executemany(f"INSERT INTO media_quality ({', '.join(COLUMNS)}) VALUES ({', '.join(['?'] * len(COLUMNS))})",
+                         [tuple(r[c] for c in COLUMNS) for r in rows])
+
+def _expected(rows):
+    """Python 里直接按集合计算的汇总，用来核对 SQL"""
+    out = {}
+    for sid, eps in _group(rows, lambda r: r["SeriesId"]).items():
+        counts = Counter(r["Resolution"] for r in eps if r["Resolution"])
+        widths = defaultdict(int)
+        for r in eps:
+            if r["Resolution"]: widths[r["Resolution"]] = max(widths[r["Resolution"]], r["Width"])
+        dominant = max(counts, key=lambda res: (counts[res], widths[res])) if counts else None
+        out[sid] = {"episodes": len(eps), "dominant_resolution": dominant,
+                    "sd_count": sum(r["Resolution"] == "sd" for r in eps),
+                    "hevc_pct": round(100.0 * sum(r["Codec"] == "hevc" for r in eps) / len(eps), 1)}
+    return out
+
+def _group(rows, key):
+    groups = defaultdict(list)
+    for r in rows: groups[key(r)].append(r)
+    return groups
+
+def test_series_rollup_matches_episode_totals(quality):
+    rows = _episodes()
+    _insert(rows)
+    result = quality.get_series(page=1, limit=100)
+    expected = _expected(rows)
+    assert result["total"] == len(expected)
+    assert {r["SeriesId"]: {k: r[k] for k in ("episodes", "dominant_resolution", "sd_count", "hevc_pct")} for r in result["items"]} == expected
+
+def test_series_total_counts_groups_not_rows_and_pages(quality):
+    _insert(_episodes(seed=2))
+    first = quality.get_series(page=1, limit=5, sort="sd")
+    second = quality.get_series(page=2, limit=5, sort="sd")
+    assert first["total"] == 12
+    assert not {r["SeriesId"] for r in first["items"]} & {r["SeriesId"] for r in second["items"]}
+    assert [r["sd_count"] for r in first["items"]] == sorted((r["sd_count"] for r in first["items"]), reverse=True)
+
+def test_library_filter_applies_to_rollup_and_total(quality):
+    rows = _episodes(seed=3)
+    _insert(rows)
+    result = quality.get_series(limit=100, library_id="L1")
+    expected = _expected([r for r in rows if r["LibraryId"] == "L1"])
+    assert result["total"] == len(expected)
+    assert {r["SeriesId"]: r["episodes"] for r in result["items"]} == {k: v["episodes"] for k, v in expected.items()}
+
+def test_seasons_carry_their_own_worst_episodes(quality):
+    rows = _episodes(seed=4)
+    _insert(rows)
+    series = max(_group(rows, lambda r: r["SeriesId"]).items(), key=lambda kv: len(kv[1]))[0]
+    seasons = quality.get_seasons(series)
+    by_season = _group([r for r in rows if r["SeriesId"] == series], lambda r: r["SeasonNumber"])
+    assert {s["SeasonNumber"]: s["episodes"] for s in seasons} == {k: len(v) for k, v in by_season.items()}
+    for season in seasons:
+        worst = season["worst_episodes"]
+        assert len(worst) == min(WORST_EPISODES, season["episodes"])
+        # 没有季号的单集也只和同样没有季号的比较
+        assert all(w["SeasonNumber"] == season["SeasonNumber"] for w in worst)
+        expected_width = sorted(r["Width"] for r in by_season[season["SeasonNumber"]])[0]
+        assert worst[0]["Resolution"].startswith(f"{expected_width}x")
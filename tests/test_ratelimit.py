@@ -0,0 +1,32 @@
+import threading
+import time
+from app.core.ratelimit import TokenBucket
+
+def test_burst_then_rate_limited():
+    bucket = TokenBucket(rate=10, capacity=3)
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 0]
+    wait = bucket.try_acquire()
+    assert 0 < wait <= 0.1
+
+def test_tokens_refill_over_time():
+    bucket = TokenBucket(rate=20, capacity=1)
+    assert bucket.try_acquire() == 0
+    time.sleep(0.06)
+    assert bucket.try_acquire() == 0
+
+def test_refund_returns_token_without_exceeding_capacity():
+    bucket = TokenBucket(rate=1, capacity=2)
+    bucket.try_acquire()
+    bucket.refund()
+    bucket.refund()
+    assert bucket.tokens == 2
+
+def test_acquire_blocks_to_respect_rate():
+    bucket = TokenBucket(rate=50, capacity=1)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=bucket.acquire) for _ in range(6)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    # 首个令牌现成，其余 5 个按 50/s 发放
+    assert time.perf_counter() - started >= 5 / 50 * 0.9
+    assert bucket.waited_ms > 0
@@ -0,0 +1,70 @@
+import random
+import sqlite3
+import pytest
+from app.core.database import query_db, query_sidecar
+from app.services.rollup_service import RollupService
+
+@pytest.fixture
+def rollup(plugin_db, sidecar):
+    service = RollupService()
+    service.init_schema()
+    # sync() 只在 running 时循环读取批次，测试里不起后台线程
+    service.running = True
+    return service
+
+def _random_plays(n, seed=1):
+    rnd = random.Random(seed)
+    return [(f"2026-0{rnd.randint(1, 3)}-{rnd.randint(10, 28)} {rnd.randint(10, 23)}:00:00",
+             f"u{rnd.randint(1, 4)}", f"i{rnd.randint(1, 30)}", f"Item {rnd.randint(1, 30)}", rnd.randint(0, 7200))
+            for _ in range(n)]
+
+def _raw(sql):
+    return {tuple(r)[:-2]: tuple(r)[-2:] for r in query_db(sql)}
+
+def _rolled(sql):
+    return {tuple(r)[:-2]: tuple(r)[-2:] for r in query_sidecar(sql)}
+
+def test_rollup_totals_match_raw_totals(plugin_db, rollup, monkeypatch):
+    plugin_db.add(_random_plays(500))
+    # 小批次，覆盖多批累加
+    monkeypatch.setattr("app.services.rollup_service.ROLLUP_BATCH", 37)
+    rollup.sync()
+    assert rollup.ready
+
+    assert _rolled("SELECT Day, UserId, SUM(Plays), SUM(PlayDuration) FROM rollup_user_daily GROUP BY Day, UserId") == \
+        _raw("SELECT substr(DateCreated, 1, 10), UserId, COUNT(*), SUM(PlayDuration) FROM PlaybackActivity GROUP BY 1, 2")
+    assert _rolled("SELECT Month, ItemId, SUM(Plays), SUM(PlayDuration) FROM rollup_item_monthly GROUP BY Month, ItemId") == \
+        _raw("SELECT substr(DateCreated, 1, 7), ItemId, COUNT(*), SUM(PlayDuration) FROM PlaybackActivity GROUP BY 1, 2")
+    hourly = query_sidecar("SELECT SUM(Plays) as p, SUM(PlayDuration) as d FROM rollup_user_hourly", one=True)
+    assert (hourly["p"], hourly["d"]) == (500, sum(r[4] for r in _random_plays(500)))
+
+def test_incremental_sync_only_adds_new_rows(plugin_db, rollup):
+    plugin_db.add(_random_plays(100, seed=2))
+    rollup.sync()
+    plugin_db.add(_random_plays(50, seed=3))
+    rollup.sync()
+    rollup.sync()
+    total = query_sidecar("SELECT SUM(Plays) as p FROM rollup_user_monthly", one=True)
+    assert total["p"] == 150
+
+def test_watermark_survives_restart(plugin_db, rollup):
+    plugin_db.add(_random_plays(80, seed=4))
+    rollup.sync()
+    restarted = RollupService()
+    restarted.init_schema()
+    restarted.running = True
+    assert restarted.ready and restarted.last_rowid == 80
+    restarted.sync()
+    assert query_sidecar("SELECT SUM(Plays) as p FROM rollup_user_daily", one=True)["p"] == 80
+
+def test_rebuilt_plugin_table_resets_rollups(plugin_db, rollup):
+    plugin_db.add(_random_plays(60, seed=5))
+    rollup.sync()
+    # 插件清库重建：rowid 回退，汇总表从头重算
+    conn = sqlite3.connect(plugin_db.path)
+    conn.execute("DELETE FROM PlaybackActivity")
+    conn.commit()
+    conn.close()
+    plugin_db.add(_random_plays(10, seed=6))
+    rollup.sync()
+    assert query_sidecar("SELECT SUM(Plays) as p FROM rollup_user_daily", one=True)["p"] == 10
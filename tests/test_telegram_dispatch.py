@@ -0,0 +1,69 @@
+import threading
+import time
+import pytest
+from app.services import telegram_dispatch as dispatch_module
+from app.services.telegram_dispatch import CommandDispatcher
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    monkeypatch.setattr(dispatch_module, "TG_WATCHDOG_INTERVAL", 0.05)
+    d = CommandDispatcher(workers=2)
+    yield d
+    d.stop()
+
+def wait_for(cond, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if cond(): return True
+        time.sleep(0.02)
+    return False
+
+def _threads(dispatcher, loop):
+    """该分发池仍在运行的 worker / watchdog 线程"""
+    return [t for t in threading.enumerate()
+            if getattr(getattr(t, "_target", None), "__self__", None) is dispatcher and t._target.__func__ is loop]
+
+def test_same_chat_runs_in_order_other_chats_in_parallel(dispatcher):
+    log, gate = [], threading.Event()
+    dispatcher.start()
+    dispatcher.submit("1", ("1", "/slow"), lambda job: (gate.wait(5), log.append("1:slow")))
+    dispatcher.submit("1", ("1", "/next"), lambda job: log.append("1:next"))
+    dispatcher.submit("2", ("2", "/other"), lambda job: log.append("2:other"))
+    assert wait_for(lambda: log == ["2:other"])
+    gate.set()
+    assert wait_for(lambda: len(log) == 3)
+    assert log == ["2:other", "1:slow", "1:next"]
+
+def test_duplicate_command_is_ignored_while_pending(dispatcher):
+    gate = threading.Event()
+    dispatcher.start()
+    assert dispatcher.submit("1", ("1", "/stats"), lambda job: gate.wait(5))
+    assert not dispatcher.submit("1", ("1", "/stats"), lambda job: None)
+    gate.set()
+    assert wait_for(lambda: dispatcher.get_stats()["completed"] == 1)
+    assert dispatcher.submit("1", ("1", "/stats"), lambda job: None)
+    assert dispatcher.get_stats()["deduped"] == 1
+
+def test_watchdog_releases_stuck_command_and_replaces_worker(dispatcher):
+    timed_out, log, stuck = [], [], threading.Event()
+    dispatcher.on_timeout = lambda job: timed_out.append(job.key)
+    dispatcher.start()
+    dispatcher.submit("1", ("1", "/stuck"), lambda job: stuck.wait(5), timeout=0.1)
+    dispatcher.submit("1", ("1", "/after"), lambda job: log.append(job.cancelled))
+    assert wait_for(lambda: log == [False])
+    assert timed_out == [("1", "/stuck")]
+    assert dispatcher.get_stats()["timed_out"] == 1
+    # 卡住的线程被顶替，执行完后自行退出，不会多出 worker
+    stuck.set()
+    assert wait_for(lambda: len(_threads(dispatcher, CommandDispatcher._worker_loop)) == 2)
+
+def test_restart_leaves_no_duplicate_workers(dispatcher):
+    dispatcher.start()
+    dispatcher.stop()
+    dispatcher.start()
+    # 上一代的 worker / watchdog 发现代数变了就退出 (最多等一个 wait 周期)
+    assert wait_for(lambda: len(_threads(dispatcher, CommandDispatcher._worker_loop)) == 2, timeout=7)
+    assert wait_for(lambda: len(_threads(dispatcher, CommandDispatcher._watchdog_loop)) == 1)
+    done = []
+    dispatcher.submit("1", ("1", "/ping"), lambda job: done.append(1))
+    assert wait_for(lambda: done == [1])
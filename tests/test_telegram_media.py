@@ -0,0 +1,26 @@
+import time
+import pytest
+from app.services import telegram_media as media_module
+from app.services.telegram_media import TelegramFileIdCache
+
+@pytest.fixture
+def file_ids(sidecar):
+    return TelegramFileIdCache()
+
+def test_put_get_and_invalidate(file_ids):
+    assert file_ids.get("i1", "Primary", "t1") is None
+    file_ids.put("i1", "Primary", "t1", "FID")
+    assert file_ids.get("i1", "Primary", "t1") == "FID"
+    # 换了海报 (tag 变化) 不会命中旧 file_id
+    assert file_ids.get("i1", "Primary", "t2") is None
+    file_ids.invalidate("i1", "Primary", "t1")
+    assert file_ids.get("i1", "Primary", "t1") is None
+    assert file_ids.get_stats()["rejected"] == 1
+
+def test_untagged_file_ids_expire(file_ids, monkeypatch):
+    file_ids.put("i1", "Primary", None, "FID")
+    file_ids.put("i2", "Primary", "t", "FID2")
+    now = time.time()
+    monkeypatch.setattr(media_module.time, "time", lambda: now + media_module.FILE_ID_UNTAGGED_TTL + 1)
+    assert file_ids.get("i1", "Primary") is None
+    assert file_ids.get("i2", "Primary", "t") == "FID2"
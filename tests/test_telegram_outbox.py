@@ -0,0 +1,147 @@
+import threading
+import time
+import pytest
+from app.services import telegram_outbox as outbox_module
+from app.services.telegram_outbox import TelegramOutbox, PRIORITY_NOTIFY, PRIORITY_REPLY
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {"Content-Type": "application/json"}
+
+    def json(self): return self.body
+
+class FakeSession:
+    """按顺序返回预设响应 (默认成功)，记录每次请求"""
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.sent = []
+
+    def post(self, url, json=None, data=None, files=None, **kwargs):
+        body = json if json is not None else data
+        self.sent.append((url.rsplit("/", 1)[1], body.get("text") or body.get("photo")))
+        return self.responses.pop(0) if self.responses else FakeResponse(200, {"ok": True, "result": {}})
+
+@pytest.fixture
+def outbox(monkeypatch):
+    monkeypatch.setattr(outbox_module.cfg, "get", lambda key: {"tg_bot_token": "T"}.get(key))
+    return TelegramOutbox()
+
+def drain(outbox, session):
+    """不起发送线程，按 _send_loop 的方式把当前可发的消息逐条发完"""
+    while True:
+        with outbox._cond: msg, _ = outbox._next_ready()
+        if msg is None: return
+        try: outbox._deliver(msg, session)
+        finally:
+            with outbox._cond: outbox._sending.discard(msg.chat_id)
+
+def send(outbox, chat_id, body, priority=PRIORITY_NOTIFY, **kwargs):
+    outbox.send("sendMessage", chat_id, {"chat_id": chat_id, "text": body}, priority=priority, **kwargs)
+
+def test_replies_jump_ahead_of_notifications(outbox):
+    send(outbox, "1", "notify-1")
+    send(outbox, "2", "notify-2")
+    send(outbox, "3", "reply", priority=PRIORITY_REPLY)
+    session = FakeSession()
+    drain(outbox, session)
+    assert [s[1] for s in session.sent] == ["reply", "notify-1", "notify-2"]
+
+def test_per_chat_order_is_kept_when_chat_is_rate_limited(outbox):
+    for i in range(5): send(outbox, "1", f"a{i}")
+    send(outbox, "2", "b0")
+    session = FakeSession()
+    drain(outbox, session)
+    # 私聊令牌桶突发为 3：chat 1 的第 4 条要等，但不能被它后面的消息插队，chat 2 照常发送
+    assert [s[1] for s in session.sent] == ["a0", "a1", "a2", "b0"]
+    with outbox._cond:
+        assert [m.data["text"] for m in outbox._lanes[PRIORITY_NOTIFY]] == ["a3", "a4"]
+
+def test_429_pauses_chat_and_requeues_at_head(outbox):
+    send(outbox, "1", "first")
+    send(outbox, "1", "second")
+    session = FakeSession([FakeResponse(429, {"ok": False, "parameters": {"retry_after": 30}})])
+    drain(outbox, session)
+    assert [s[1] for s in session.sent] == ["first"]
+    assert outbox.get_stats()["rate_limited"] == 1
+    with outbox._cond:
+        assert [m.data["text"] for m in outbox._lanes[PRIORITY_NOTIFY]] == ["first", "second"]
+        outbox._chat_paused["1"] = 0
+        for bucket in outbox._chat_buckets.values(): bucket.tokens = bucket.capacity
+    drain(outbox, session)
+    assert [s[1] for s in session.sent] == ["first", "first", "second"]
+
+def test_server_errors_retry_then_fall_back(outbox, monkeypatch):
+    monkeypatch.setattr(outbox_module, "TG_RETRY_BACKOFF", 0)
+    monkeypatch.setattr(outbox_module, "TG_CHAT_BURST", 10)
+    outbox.send("sendPhoto", "1", {"chat_id": "1", "photo": "url"}, fallback=("sendMessage", "1", {"chat_id": "1", "text": "plain"}))
+    session = FakeSession([FakeResponse(502, {})] * outbox_module.TG_MAX_RETRIES)
+    drain(outbox, session)
+    assert [s[1] for s in session.sent] == ["url"] * outbox_module.TG_MAX_RETRIES + ["plain"]
+
+def test_notification_backlog_drops_oldest(outbox, monkeypatch):
+    monkeypatch.setattr(outbox_module, "TG_NOTIFY_QUEUE_MAX", 2)
+    for i in range(3): send(outbox, "1", f"n{i}")
+    send(outbox, "1", "reply", priority=PRIORITY_REPLY)
+    with outbox._cond:
+        assert [m.data["text"] for m in outbox._lanes[PRIORITY_NOTIFY]] == ["n1", "n2"]
+    assert outbox.get_stats()["dropped"] == 1
+
+def test_restart_leaves_single_sender(outbox, monkeypatch):
+    monkeypatch.setattr(outbox_module.requests, "Session", FakeSession)
+    outbox.start()
+    first = outbox.thread
+    outbox.stop()
+    outbox.start()
+    first.join(6)
+    assert not first.is_alive()
+    assert outbox.thread.is_alive()
+    outbox.stop()
+
+BAD_FILE_ID = FakeResponse(400, {"ok": False, "description": "Bad Request: wrong file identifier/HTTP URL specified"})
+
+def wait_until_released(outbox, chat_id):
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        with outbox._cond:
+            if chat_id not in outbox._held: return
+        time.sleep(0.01)
+    raise AssertionError("on_reject never finished")
+
+def test_rejected_file_id_is_replaced_at_head_of_lane(outbox):
+    downloaded = threading.Event()
+    def reupload():
+        downloaded.wait(5)
+        return {"method": "sendPhoto", "data": {"chat_id": "1", "photo": "uploaded"}, "files": None, "on_result": None}
+    outbox.send("sendPhoto", "1", {"chat_id": "1", "photo": "stale-file-id"}, on_reject=reupload)
+    send(outbox, "1", "next")
+    send(outbox, "2", "other chat")
+    session = FakeSession([BAD_FILE_ID])
+    drain(outbox, session)
+    # on_reject 在后台线程重新下载期间，该会话的后续消息不能先发，其它会话不受影响
+    assert [s[1] for s in session.sent] == ["stale-file-id", "other chat"]
+    downloaded.set()
+    wait_until_released(outbox, "1")
+    drain(outbox, session)
+    assert [s[1] for s in session.sent] == ["stale-file-id", "other chat", "uploaded", "next"]
+
+def test_reject_without_replacement_falls_back_in_order(outbox):
+    outbox.send("sendPhoto", "1", {"chat_id": "1", "photo": "stale-file-id"}, on_reject=lambda: None,
+                fallback=("sendMessage", "1", {"chat_id": "1", "text": "caption only"}))
+    send(outbox, "1", "next")
+    session = FakeSession([BAD_FILE_ID])
+    drain(outbox, session)
+    wait_until_released(outbox, "1")
+    drain(outbox, session)
+    assert [s[1] for s in session.sent] == ["stale-file-id", "caption only", "next"]
+
+def test_other_client_errors_skip_on_reject(outbox):
+    rejected = []
+    outbox.send("sendPhoto", "1", {"chat_id": "1", "photo": "file-id"}, on_reject=lambda: rejected.append(1),
+                fallback=("sendMessage", "1", {"chat_id": "1", "text": "caption only"}))
+    send(outbox, "1", "next")
+    session = FakeSession([FakeResponse(400, {"ok": False, "description": "Bad Request: can't parse entities"})])
+    drain(outbox, session)
+    assert rejected == []
+    assert [s[1] for s in session.sent] == ["file-id", "caption only", "next"]
@@ -0,0 +1,76 @@
+import json
+import pytest
+import requests
+from app.core import tmdb as tmdb_module
+from app.core.tmdb import TmdbClient
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, etag=None):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = {"ETag": etag} if etag else {}
+
+    def json(self): return json.loads(self.text)
+
+class FakeSession:
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        self.requests.append((url, dict(params), dict(headers)))
+        resp = self.responses.pop(0)
+        if isinstance(resp, Exception): raise resp
+        return resp
+
+@pytest.fixture
+def client(sidecar, monkeypatch):
+    monkeypatch.setattr(tmdb_module.cfg, "get", lambda key: {"tmdb_api_key": "k"}.get(key))
+    client = TmdbClient()
+    client._session = FakeSession()
+    return client
+
+def _expire(monkeypatch, seconds):
+    now = tmdb_module.time.time()
+    monkeypatch.setattr(tmdb_module.time, "time", lambda: now + seconds)
+
+def test_fresh_cache_hit_skips_network(client):
+    client._session.responses = [FakeResponse(200, {"id": 1}, etag='"v1"')]
+    assert client.get("/tv/1", {"language": "zh-CN"}) == {"id": 1}
+    assert client.get("/tv/1", {"language": "zh-CN"}) == {"id": 1}
+    assert len(client._session.requests) == 1
+    # api_key 不进缓存键，语言参数进
+    url, params, _ = client._session.requests[0]
+    assert params["api_key"] == "k"
+    assert client.get_stats()["hits"] == 1
+
+def test_expired_entry_revalidates_with_etag(client, monkeypatch):
+    client._session.responses = [FakeResponse(200, {"id": 1}, etag='"v1"'), FakeResponse(304)]
+    client.get("/tv/1", ttl=60)
+    _expire(monkeypatch, 61)
+    assert client.get("/tv/1", ttl=60) == {"id": 1}
+    assert client._session.requests[1][2]["If-None-Match"] == '"v1"'
+    assert client.get_stats()["revalidated"] == 1
+    # 304 续期后重新计时
+    assert client.get("/tv/1", ttl=60) == {"id": 1}
+    assert len(client._session.requests) == 2
+
+def test_changed_content_replaces_cache(client, monkeypatch):
+    client._session.responses = [FakeResponse(200, {"v": 1}, etag='"v1"'), FakeResponse(200, {"v": 2}, etag='"v2"')]
+    client.get("/tv/1", ttl=60)
+    _expire(monkeypatch, 61)
+    assert client.get("/tv/1", ttl=60) == {"v": 2}
+
+def test_errors_fall_back_to_stale_copy(client, monkeypatch):
+    client._session.responses = [FakeResponse(200, {"id": 1}), requests.ConnectionError("down"), FakeResponse(503)]
+    client.get("/tv/1", ttl=60)
+    _expire(monkeypatch, 61)
+    assert client.get("/tv/1", ttl=60) == {"id": 1}
+    assert client.get("/tv/1", ttl=60) == {"id": 1}
+    assert client.get_stats()["stale_served"] == 2
+
+def test_not_found_is_negatively_cached(client):
+    client._session.responses = [FakeResponse(404, {"status_message": "missing"})]
+    assert client.get("/tv/404") is None
+    assert client.get("/tv/404") is None
+    assert len(client._session.requests) == 1
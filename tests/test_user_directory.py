@@ -0,0 +1,50 @@
+import threading
+import time
+from app.services.user_directory import UserDirectory
+
+USERS = [{"Id": "u1", "Name": "alice", "Policy": {}}, {"Id": "u2", "Name": "bob", "Policy": {"IsAdministrator": True}}]
+
+class FakeFetch:
+    def __init__(self, result=USERS, delay=0):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock: self.calls += 1
+        time.sleep(self.delay)
+        return self.result
+
+def test_concurrent_cold_readers_share_one_fetch():
+    directory = UserDirectory()
+    directory._fetch = fetch = FakeFetch(delay=0.2)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(directory.get_user_map())) for _ in range(8)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert fetch.calls == 1
+    assert results == [{"u1": "alice", "u2": "bob"}] * 8
+    assert directory.get_admin_id() == "u2"
+
+def test_cached_map_is_served_without_fetching():
+    directory = UserDirectory()
+    directory._fetch = fetch = FakeFetch()
+    for _ in range(5): directory.get_name("u1")
+    assert fetch.calls == 1
+
+def test_failed_fetch_backs_off():
+    directory = UserDirectory()
+    directory._fetch = fetch = FakeFetch(result=None)
+    assert directory.get_user_map() == {}
+    assert directory.get_user_map() == {}
+    assert fetch.calls == 1
+    assert directory.get_stats()["errors"] == 1
+
+def test_invalidate_forces_refetch():
+    directory = UserDirectory()
+    directory._fetch = fetch = FakeFetch()
+    directory.get_users()
+    directory.invalidate()
+    directory.get_users()
+    assert fetch.calls == 2
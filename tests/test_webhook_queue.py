@@ -0,0 +1,101 @@
+import time
+import pytest
+from app.services import webhook_queue as queue_module
+from app.services.webhook_queue import WebhookQueue, LANE_DEFAULT
+
+@pytest.fixture
+def queue(sidecar):
+    q = WebhookQueue()
+    q._ensure_schema()
+    return q
+
+def test_enqueue_is_buffered_until_flush(queue):
+    assert queue.enqueue("playback.start", {"n": 1})
+    assert queue.pending(LANE_DEFAULT) == 1
+    assert queue.claim(LANE_DEFAULT) == []
+    assert queue.flush() == 1
+    assert [e["payload"] for e in queue.claim(LANE_DEFAULT)] == [{"n": 1}]
+
+def test_claimed_entries_are_not_handed_out_twice(queue):
+    for n in range(5): queue.enqueue("e", {"n": n})
+    queue.flush()
+    first = queue.claim(LANE_DEFAULT, limit=3)
+    second = queue.claim(LANE_DEFAULT, limit=3)
+    assert [e["payload"]["n"] for e in first] == [0, 1, 2]
+    assert [e["payload"]["n"] for e in second] == [3, 4]
+    queue.ack(first + second)
+    assert queue.pending(LANE_DEFAULT) == 0
+    assert queue.get_stats()["processed"] == 5
+
+def test_dedup_key_collapses_repeats_in_buffer_and_on_disk(queue):
+    queue.enqueue("library.new", {"Id": "a"}, dedup_key="library:a", lane="library")
+    queue.enqueue("library.new", {"Id": "a"}, dedup_key="library:a", lane="library")
+    queue.flush()
+    queue.enqueue("library.new", {"Id": "a"}, dedup_key="library:a", lane="library")
+    queue.flush()
+    assert queue.pending("library") == 1
+    assert queue.get_stats()["deduped"] == 2
+
+def test_lanes_are_claimed_independently(queue):
+    queue.enqueue("library.new", {"Id": "a"}, lane="library")
+    queue.enqueue("playback.start", {"Id": "b"})
+    queue.flush()
+    assert [e["payload"]["Id"] for e in queue.claim("library", limit=10)] == ["a"]
+    assert [e["payload"]["Id"] for e in queue.claim(LANE_DEFAULT, limit=10)] == ["b"]
+
+def test_release_backs_off_then_drops(queue, monkeypatch):
+    queue.enqueue("e", {"n": 1})
+    queue.flush()
+    now = time.time()
+    for attempt in range(queue_module.WEBHOOK_MAX_ATTEMPTS):
+        monkeypatch.setattr(queue_module.time, "time", lambda: now)
+        entry, = queue.claim(LANE_DEFAULT)
+        assert entry["attempts"] == attempt
+        queue.release(entry)
+        # 退避期间不会被再次认领
+        assert queue.claim(LANE_DEFAULT) == []
+        now += queue_module.WEBHOOK_RETRY_DELAY * (2 ** attempt) + 1
+    monkeypatch.setattr(queue_module.time, "time", lambda: now)
+    assert queue.claim(LANE_DEFAULT) == []
+    assert queue.get_stats()["dropped"] == 1
+
+def test_restart_requeues_claimed_entries(queue):
+    queue.enqueue("e", {"n": 1})
+    queue.flush()
+    assert queue.claim(LANE_DEFAULT)
+    # 进程在处理中途退出：新实例启动时把已认领的事件放回队列
+    restarted = WebhookQueue()
+    seen = []
+    restarted.register("e", seen.append)
+    restarted.start()
+    try:
+        deadline = time.time() + 5
+        while not seen and time.time() < deadline: time.sleep(0.05)
+    finally:
+        restarted.stop()
+    assert seen == [{"n": 1}]
+
+def test_full_buffer_rejects(queue, monkeypatch):
+    monkeypatch.setattr(queue_module, "WEBHOOK_BUFFER_MAX", 2)
+    assert queue.enqueue("e", {}) and queue.enqueue("e", {})
+    assert not queue.enqueue("e", {})
+
+def test_workers_dispatch_to_handlers_and_retry_failures(queue):
+    seen, failures = [], []
+    def handler(payload):
+        if payload["n"] == 2 and not failures:
+            failures.append(payload)
+            raise RuntimeError("boom")
+        seen.append(payload["n"])
+    queue.register("e", handler)
+    queue.start()
+    try:
+        for n in range(4): queue.enqueue("e", {"n": n})
+        queue.flush()
+        deadline = time.time() + 5
+        while len(seen) < 3 and time.time() < deadline: time.sleep(0.05)
+    finally:
+        queue.stop()
+    assert sorted(seen) == [0, 1, 3]
+    assert failures == [{"n": 2}]
+    assert queue.get_stats()["retried"] == 1